@@ -8,9 +8,15 @@ function monitor_download {
 while true
 do
   clear
-  monitor_download $1/data.sqlite3 Plan
-  monitor_download $1/data.sqlite3 Provider
-  monitor_download $1/data.sqlite3 Drug
+  # with several writers, each has a shard until they are merged
+  for db in $1/data.sqlite3 $1/data_shard*.sqlite3
+  do
+    [ -f $db ] || continue
+    echo $db
+    monitor_download $db Plan
+    monitor_download $db Provider
+    monitor_download $db Drug
+  done
 	echo 
   ls -lht $1 | head
   sleep 1
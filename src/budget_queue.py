@@ -0,0 +1,99 @@
+"""
+A queue between processes that is bounded by the bytes it holds rather
+than by the number of objects, so that a run of unusually big objects
+can't fill the memory of the processes on either end of it.
+"""
+import time
+import pickle
+import multiprocessing as mp
+from queue import Full as QueueFull
+
+_MB = 1024 * 1024
+
+
+class ByteBudgetQueue:
+    """
+    Stands in for multiprocessing.Queue. Objects are pickled as they are
+    put, and a put blocks while the pickled objects not yet taken out
+    would come to more than max_bytes. An object bigger than max_bytes
+    on its own is let through once the queue is empty. Producers
+    waiting for room are let in one at a time, so a big object isn't
+    starved by a stream of small ones from other producers. stats()
+    reports the objects and bytes queued, and the time producers have
+    spent blocked, over all processes sharing the queue.
+    """
+    def __init__(self, max_bytes=256*_MB):
+        self.max_bytes = max_bytes
+        self.queue = mp.Queue()
+        self.turnstile = mp.Lock()  # held by the producer next in line
+        self.cond = mp.Condition(mp.Lock())
+        self.depth = mp.Value('q', 0, lock=False)
+        self.bytes = mp.Value('q', 0, lock=False)
+        self.peak = mp.Value('q', 0, lock=False)  # most bytes queued
+        self.blocked = mp.Value('d', 0, lock=False)  # seconds
+        self.blocks = mp.Value('q', 0, lock=False)  # puts that had to wait
+
+    def _room(self, size):
+        # called holding cond
+        return (self.bytes.value == 0 or
+                self.bytes.value + size <= self.max_bytes)
+
+    def put(self, obj, block=True, timeout=None):
+        b = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        size = len(b)
+        start = time.monotonic()
+        if not self.turnstile.acquire(block, timeout):
+            raise QueueFull
+        try:
+            with self.cond:
+                if not self._room(size):
+                    if not block:
+                        raise QueueFull
+                    if timeout is not None:
+                        timeout = max(0, timeout - (time.monotonic() -
+                                                    start))
+                    self.blocks.value += 1
+                    room = self.cond.wait_for(lambda: self._room(size),
+                                              timeout)
+                    self.blocked.value += time.monotonic() - start
+                    if not room:
+                        raise QueueFull
+                self.depth.value += 1
+                self.bytes.value += size
+                self.peak.value = max(self.peak.value, self.bytes.value)
+        finally:
+            self.turnstile.release()
+        self.queue.put(b)
+
+    def put_nowait(self, obj):
+        self.put(obj, False)
+
+    def get(self, block=True, timeout=None):
+        b = self.queue.get(block, timeout)
+        with self.cond:
+            self.depth.value -= 1
+            self.bytes.value -= len(b)
+            self.cond.notify_all()
+        return pickle.loads(b)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return self.depth.value
+
+    def stats(self):
+        """
+        The objects and bytes queued now, the most bytes ever queued, and
+        the number of puts that had to wait and the seconds they waited.
+        """
+        with self.cond:
+            return {'depth': self.depth.value, 'bytes': self.bytes.value,
+                    'peak': self.peak.value, 'blocks': self.blocks.value,
+                    'blocked': self.blocked.value}
+
+    def close(self):
+        self.queue.close()
+
+    def join_thread(self):
+        self.queue.join_thread()
@@ -0,0 +1,243 @@
+"""
+An on-disk cache of raw HTTP responses, so that files which haven't
+changed since the last run are revalidated instead of downloaded again,
+and so that a whole run can be replayed from disk with no network at all.
+"""
+import os
+import json
+import time
+import hashlib
+import http.client
+import urllib.error as error
+
+_GB = 1024 * 1024 * 1024
+_DEFAULT_MAX_SIZE = 50 * _GB
+# response headers kept with a cached body
+_KEPT_HEADERS = ('Content-Type', 'Content-Encoding', 'ETag', 'Last-Modified')
+
+
+def _message(headers):
+    msg = http.client.HTTPMessage()
+    for name, value in headers.items():
+        msg[name] = value
+    return msg
+
+
+class CachedResponse:
+    """
+    A cached body, read back with the interface of an HTTP response.
+    """
+    def __init__(self, url, path, headers, status=200, offset=0):
+        self.url = url
+        self.status = status
+        self.headers = _message(headers)
+        self.file = open(path, 'rb')
+        self.file.seek(offset)
+
+    def info(self):
+        return self.headers
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _CachingResponse:
+    """
+    Passes a response through while copying its body to a temporary file,
+    which becomes the cache entry if, and only if, the body is read to the
+    end.
+    """
+    def __init__(self, cache, key, raw, meta):
+        self.cache = cache
+        self.key = key
+        self.raw = raw
+        self.meta = meta
+        self.tmp = cache._path(key, '.{}.tmp'.format(os.getpid()))
+        self.file = open(self.tmp, 'wb')
+        self.size = 0
+
+    def read(self, size=-1):
+        b = self.raw.read(size)
+        if self.file is None:
+            return b
+        if b:
+            self.file.write(b)
+            self.size += len(b)
+        if (not b and size != 0) or size is None or size < 0:
+            self._finish()
+        return b
+
+    def _finish(self):
+        self.file.close()
+        self.file = None
+        length = self.meta['headers'].get('Content-Length')
+        if length is not None and int(length) != self.size:
+            os.remove(self.tmp)
+            return
+        self.meta['headers']['Content-Length'] = str(self.size)
+        self.meta['size'] = self.size
+        self.cache._store(self.key, self.tmp, self.meta)
+
+    def close(self):
+        if self.file is not None:  # abandoned part way through
+            self.file.close()
+            self.file = None
+            os.remove(self.tmp)
+        self.raw.close()
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ResponseCache:
+    """
+    Keeps the bodies of complete 200 responses in directory, keyed by URL,
+    along with their ETag and Last-Modified headers. Cached URLs are
+    revalidated with a conditional GET and, when unchanged, served from
+    disk. Bodies are stored as sent, so still content-encoded. The least
+    recently used entries are evicted to keep the cache under max_size
+    bytes. In offline mode nothing is fetched: cached URLs are replayed as
+    they are and anything else raises a URLError.
+    """
+    def __init__(self, directory="data/cache", max_size=_DEFAULT_MAX_SIZE,
+                 offline=False):
+        self.directory = directory
+        self.max_size = max_size
+        self.offline = offline
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def _load(self, url):
+        """
+        Returns the key and metadata of url's cache entry, the latter None
+        if it has no usable entry.
+        """
+        key = hashlib.sha1(url.encode('utf8')).hexdigest()
+        try:
+            with open(self._path(key, '.json')) as f:
+                meta = json.load(f)
+            size = os.stat(self._path(key, '.body')).st_size
+        except (OSError, ValueError):
+            return key, None
+        if meta.get('url') != url or meta.get('size') != size:
+            return key, None
+        return key, meta
+
+    def _store(self, key, tmp, meta):
+        os.replace(tmp, self._path(key, '.body'))
+        tmp = self._path(key, '.json.{}.tmp'.format(os.getpid()))
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._path(key, '.json'))
+        self._evict()
+
+    def _hit(self, key, meta, headers):
+        """
+        Serve a cache entry, from the offset asked for by a Range header if
+        there is one.
+        """
+        path = self._path(key, '.body')
+        os.utime(path)  # recently used
+        offset = 0
+        if 'Range' in headers:
+            offset = int(headers['Range'].split('=')[1].rstrip('-'))
+            headers = dict(meta['headers'])
+            headers['Content-Range'] = "bytes {}-{}/{}".format(
+                offset, meta['size'] - 1, meta['size'])
+            headers['Content-Length'] = str(meta['size'] - offset)
+            return CachedResponse(meta['url'], path, headers, 206, offset)
+        return CachedResponse(meta['url'], path, meta['headers'])
+
+    def get(self, url, headers, fetch):
+        """
+        Return a response for a GET of url, from the cache where possible.
+        fetch(headers) makes the actual request and returns the response,
+        like request.urlopen. Range requests are served from the cache
+        only if their If-Range validator matches the cached entry, and are
+        never stored.
+        """
+        key, meta = self._load(url)
+        validators = ()
+        if meta is not None:
+            validators = (meta['headers'].get('ETag'),
+                          meta['headers'].get('Last-Modified'))
+        if 'Range' in headers:
+            if meta is not None and headers.get('If-Range') in validators:
+                # Ranges count unencoded bytes, so an encoded body is sent
+                # whole for the reader to skip through
+                if meta['headers'].get('Content-Encoding'):
+                    return self._hit(key, meta, {})
+                return self._hit(key, meta, headers)
+            if self.offline:
+                raise error.URLError("Range of {} not cached".format(url))
+            return fetch(headers)
+        if self.offline:
+            if meta is None:
+                raise error.URLError("{} is not cached".format(url))
+            return self._hit(key, meta, headers)
+
+        conditional = dict(headers)
+        if meta is not None:
+            etag, last_modified = validators
+            if etag:
+                conditional['If-None-Match'] = etag
+            if last_modified:
+                conditional['If-Modified-Since'] = last_modified
+        try:
+            raw = fetch(conditional)
+        except error.HTTPError as e:
+            if e.code != 304 or meta is None:
+                raise
+            e.close()
+            return self._hit(key, meta, headers)
+        status = getattr(raw, 'status', 200)
+        if status == 304 and meta is not None:
+            raw.read()  # no body, but lets a pooled connection be reused
+            raw.close()
+            return self._hit(key, meta, headers)
+        if status != 200:
+            return raw
+        kept = {name: raw.headers[name] for name in _KEPT_HEADERS
+                if raw.headers.get(name) is not None}
+        if raw.headers.get('Content-Length') is not None:
+            kept['Content-Length'] = raw.headers['Content-Length']
+        meta = {'url': url, 'headers': kept, 'fetched': time.time()}
+        return _CachingResponse(self, key, raw, meta)
+
+    def _evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.body'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.name))
+                    total += st.st_size
+        entries.sort()
+        for _, size, name in entries:
+            if total <= self.max_size:
+                break
+            key = name[:-len('.body')]
+            for suffix in ('.json', '.body'):
+                try:
+                    os.remove(self._path(key, suffix))
+                except FileNotFoundError:
+                    pass
+            total -= size
@@ -1,28 +1,69 @@
 #!/usr/bin/env python3
 import os
+import queue
 import sqlite3
 import argparse
+import multiprocessing as mp
 from collections import defaultdict
+from urllib.request import pathname2url
 
+CLEAN_DB_FILE = "data/data_clean.sqlite3"
+ENGINES = ('python', 'sql')
 
-def open_clean_db():
+# the tables of the clean database, in the order they are filled in
+CLEAN_TABLES = ('Issuer', 'Plan', 'Location', 'Language', 'Specialty',
+                'FacilityType', 'Provider', 'Provider_Location',
+                'Provider_Language', 'Provider_Specialty',
+                'Provider_FacilityType', 'Provider_Plan', 'Drug',
+                'Drug_Plan')
+# those filled in for a share of the npis and rxnorm_ids, see
+# clean_partition
+PARTITIONED_TABLES = CLEAN_TABLES[6:]
+
+
+def partition_path(index, fname=CLEAN_DB_FILE):
+    return fname.replace(".sqlite3", ".part{}.sqlite3".format(index))
+
+
+def _read_only(path):
+    # a URI for opening the raw database read-only, so that any number of
+    # processes can read it at once
+    return "file:{}?mode=ro".format(pathname2url(os.path.abspath(path)))
+
+
+def _in_partition(column, partition):
+    """ An SQL condition selecting the rows whose column falls in
+    partition, (index, count), or all rows if partition is None
+    """
+    if partition is None:
+        return "1"
+    index, count = partition
+    return "{} % {} = {}".format(column, count, index)
+
+
+def _print_progress(kind):
+    def progress(i, num):
+        print("\rProcessing {} {}/{}".format(kind, i+1, num), end='')
+    return progress
+
+
+def open_clean_db(fname=CLEAN_DB_FILE):
     if not os.path.exists("data"):
         os.mkdir("data")
-    fname = "data/data_clean.sqlite3"
     if os.path.exists(fname):
         os.remove(fname)
-    conn = sqlite3.connect(fname)
+    conn = sqlite3.connect(fname, uri=True)
     conn.execute("PRAGMA journal_mode=WAL;")
     return conn
 
 
 def open_full_db(path):
-    conn = sqlite3.connect(path)
+    conn = sqlite3.connect(_read_only(path), uri=True)
     return conn
 
 
-def init_clean_db():
-    conn = open_clean_db()
+def init_clean_db(fname=CLEAN_DB_FILE):
+    conn = open_clean_db(fname)
     conn.executescript('''
     CREATE TABLE Issuer (id_issuer INTEGER PRIMARY KEY,
                          name      TEXT    NOT NULL,
@@ -42,14 +83,31 @@ def init_clean_db():
                            type            INTEGER NOT NULL,
                            accepting       INTEGER NOT NULL);
 
-    CREATE TABLE Address (npi             INTEGER NOT NULL,
-                          address         TEXT,
-                          city            TEXT,
-                          state           TEXT,
-                          zip             TEXT,
-                          phone           TEXT,
-                          FOREIGN KEY(npi)
-                              REFERENCES Provider(npi));
+    CREATE TABLE Location (idx_location INTEGER PRIMARY KEY,
+                           address      TEXT,
+                           city         TEXT,
+                           state        TEXT,
+                           zip          TEXT,
+                           phone        TEXT);
+
+    CREATE INDEX Location_zip ON Location (zip);
+
+    CREATE TABLE Provider_Location (npi          INTEGER NOT NULL,
+                                    idx_location INTEGER NOT NULL,
+                                    UNIQUE(npi, idx_location)
+                                        ON CONFLICT IGNORE,
+                                    FOREIGN KEY(npi)
+                                        REFERENCES Provider(npi),
+                                    FOREIGN KEY(idx_location)
+                                        REFERENCES Location(idx_location));
+
+    -- covers per-location, and so per-zip, counts of providers
+    CREATE INDEX Provider_Location_idx_location
+        ON Provider_Location (idx_location, npi);
+
+    CREATE VIEW Address AS
+        SELECT npi, address, city, state, zip, phone
+        FROM Provider_Location JOIN Location USING (idx_location);
 
     CREATE TABLE Language (idx_language INTEGER PRIMARY KEY,
                            language     TEXT    NOT NULL,
@@ -141,6 +199,18 @@ def copy_common_tables(conn_full, conn_state):
                  "VALUES (?,?,?,?,?)")
         conn_state.execute(query, row)
     ##################
+    # Location
+    ##################
+    # those no provider ends up at are deleted by copy_providers, or by
+    # merge_partitions
+    query = ("SELECT idx_location, address, city, state, zip, phone "
+             "FROM Location")
+    for row in conn_full.execute(query).fetchall():
+        conn_state.execute(("INSERT INTO Location "
+                            "(idx_location, address, city, state, zip, "
+                            "phone) "
+                            "VALUES (?,?,?,?,?,?)"), row)
+    ##################
     # Language
     ##################
     query = "SELECT idx_language, language FROM Language"
@@ -167,8 +237,9 @@ def copy_common_tables(conn_full, conn_state):
     conn_state.commit()
 
 
-def copy_providers(conn_full, conn_clean):
-    """ copies the provider data
+def copy_providers(conn_full, conn_clean, partition=None, progress=None):
+    """ copies the provider data, of the npis in partition if given (see
+    _in_partition), calling progress(i, num_npis) as it goes
     """
     def most_recent_set(provs):
         """ Get all providers with most recently updated information
@@ -208,7 +279,8 @@ def copy_providers(conn_full, conn_clean):
 
     def copy_provider_info(npi, provs):
         provs, _ = most_recent_set(provs)
-        orig_ids = ','.join([str(prov[0]) for prov in provs])
+        # details are kept once per distinct payload, see db.init_db
+        orig_ids = ','.join({str(prov[6]) for prov in provs})
         ##################
         # Provider
         ##################
@@ -221,25 +293,25 @@ def copy_providers(conn_full, conn_clean):
         args = (npi, provs[0][1], provs[0][3], provs[0][4])
         conn_clean.execute(query, args)
         ##################
-        # Address
+        # Location
         ##################
-        query = ("SELECT address, city, state, zip, phone "
-                 "FROM Address "
-                 "WHERE idx_provider IN ({})").format(orig_ids)
-        addrs = conn_full.execute(query).fetchall()
-        for addr in set(addrs):
+        query = ("SELECT DISTINCT idx_location "
+                 "FROM Provider_Location "
+                 "WHERE idx_payload IN ({})").format(orig_ids)
+        locations = conn_full.execute(query).fetchall()
+        for location in locations:
             query = ("INSERT "
-                     "INTO Address "
-                     "(npi, address, city, state, zip, phone) "
-                     "VALUES (?,?,?,?,?,?)")
-            args = (npi, *addr)
+                     "INTO Provider_Location "
+                     "(npi, idx_location) "
+                     "VALUES (?,?)")
+            args = (npi, location[0])
             conn_clean.execute(query, args)
         ##################
         # Language
         ##################
         query = ("SELECT DISTINCT idx_language "
                  "FROM Provider_Language "
-                 "WHERE idx_provider IN ({})").format(orig_ids)
+                 "WHERE idx_payload IN ({})").format(orig_ids)
         languages = conn_full.execute(query).fetchall()
         for language in languages:
             query = ("INSERT "
@@ -253,7 +325,7 @@ def copy_providers(conn_full, conn_clean):
         ##################
         query = ("SELECT DISTINCT idx_specialty "
                  "FROM Provider_Specialty "
-                 "WHERE idx_provider IN ({})").format(orig_ids)
+                 "WHERE idx_payload IN ({})").format(orig_ids)
         specialties = conn_full.execute(query).fetchall()
         for specialty in specialties:
             query = ("INSERT "
@@ -267,7 +339,7 @@ def copy_providers(conn_full, conn_clean):
         ##################
         query = ("SELECT DISTINCT idx_facility_type "
                  "FROM Provider_FacilityType "
-                 "WHERE idx_provider IN ({})").format(orig_ids)
+                 "WHERE idx_payload IN ({})").format(orig_ids)
         facility_types = conn_full.execute(query).fetchall()
         for facility_type in facility_types:
             query = ("INSERT "
@@ -282,8 +354,9 @@ def copy_providers(conn_full, conn_clean):
             return
         query = ("SELECT "
                  "idx_provider, name, last_updated_on, "
-                 "type, accepting, idx_issuer_group "
+                 "type, accepting, idx_issuer_group, idx_payload "
                  "FROM Provider "
+                 "INNER JOIN ProviderPayload USING (idx_payload) "
                  "INNER JOIN ProviderURL ON (source_url_id=url_id) "
                  "WHERE npi=?;")
         provs = conn_full.execute(query, (npi,)).fetchall()
@@ -291,18 +364,24 @@ def copy_providers(conn_full, conn_clean):
         copy_provider_info(npi, provs)
         copy_provider_plans(npi, provs)
 
-    query = "SELECT DISTINCT npi FROM Provider;"
+    progress = progress or _print_progress("Provider")
+    query = ("SELECT DISTINCT npi FROM Provider WHERE {};"
+             .format(_in_partition("npi", partition)))
     npis = conn_full.execute(query).fetchall()
     num_npis = len(npis)
     for i, row in enumerate(npis):
-        print("\rProcessing Provider {}/{}".format(i+1, num_npis), end='')
+        progress(i, num_npis)
         copy_provider(npi=row[0])
         if (i % 1000) == 0:
             conn_clean.commit()
+    conn_clean.execute("DELETE FROM Location WHERE idx_location NOT IN "
+                       "(SELECT idx_location FROM Provider_Location);")
     conn_clean.commit()
 
 
-def copy_drugs(conn_full, conn_clean):
+def copy_drugs(conn_full, conn_clean, partition=None, progress=None):
+    """ copies the drug data, as copy_providers does the providers
+    """
     def copy_drug_plans(rxnorm_id, drugs):
         orig_ids = ','.join([str(drug[0]) for drug in drugs])
         query = ("SELECT "
@@ -343,20 +422,299 @@ def copy_drugs(conn_full, conn_clean):
         copy_drug_info(rxnorm_id, drugs)
         copy_drug_plans(rxnorm_id, drugs)
 
-    query = "SELECT DISTINCT rxnorm_id FROM Drug;"
+    progress = progress or _print_progress("Drug")
+    query = ("SELECT DISTINCT rxnorm_id FROM Drug WHERE {};"
+             .format(_in_partition("rxnorm_id", partition)))
     rxnorm_ids = conn_full.execute(query).fetchall()
     num_rxnorm_ids = len(rxnorm_ids)
     for i, row in enumerate(rxnorm_ids):
-        print("\rProcessing Drug {}/{}".format(i+1, num_rxnorm_ids), end='')
+        progress(i, num_rxnorm_ids)
         copy_drug(rxnorm_id=row[0])
         if (i % 1000) == 0:
             conn_clean.commit()
     conn_clean.commit()
 
 
-def main(db_path):
+def copy_common_tables_sql(conn_clean):
+    """ copy_common_tables, from the attached raw database
+    """
+    conn_clean.executescript('''
+    INSERT INTO Issuer (id_issuer, name, state)
+        SELECT id_issuer, name, state FROM raw.Issuer;
+
+    INSERT INTO Plan (idx_plan, id_plan, id_issuer, marketing_name,
+                      summary_url)
+        SELECT idx_plan, id_plan, id_issuer, marketing_name, summary_url
+        FROM raw.Plan;
+
+    INSERT INTO Location (idx_location, address, city, state, zip, phone)
+        SELECT idx_location, address, city, state, zip, phone
+        FROM raw.Location;
+
+    INSERT INTO Language (idx_language, language)
+        SELECT idx_language, language FROM raw.Language;
+
+    INSERT INTO Specialty (idx_specialty, specialty)
+        SELECT idx_specialty, specialty FROM raw.Specialty;
+
+    INSERT INTO FacilityType (idx_facility_type, facility_type)
+        SELECT idx_facility_type, facility_type FROM raw.FacilityType;
+    ''')
+    conn_clean.commit()
+
+
+def copy_providers_sql(conn_clean, partition=None):
+    """ copy_providers, from the attached raw database, for all npis (of
+    partition, if given) at once. Each listing of a provider is ranked
+    among the provider's listings, and those of its issuer group, by how
+    recently it was updated. Ties go to the listing read first, as with
+    copy_providers.
+    """
+    conn_clean.executescript('''
+    CREATE TEMP TABLE Listing AS
+        SELECT idx_provider, npi, idx_payload, last_updated_on,
+               idx_issuer_group,
+               last_updated_on = MAX(last_updated_on)
+                   OVER (PARTITION BY npi) AS recent,
+               last_updated_on = MAX(last_updated_on)
+                   OVER (PARTITION BY npi, idx_issuer_group)
+                   AS recent_in_group,
+               ROW_NUMBER()
+                   OVER (PARTITION BY npi
+                         ORDER BY last_updated_on DESC, idx_provider)
+                   AS rank
+        FROM raw.Provider
+        INNER JOIN raw.ProviderURL ON (source_url_id=url_id)
+        WHERE npi IS NOT NULL AND {};
+
+    -- details are kept once per distinct payload, see db.init_db
+    CREATE TEMP TABLE RecentPayload AS
+        SELECT DISTINCT npi, idx_payload FROM Listing WHERE recent;
+
+    INSERT INTO Provider (npi, name, type, accepting)
+        SELECT npi, name, type, accepting
+        FROM Listing INNER JOIN raw.ProviderPayload USING (idx_payload)
+        WHERE rank = 1;
+
+    INSERT INTO Provider_Location (npi, idx_location)
+        SELECT DISTINCT npi, idx_location
+        FROM RecentPayload
+        INNER JOIN raw.Provider_Location USING (idx_payload);
+
+    INSERT INTO Provider_Language (npi, idx_language)
+        SELECT DISTINCT npi, idx_language
+        FROM RecentPayload
+        INNER JOIN raw.Provider_Language USING (idx_payload);
+
+    INSERT INTO Provider_Specialty (npi, idx_specialty)
+        SELECT DISTINCT npi, idx_specialty
+        FROM RecentPayload
+        INNER JOIN raw.Provider_Specialty USING (idx_payload);
+
+    INSERT INTO Provider_FacilityType (npi, idx_facility_type)
+        SELECT DISTINCT npi, idx_facility_type
+        FROM RecentPayload
+        INNER JOIN raw.Provider_FacilityType USING (idx_payload);
+
+    -- the plans of each issuer group's most recent listings
+    INSERT INTO Provider_Plan (npi, idx_plan, network_tier,
+                               last_updated_on)
+        SELECT npi, idx_plan, network_tier, last_updated_on
+        FROM (SELECT DISTINCT npi, idx_issuer_group, idx_plan,
+                              network_tier, last_updated_on
+              FROM Listing
+              INNER JOIN raw.Provider_Plan USING (idx_provider)
+              WHERE recent_in_group);
+
+    DELETE FROM Location WHERE idx_location NOT IN
+        (SELECT idx_location FROM Provider_Location);
+
+    DROP TABLE Listing;
+    DROP TABLE RecentPayload;
+    '''.format(_in_partition("npi", partition)))
+    conn_clean.commit()
+
+
+def copy_drugs_sql(conn_clean, partition=None):
+    """ copy_drugs, from the attached raw database
+    """
+    conn_clean.executescript('''
+    INSERT INTO Drug (rxnorm_id, drug_name)
+        SELECT rxnorm_id, drug_name
+        FROM (SELECT rxnorm_id, drug_name,
+                     ROW_NUMBER()
+                         OVER (PARTITION BY rxnorm_id ORDER BY idx_drug)
+                         AS rank
+              FROM raw.Drug
+              WHERE {0})
+        WHERE rank = 1;
+
+    INSERT INTO Drug_Plan (rxnorm_id, idx_plan, drug_tier,
+                           prior_authorization, step_therapy,
+                           quantity_limit)
+        SELECT DISTINCT rxnorm_id, idx_plan, drug_tier,
+                        prior_authorization, step_therapy, quantity_limit
+        FROM raw.Drug INNER JOIN raw.Drug_Plan USING (idx_drug)
+        WHERE {0};
+    '''.format(_in_partition("rxnorm_id", partition)))
+    conn_clean.commit()
+
+
+def compare_clean_dbs(path, other_path):
+    """ Returns the tables whose rows differ between two clean databases,
+    regardless of the order they are in
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("ATTACH DATABASE ? AS other", (other_path,))
+    differ = []
+    for table in CLEAN_TABLES:
+        columns = ', '.join(row[1] for row in
+                            conn.execute("PRAGMA table_info({})"
+                                         .format(table)))
+        counts = ("SELECT {0}, COUNT(*) FROM {{0}}.{1} GROUP BY {0}"
+                  .format(columns, table))
+        query = ("SELECT EXISTS ({0} EXCEPT {1}) OR EXISTS ({1} EXCEPT {0})"
+                 .format(counts.format('main'), counts.format('other')))
+        if conn.execute(query).fetchone()[0]:
+            differ.append(table)
+    conn.close()
+    return differ
+
+
+def clean_partition(db_path, engine, partition, fname, messages):
+    """ Fill in fname, a clean database of its own, with the providers and
+    drugs of partition (see _in_partition), putting (index, message)s on
+    messages to report progress, and (index, None) once done
+    """
+    index = partition[0]
+
+    def report(kind):
+        def progress(i, num):
+            if i % 1000 == 0 or i + 1 == num:
+                messages.put((index, "{} {}/{}".format(kind, i+1, num)))
+        return progress
+
+    try:
+        conn_clean = init_clean_db(fname)
+        if engine == 'sql':
+            conn_clean.execute("ATTACH DATABASE ? AS raw",
+                               (_read_only(db_path),))
+            messages.put((index, "Copying providers"))
+            copy_providers_sql(conn_clean, partition)
+            messages.put((index, "Copying drugs"))
+            copy_drugs_sql(conn_clean, partition)
+        else:
+            conn_full = open_full_db(db_path)
+            copy_providers(conn_full, conn_clean, partition,
+                           report("Provider"))
+            copy_drugs(conn_full, conn_clean, partition, report("Drug"))
+            conn_full.close()
+        conn_clean.close()
+        messages.put((index, "Finished!"))
+    finally:
+        messages.put((index, None))
+
+
+def merge_partitions(conn_clean, paths):
+    """ Copy the providers and drugs of the partition databases at paths
+    into the clean database, which holds the common tables, and delete the
+    partitions
+    """
+    for path in paths:
+        conn_clean.execute("ATTACH DATABASE ? AS part", (path,))
+        for table in PARTITIONED_TABLES:
+            conn_clean.execute("INSERT INTO main.{0} SELECT * FROM part.{0}"
+                               .format(table))
+        conn_clean.commit()
+        conn_clean.execute("DETACH DATABASE part")
+    conn_clean.execute("DELETE FROM Location WHERE idx_location NOT IN "
+                       "(SELECT idx_location FROM Provider_Location);")
+    conn_clean.commit()
+    for path in paths:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def main_partitioned(db_path, engine, workers, fname=CLEAN_DB_FILE):
+    """ main, with the npis and rxnorm_ids split by their remainder
+    modulo workers among as many processes. Each writes a database of its
+    own, and these are merged into fname once all are done.
+    """
+    paths = [partition_path(index, fname) for index in range(workers)]
+    messages = mp.Queue()
+    procs = [mp.Process(target=clean_partition,
+                        args=(db_path, engine, (index, workers), path,
+                              messages))
+             for index, path in enumerate(paths)]
+    for proc in procs:
+        proc.start()
+
+    conn_clean = init_clean_db(fname)
+    print("Copying common tables")
+    if engine == 'sql':
+        conn_clean.execute("ATTACH DATABASE ? AS raw",
+                           (_read_only(db_path),))
+        copy_common_tables_sql(conn_clean)
+        conn_clean.execute("DETACH DATABASE raw")
+    else:
+        conn_full = open_full_db(db_path)
+        copy_common_tables(conn_full, conn_clean)
+        conn_full.close()
+    print("Finished!")
+
+    running = workers
+    while running:
+        try:
+            index, message = messages.get(timeout=1)
+        except queue.Empty:
+            if not any(proc.is_alive() for proc in procs):
+                break  # one died without a word
+            continue
+        if message is None:
+            running -= 1
+        else:
+            print("Partition {}: {}".format(index, message))
+    for proc in procs:
+        proc.join()
+    failed = [index for index, proc in enumerate(procs) if proc.exitcode]
+    if failed:
+        conn_clean.close()
+        raise RuntimeError("Partitions {} failed".format(failed))
+
+    print("Merging {} partitions".format(workers))
+    merge_partitions(conn_clean, paths)
+    print("Finished!")
+    conn_clean.close()
+
+
+def main(db_path, engine='python', fname=CLEAN_DB_FILE, workers=1):
+    """ engine is one of ENGINES, "python" going through the providers and
+    drugs one by one, and "sql" copying them with a few set-based queries
+    (needs SQLite 3.25 or later). With more than one worker, the work is
+    split among processes, see main_partitioned.
+    """
+    if workers > 1:
+        return main_partitioned(db_path, engine, workers, fname)
+    conn_clean = init_clean_db(fname)
+    if engine == 'sql':
+        conn_clean.execute("ATTACH DATABASE ? AS raw",
+                           (_read_only(db_path),))
+
+        print("Copying common tables")
+        copy_common_tables_sql(conn_clean)
+        print("Finished!")
+        print("Copying providers")
+        copy_providers_sql(conn_clean)
+        print("Finished!")
+        print("Copying drugs")
+        copy_drugs_sql(conn_clean)
+        print("Finished!")
+
+        conn_clean.close()
+        return
+
     conn_full = open_full_db(db_path)
-    conn_clean = init_clean_db()
 
     print("Copying common tables")
     copy_common_tables(conn_full, conn_clean)
@@ -372,10 +730,53 @@ def main(db_path):
     conn_clean.close()
 
 
+def verify(db_path, engine='python', workers=1):
+    """ Build the clean database with engine, and workers, and again with
+    the other engine in a single process, and check that the two agree
+    """
+    other = ENGINES[1 - ENGINES.index(engine)]
+    other_fname = CLEAN_DB_FILE.replace(".sqlite3",
+                                        "_{}.sqlite3".format(other))
+    main(db_path, engine, workers=workers)
+    print("Building again with the {} engine to verify".format(other))
+    main(db_path, other, other_fname)
+    differ = compare_clean_dbs(CLEAN_DB_FILE, other_fname)
+    if differ:
+        print("The engines disagree on: {} (see {})"
+              .format(', '.join(differ), other_fname))
+        return False
+    os.remove(other_fname)
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(other_fname + suffix):
+            os.remove(other_fname + suffix)
+    print("The engines agree")
+    return True
+
+
 if __name__ == '__main__':
     desc = 'Utility to clean main data-pull data'
     parser = argparse.ArgumentParser(description=desc)
     add = parser.add_argument
     add('full_db', help='path to full-data sqlite file', type=str)
+    add('--engine', default='python', choices=ENGINES,
+        help=("\"sql\" copies providers and drugs with a few set-based "
+              "queries, much faster than going through them one by one "
+              "in python (the default). Needs SQLite 3.25 or later"))
+    add('--verify', action='store_true',
+        help=("Build the clean database with the other engine too, and "
+              "check that both give the same result"))
+    add('--workers', default=1, type=int,
+        help=("Split the providers and drugs among this many processes, "
+              "and merge their work at the end (default 1)"))
     args = parser.parse_args()
-    main(args.full_db)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.engine == 'sql' or args.verify:
+        if sqlite3.sqlite_version_info < (3, 25):
+            parser.error("The sql engine needs SQLite 3.25 or later, "
+                         "found {}".format(sqlite3.sqlite_version))
+    if args.verify:
+        if not verify(args.full_db, args.engine, args.workers):
+            raise SystemExit(1)
+    else:
+        main(args.full_db, args.engine, workers=args.workers)
@@ -1,31 +1,82 @@
 import os
+import time
 import sqlite3
 
 import models
 
 
+DB_FILE = "data/data.sqlite3"
+
+_MB = 1024 * 1024
+# PRAGMAs set for each profile the database can be opened with. "safe"
+# keeps every commit through a crash or power loss. "bulk" is for long
+# ingests of a database that can always be downloaded again: sync is off
+# and checkpoints are left to the caller (see checkpoint), so a power
+# loss may corrupt it, but writes go several times faster.
+PROFILES = {
+    'safe': (('journal_mode', 'WAL'),
+             ('synchronous', 'FULL'),
+             ('journal_size_limit', 64 * _MB)),
+    'bulk': (('journal_mode', 'WAL'),
+             ('synchronous', 'OFF'),
+             ('journal_size_limit', 64 * _MB),
+             ('wal_autocheckpoint', 0),
+             ('cache_size', -256 * 1024),  # KB, so 256MB
+             ('mmap_size', 1024 * _MB),
+             ('temp_store', 'MEMORY'),
+             # the references between tables are checked by the clean-up
+             ('foreign_keys', 'OFF')),
+}
+
+
+def shard_path(shard):
+    return "data/data_shard{}.sqlite3".format(shard)
+
+
 def get_last_idx(conn):
     return conn.execute("SELECT last_insert_rowid();").fetchone()[0]
 
 
-def open_db(recreate=True):
+def open_db(recreate=True, fname=DB_FILE, profile='safe'):
     if not os.path.exists("data"):
         os.mkdir("data")
-    fname = "data/data.sqlite3"
     if recreate and os.path.exists(fname):
         os.remove(fname)
     conn = sqlite3.connect(fname)
-    conn.execute("PRAGMA journal_mode=WAL;")
+    for pragma, value in PROFILES[profile]:
+        conn.execute("PRAGMA {}={};".format(pragma, value))
     return conn
 
 
-def init_db():
+def checkpoint(conn, mode='TRUNCATE'):
+    """
+    Copy the WAL back into the database, and with the default mode,
+    truncate it. Waits for readers as long as the connection's busy
+    timeout allows. Returns (busy, frames in the WAL, frames copied) as
+    PRAGMA wal_checkpoint does, busy being 1 if it couldn't finish. Once
+    truncated, the WAL has no frames left to report.
+    """
+    query = "PRAGMA wal_checkpoint({});".format(mode)
+    return tuple(conn.execute(query).fetchone())
+
+
+def init_db(fname=DB_FILE, profile='safe'):
     """ init_db
     Creates the initial database. *THIS IS NOT THE FINAL SCHEMA*. After the
     download finishes. The cleanup stage will modify some of the table
     restraints.
+
+    The same provider is often listed, identically, by several issuers
+    and URLs. What is listed (name, type, accepting, addresses,
+    languages, specialties and facility types) is stored once per
+    distinct payload, identified by its hash (see wire.encode_provider),
+    and each Provider row records just one listing of it: the npi, when
+    it was updated, where it came from and, in Provider_Plan, its plans.
+    Likewise, each distinct (normalized) address is stored once, as a
+    Location, that payloads link to. The Address view lists them as they
+    used to be.
     """
-    conn = open_db()
+    conn = open_db(fname=fname, profile=profile)
     conn.executescript('''
     CREATE TABLE IssuerGroup (idx_issuer_group INTEGER PRIMARY KEY,
                               index_url        TEXT    NOT NULL,
@@ -43,6 +94,7 @@ def init_db():
                               url              TEXT    NOT NULL,
                               idx_issuer_group INTEGER NOT NULL,
                               download_status  TEXT    NOT NULL,
+                              stalls           INTEGER NOT NULL DEFAULT 0,
                               FOREIGN KEY(idx_issuer_group)
                                   REFERENCES IssuerGroup(id_issuer_group),
                               UNIQUE(url, idx_issuer_group)
@@ -52,6 +104,7 @@ def init_db():
                           url              TEXT    NOT NULL,
                           idx_issuer_group INTEGER NOT NULL,
                           download_status  TEXT    NOT NULL,
+                          stalls           INTEGER NOT NULL DEFAULT 0,
                           FOREIGN KEY(idx_issuer_group)
                               REFERENCES IssuerGroup(id_issuer_group),
                           UNIQUE(url, idx_issuer_group) ON CONFLICT FAIL);
@@ -60,11 +113,12 @@ def init_db():
                           url              TEXT    NOT NULL,
                           idx_issuer_group INTEGER NOT NULL,
                           download_status  TEXT    NOT NULL,
+                          stalls           INTEGER NOT NULL DEFAULT 0,
                           FOREIGN KEY(idx_issuer_group)
                               REFERENCES IssuerGroup(id_issuer_group),
                           UNIQUE(url, idx_issuer_group) ON CONFLICT FAIL);
 
-    CREATE TABLE Plan (idx_plan       INTEGER PRIMARY KEY AUTOINCREMENT,
+    CREATE TABLE Plan (idx_plan       INTEGER PRIMARY KEY,
                        id_plan        TEXT    NOT NULL,
                        id_issuer      INTEGER NOT NULL,
                        plan_id_type   TEXT    NOT NULL,
@@ -74,24 +128,41 @@ def init_db():
                        FOREIGN KEY(source_url_id)
                            REFERENCES PlanURL(url_id));
 
-    CREATE TABLE Provider (idx_provider    INTEGER PRIMARY KEY AUTOINCREMENT,
+    CREATE TABLE ProviderPayload (idx_payload INTEGER PRIMARY KEY,
+                                  hash        BLOB,
+                                  name        TEXT    NOT NULL,
+                                  type        INTEGER NOT NULL,
+                                  accepting   INTEGER NOT NULL);
+
+    CREATE TABLE Provider (idx_provider    INTEGER PRIMARY KEY,
                            npi             INTEGER,
-                           name            TEXT    NOT NULL,
+                           idx_payload     INTEGER NOT NULL,
                            last_updated_on INTEGER NOT NULL,
-                           type            INTEGER NOT NULL,
-                           accepting       INTEGER NOT NULL,
                            source_url_id      INTEGER,
+                           FOREIGN KEY(idx_payload)
+                               REFERENCES ProviderPayload(idx_payload),
                            FOREIGN KEY(source_url_id)
                                REFERENCES ProviderURL(url_id));
 
-    CREATE TABLE Address (idx_provider INTEGER NOT NULL,
-                          address      TEXT,
-                          city         TEXT,
-                          state        TEXT,
-                          zip          TEXT,
-                          phone        TEXT,
-                          FOREIGN KEY(idx_provider)
-                              REFERENCES Provider(idx_provider));
+    CREATE TABLE Location (idx_location INTEGER PRIMARY KEY,
+                           address      TEXT,
+                           city         TEXT,
+                           state        TEXT,
+                           zip          TEXT,
+                           phone        TEXT,
+                           hash         BLOB);
+
+    CREATE TABLE Provider_Location (idx_payload  INTEGER NOT NULL,
+                                    idx_location INTEGER NOT NULL,
+                                    FOREIGN KEY(idx_payload)
+                                        REFERENCES
+                                        ProviderPayload(idx_payload),
+                                    FOREIGN KEY(idx_location)
+                                        REFERENCES Location(idx_location));
+
+    CREATE VIEW Address AS
+        SELECT idx_payload, address, city, state, zip, phone
+        FROM Provider_Location JOIN Location USING (idx_location);
 
     CREATE TABLE Language (idx_language INTEGER PRIMARY KEY AUTOINCREMENT,
                            language     TEXT    NOT NULL,
@@ -106,21 +177,21 @@ def init_db():
                                facility_type     TEXT    NOT NULL,
                                UNIQUE(facility_type) ON CONFLICT FAIL);
 
-    CREATE TABLE Provider_Language (idx_provider INTEGER NOT NULL,
+    CREATE TABLE Provider_Language (idx_payload  INTEGER NOT NULL,
                                     idx_language INTEGER NOT NULL);
 
-    CREATE TABLE Provider_Specialty (idx_provider  INTEGER NOT NULL,
+    CREATE TABLE Provider_Specialty (idx_payload   INTEGER NOT NULL,
                                      idx_specialty INTEGER NOT NULL);
 
 
-    CREATE TABLE Provider_FacilityType (idx_provider      INTEGER NOT NULL,
+    CREATE TABLE Provider_FacilityType (idx_payload       INTEGER NOT NULL,
                                         idx_facility_type INTEGER NOT NULL);
 
     CREATE TABLE Provider_Plan (idx_provider INTEGER NOT NULL,
                                 idx_plan     INTEGER NOT NULL,
                                 network_tier TEXT    NOT NULL);
 
-    CREATE TABLE Drug (idx_drug  INTEGER PRIMARY KEY AUTOINCREMENT,
+    CREATE TABLE Drug (idx_drug  INTEGER PRIMARY KEY,
                        rxnorm_id INTEGER NOT NULL,
                        drug_name TEXT    NOT NULL,
                        source_url_id      INTEGER,
@@ -133,6 +204,9 @@ def init_db():
                             prior_authorization INTEGER,
                             step_therapy        INTEGER,
                             quantity_limit      INTEGER);
+
+    CREATE UNIQUE INDEX ProviderPayload_hash ON ProviderPayload (hash);
+    CREATE UNIQUE INDEX Location_hash ON Location (hash);
     ''')
     return conn
 
@@ -140,8 +214,12 @@ def init_db():
 def create_indices(conn):
     """
     Create a series of indices that will make the "clean-up"
-    Stage run much *much* faster.
+    Stage run much *much* faster. The indices of payload and location
+    hashes are only needed while they are still being added, so are
+    dropped.
     """
+    conn.execute("DROP INDEX IF EXISTS ProviderPayload_hash;")
+    conn.execute("DROP INDEX IF EXISTS Location_hash;")
     conn.execute(("CREATE INDEX Provider_Plan_idx_provider "
                   "ON Provider_Plan (idx_provider)"))
     conn.execute(("CREATE INDEX Drug_Plan_idx_drug "
@@ -150,14 +228,191 @@ def create_indices(conn):
                   "ON Drug (rxnorm_id)"))
     conn.execute(("CREATE INDEX Provider_npi "
                   "ON Provider (npi)"))
-    conn.execute(("CREATE INDEX Address_idx_provider "
-                  "ON Address (idx_provider)"))
-    conn.execute(("CREATE INDEX Provider_Language_idx_provider "
-                  "ON Provider_Language (idx_provider)"))
-    conn.execute(("CREATE INDEX Provider_Specialty_idx_provider "
-                  "ON Provider_Specialty (idx_provider)"))
-    conn.execute(("CREATE INDEX Provider_FacilityType_idx_provider "
-                  "ON Provider_FacilityType (idx_provider)"))
+    conn.execute(("CREATE INDEX Provider_Location_idx_payload "
+                  "ON Provider_Location (idx_payload)"))
+    conn.execute(("CREATE INDEX Provider_Language_idx_payload "
+                  "ON Provider_Language (idx_payload)"))
+    conn.execute(("CREATE INDEX Provider_Specialty_idx_payload "
+                  "ON Provider_Specialty (idx_payload)"))
+    conn.execute(("CREATE INDEX Provider_FacilityType_idx_payload "
+                  "ON Provider_FacilityType (idx_payload)"))
+
+
+def _max_idx(conn, table, key):
+    query = "SELECT COALESCE(MAX({}), 0) FROM main.{};".format(key, table)
+    return conn.execute(query).fetchone()[0]
+
+
+# (table, primary key, name) of each vocabulary table, along with the
+# provider table linking to it
+_VOCABULARIES = (('Language', 'idx_language', 'language',
+                  'Provider_Language'),
+                 ('Specialty', 'idx_specialty', 'specialty',
+                  'Provider_Specialty'),
+                 ('FacilityType', 'idx_facility_type', 'facility_type',
+                  'Provider_FacilityType'))
+
+
+def _merge_hashed(conn, table, key, columns, map_):
+    """
+    Copy the rows of table in the shard whose hash isn't in the main
+    database yet, or that have no hash, numbered on from those there.
+    temp.<map_> maps the key of each row in the shard to that of its copy,
+    or of the row with the same hash. Returns the offset added to the keys
+    of the rows copied.
+    """
+    offset = _max_idx(conn, table, key)
+    conn.execute(("CREATE TEMP TABLE {} (old INTEGER PRIMARY KEY, "
+                  "new INTEGER NOT NULL);").format(map_))
+    conn.execute(("INSERT INTO temp.{3} "
+                  "SELECT s.{1}, COALESCE(m.{1}, s.{1} + ?) "
+                  "FROM shard.{0} AS s "
+                  "LEFT JOIN main.{0} AS m ON m.hash = s.hash;"
+                  ).format(table, key, columns, map_), (offset,))
+    conn.execute(("INSERT INTO main.{0} ({1}, hash, {2}) "
+                  "SELECT {1} + ?, hash, {2} "
+                  "FROM shard.{0} AS s "
+                  "WHERE s.hash IS NULL OR NOT EXISTS "
+                  "(SELECT 1 FROM main.{0} AS m WHERE m.hash = s.hash);"
+                  ).format(table, key, columns), (offset,))
+    return offset
+
+
+def _merge_shard(conn):
+    """
+    Copy the database attached as "shard" into the main one.
+    """
+    conn.execute("INSERT INTO main.IssuerGroup "
+                 "SELECT * FROM shard.IssuerGroup;")
+    conn.execute("INSERT OR IGNORE INTO main.Issuer "
+                 "SELECT * FROM shard.Issuer;")
+    url_offsets = {}
+    for table in ("ProviderURL", "PlanURL", "DrugURL"):
+        offset = url_offsets[table] = _max_idx(conn, table, "url_id")
+        conn.execute(("INSERT INTO main.{0} "
+                      "(url_id, url, idx_issuer_group, download_status, "
+                      "stalls) "
+                      "SELECT url_id + ?, url, idx_issuer_group, "
+                      "download_status, stalls FROM shard.{0};"
+                      ).format(table), (offset,))
+
+    for table, key, name, _ in _VOCABULARIES:
+        conn.execute(("INSERT OR IGNORE INTO main.{0} ({2}) "
+                      "SELECT {2} FROM shard.{0} ORDER BY {1};"
+                      ).format(table, key, name))
+
+    # Plans may be listed in more than one shard. The first copy is kept,
+    # unless it is a "VOID" placeholder, made by a Consumer for a plan of
+    # an issuer group held by another shard, and this shard has the plan
+    # itself, which then takes the placeholder's place
+    offset = _max_idx(conn, "Plan", "idx_plan")
+    conn.execute("UPDATE main.Plan SET "
+                 "(plan_id_type, marketing_name, summary_url, "
+                 "source_url_id) = "
+                 "(SELECT plan_id_type, marketing_name, summary_url, "
+                 "source_url_id + ? FROM shard.Plan AS p WHERE "
+                 "p.id_issuer = Plan.id_issuer AND p.id_plan = Plan.id_plan "
+                 "AND p.plan_id_type <> 'VOID') "
+                 "WHERE plan_id_type = 'VOID' AND EXISTS "
+                 "(SELECT 1 FROM shard.Plan AS p WHERE "
+                 "p.id_issuer = Plan.id_issuer AND p.id_plan = Plan.id_plan "
+                 "AND p.plan_id_type <> 'VOID');",
+                 (url_offsets["PlanURL"],))
+    conn.execute("INSERT INTO main.Plan "
+                 "(idx_plan, id_plan, id_issuer, plan_id_type, "
+                 "marketing_name, summary_url, source_url_id) "
+                 "SELECT idx_plan + ?, id_plan, id_issuer, plan_id_type, "
+                 "marketing_name, summary_url, source_url_id + ? "
+                 "FROM shard.Plan AS p WHERE NOT EXISTS "
+                 "(SELECT 1 FROM main.Plan AS m WHERE "
+                 "m.id_issuer = p.id_issuer AND m.id_plan = p.id_plan);",
+                 (offset, url_offsets["PlanURL"]))
+    conn.execute("CREATE TEMP TABLE PlanMap (old INTEGER PRIMARY KEY, "
+                 "new INTEGER NOT NULL);")
+    conn.execute("INSERT INTO temp.PlanMap "
+                 "SELECT p.idx_plan, m.idx_plan "
+                 "FROM shard.Plan AS p JOIN main.Plan AS m "
+                 "ON m.id_issuer = p.id_issuer AND m.id_plan = p.id_plan;")
+
+    # Payloads and locations already in an earlier shard are shared with
+    # it, the rest are copied, payloads along with their details
+    _merge_hashed(conn, "Location", "idx_location",
+                  "address, city, state, zip, phone", "LocationMap")
+    offset = _merge_hashed(conn, "ProviderPayload", "idx_payload",
+                           "name, type, accepting", "PayloadMap")
+    new = ("(SELECT old FROM temp.PayloadMap WHERE new = old + {})"
+           ).format(int(offset))
+    conn.execute("INSERT INTO main.Provider_Location "
+                 "(idx_payload, idx_location) "
+                 "SELECT idx_payload + ?, lm.new "
+                 "FROM shard.Provider_Location "
+                 "JOIN temp.LocationMap AS lm ON lm.old = idx_location "
+                 "WHERE idx_payload IN {};".format(new), (offset,))
+    for table, key, name, link in _VOCABULARIES:
+        conn.execute(("INSERT INTO main.{3} (idx_payload, {1}) "
+                      "SELECT l.idx_payload + ?, m.{1} "
+                      "FROM shard.{3} AS l "
+                      "JOIN shard.{0} AS s ON s.{1} = l.{1} "
+                      "JOIN main.{0} AS m ON m.{2} = s.{2} "
+                      "WHERE l.idx_payload IN {4};"
+                      ).format(table, key, name, link, new), (offset,))
+
+    offset = _max_idx(conn, "Provider", "idx_provider")
+    conn.execute("INSERT INTO main.Provider "
+                 "(idx_provider, npi, idx_payload, last_updated_on, "
+                 "source_url_id) "
+                 "SELECT idx_provider + ?, npi, pm.new, last_updated_on, "
+                 "source_url_id + ? FROM shard.Provider "
+                 "JOIN temp.PayloadMap AS pm ON pm.old = idx_payload;",
+                 (offset, url_offsets["ProviderURL"]))
+    conn.execute("INSERT INTO main.Provider_Plan "
+                 "(idx_provider, idx_plan, network_tier) "
+                 "SELECT pp.idx_provider + ?, pm.new, pp.network_tier "
+                 "FROM shard.Provider_Plan AS pp "
+                 "JOIN temp.PlanMap AS pm ON pm.old = pp.idx_plan;",
+                 (offset,))
+
+    offset = _max_idx(conn, "Drug", "idx_drug")
+    conn.execute("INSERT INTO main.Drug "
+                 "(idx_drug, rxnorm_id, drug_name, source_url_id) "
+                 "SELECT idx_drug + ?, rxnorm_id, drug_name, "
+                 "source_url_id + ? FROM shard.Drug;",
+                 (offset, url_offsets["DrugURL"]))
+    # Drug_Plan.idx_plan holds plan ids rather than Plan rows, so is kept
+    conn.execute("INSERT INTO main.Drug_Plan "
+                 "(idx_drug, idx_plan, drug_tier, prior_authorization, "
+                 "step_therapy, quantity_limit) "
+                 "SELECT idx_drug + ?, idx_plan, drug_tier, "
+                 "prior_authorization, step_therapy, quantity_limit "
+                 "FROM shard.Drug_Plan;", (offset,))
+    conn.execute("DROP TABLE temp.PlanMap;")
+    conn.execute("DROP TABLE temp.PayloadMap;")
+    conn.execute("DROP TABLE temp.LocationMap;")
+
+
+def merge_shards(paths, fname=DB_FILE, profile='safe'):
+    """
+    Combine the shard databases at paths, written by separate Consumers
+    each holding their own issuer groups, into a new database at fname.
+    ids are renumbered to follow on from those of earlier shards, plans
+    found in more than one shard are merged by (id_issuer, id_plan),
+    a shard's copy of a plan replacing another's "VOID" placeholder,
+    provider payloads and locations by hash, and languages, specialties
+    and facility types by name. Indices are
+    created once everything has been copied.
+    """
+    conn = init_db(fname, profile)
+    conn.execute("CREATE INDEX Plan_id ON Plan (id_issuer, id_plan);")
+    for path in paths:
+        conn.execute("ATTACH DATABASE ? AS shard;", (path,))
+        with conn:
+            _merge_shard(conn)
+        conn.execute("DETACH DATABASE shard;")
+    conn.execute("DROP INDEX Plan_id;")
+    create_indices(conn)
+    conn.commit()
+    checkpoint(conn)
+    return conn
 
 
 def insert_issuer_group(conn, issuer_group):
@@ -184,47 +439,83 @@ def insert_data_url(conn, url):
         type_ = models.URLType.get_name(url.url_type)
         try:
             query = ("INSERT INTO {}URL "
-                     "(url, download_status, idx_issuer_group) "
-                     "VALUES (?, ?, ?);").format(type_)
-            vals = (url.url, url.status, url.idx_issuer_group)
+                     "(url, download_status, idx_issuer_group, stalls) "
+                     "VALUES (?, ?, ?, ?);").format(type_)
+            vals = (url.url, url.status, url.idx_issuer_group, url.stalls)
             conn.execute(query, vals)
             return get_last_idx(conn)
         except sqlite3.IntegrityError:
             query = ("UPDATE {}URL "
-                     "SET download_status=? "
+                     "SET download_status=?, stalls=? "
                      "WHERE url_id=?;").format(type_)
-            vals = (url.status, url.url_id)
+            vals = (url.status, url.stalls, url.url_id)
             conn.execute(query, vals)
             return url.url_id
 
 
-def insert_plan(conn, plan):
-    args = (plan.id_plan, plan.id_issuer, plan.plan_id_type,
-            plan.marketing_name, plan.summary_url, plan.source_url.url_id)
-    conn.execute(("INSERT INTO Plan"
-                  "(id_plan, id_issuer, plan_id_type, "
-                  "marketing_name, summary_url, source_url_id) "
-                  "VALUES (?,?,?,?,?,?)"), args)
-    return get_last_idx(conn)
+def update_provider(conn, values, idx_provider):
+    """
+    values are (npi, name, last_updated_on, type, accepting). The
+    provider's payload must be its own, see BulkWriter.insert_payload_stub.
+    """
+    npi, name, last_updated_on, type_, accepting = values
+    conn.execute(("UPDATE ProviderPayload "
+                  "SET name=?, type=?, accepting=? "
+                  "WHERE idx_payload="
+                  "(SELECT idx_payload FROM Provider WHERE idx_provider=?);"),
+                 (name, type_, accepting, idx_provider))
+    conn.execute(("UPDATE Provider "
+                  "SET npi=?, last_updated_on=? "
+                  "WHERE idx_provider=?;"),
+                 (npi, last_updated_on, idx_provider))
 
 
-def insert_provider(conn, provider):
-    args = (provider.npi, provider.name,
-            provider.last_updated_on.toordinal(),
-            int(provider.type_), int(provider.accepting),
-            provider.source_url.url_id)
-    conn.execute(("INSERT INTO Provider "
-                  "(npi,name,last_updated_on,type,accepting, source_url_id) "
-                  "VALUES (?,?,?,?,?,?);"), args)
-    return get_last_idx(conn)
+_PAYLOAD_TABLES = ("Provider_Location", "Provider_Language",
+                   "Provider_Specialty", "Provider_FacilityType",
+                   "ProviderPayload")
+
+
+def delete_provider(conn, idx_provider):
+    """
+    Delete a provider, along with its payload if that isn't shared (has
+    no hash).
+    """
+    payloads = ("SELECT idx_payload FROM ProviderPayload WHERE hash IS NULL "
+                "AND idx_payload="
+                "(SELECT idx_payload FROM Provider WHERE idx_provider=?)")
+    for table in _PAYLOAD_TABLES:
+        query = "DELETE FROM {} WHERE idx_payload IN ({});"
+        conn.execute(query.format(table, payloads), (idx_provider,))
+    for table in ("Provider_Plan", "Provider"):
+        query = "DELETE FROM {} WHERE idx_provider=?;".format(table)
+        conn.execute(query, (idx_provider,))
+
+
+def delete_url_providers(conn, source_url_id):
+    """
+    Delete every provider read from a URL, along with its plans. Payloads
+    left unused are deleted by delete_unused_payloads.
+    """
+    providers = "SELECT idx_provider FROM Provider WHERE source_url_id=?"
+    conn.execute(("DELETE FROM Provider_Plan WHERE idx_provider IN ({});"
+                  ).format(providers), (source_url_id,))
+    conn.execute("DELETE FROM Provider WHERE source_url_id=?;",
+                 (source_url_id,))
 
 
-def insert_address(conn, address, idx_provider):
-    args = (idx_provider, address.address, address.city,
-            address.state, address.zip_, address.phone)
-    conn.execute(("INSERT INTO Address "
-                  "(idx_provider, address, city, state, zip, phone) "
-                  "VALUES (?,?,?,?,?,?);"), args)
+def delete_unused_payloads(conn):
+    """
+    Delete the payloads no provider refers to any more, their details,
+    and the locations no payload refers to any more.
+    """
+    conn.execute("DELETE FROM ProviderPayload WHERE idx_payload NOT IN "
+                 "(SELECT idx_payload FROM Provider);")
+    for table in _PAYLOAD_TABLES[:-1]:
+        conn.execute(("DELETE FROM {} WHERE idx_payload NOT IN "
+                      "(SELECT idx_payload FROM ProviderPayload);"
+                      ).format(table))
+    conn.execute("DELETE FROM Location WHERE idx_location NOT IN "
+                 "(SELECT idx_location FROM Provider_Location);")
 
 
 def insert_language(conn, language):
@@ -235,13 +526,6 @@ def insert_language(conn, language):
     return get_last_idx(conn)
 
 
-def insert_provider_language(conn, idx_provider, idx_language):
-    args = (idx_provider, idx_language)
-    conn.execute(("INSERT INTO Provider_Language "
-                  "(idx_provider, idx_language) "
-                  "VALUES (?,?);"), args)
-
-
 def insert_facility_type(conn, facility_type):
     args = (facility_type,)
     conn.execute(("INSERT INTO FacilityType "
@@ -250,13 +534,6 @@ def insert_facility_type(conn, facility_type):
     return get_last_idx(conn)
 
 
-def insert_provider_facility_type(conn, idx_provider, idx_facility_type):
-    args = (idx_provider, idx_facility_type)
-    conn.execute(("INSERT INTO Provider_FacilityType "
-                  "(idx_provider, idx_facility_type) "
-                  "VALUES (?,?);"), args)
-
-
 def insert_specialty(conn, specialty):
     args = (specialty,)
     conn.execute(("INSERT INTO Specialty "
@@ -265,34 +542,258 @@ def insert_specialty(conn, specialty):
     return get_last_idx(conn)
 
 
-def insert_provider_specialty(conn, idx_provider, idx_specialty):
-    args = (idx_provider, idx_specialty)
-    conn.execute(("INSERT INTO Provider_Specialty "
-                  "(idx_provider, idx_specialty) "
-                  "VALUES (?,?);"), args)
+def update_drug(conn, rxnorm_id, name, idx_drug):
+    args = (rxnorm_id, name, idx_drug)
+    conn.execute(("UPDATE Drug "
+                  "SET rxnorm_id=?, drug_name=? "
+                  "WHERE idx_drug=?;"), args)
 
 
-def insert_drug(conn, drug):
-    args = (drug.rxnorm_id, drug.name, drug.source_url.url_id)
-    conn.execute(("INSERT INTO Drug "
-                  "(rxnorm_id,drug_name,source_url_id) "
-                  "VALUES (?,?,?);"), args)
-    return get_last_idx(conn)
+def delete_drug(conn, idx_drug):
+    conn.execute("DELETE FROM Drug_Plan WHERE idx_drug=?;", (idx_drug,))
+    conn.execute("DELETE FROM Drug WHERE idx_drug=?;", (idx_drug,))
 
 
-def insert_drug_plan(conn, drug_plan, idx_drug):
-    args = (idx_drug, drug_plan.id_plan, drug_plan.drug_tier,
-            drug_plan.prior_authorization, drug_plan.step_therapy,
-            drug_plan.quantity_limit)
-    conn.execute(("INSERT INTO Drug_Plan "
-                  "(idx_drug,idx_plan,drug_tier,prior_authorization,"
+def delete_url_drugs(conn, source_url_id):
+    """
+    Delete every drug read from a URL, along with its plans.
+    """
+    conn.execute(("DELETE FROM Drug_Plan WHERE idx_drug IN "
+                  "(SELECT idx_drug FROM Drug WHERE source_url_id=?);"),
+                 (source_url_id,))
+    conn.execute("DELETE FROM Drug WHERE source_url_id=?;", (source_url_id,))
+
+
+# The tables written by BulkWriter, in the order they are flushed
+_BULK_INSERTS = {
+    'Plan': ("INSERT INTO Plan "
+             "(idx_plan, id_plan, id_issuer, plan_id_type, "
+             "marketing_name, summary_url, source_url_id) "
+             "VALUES (?,?,?,?,?,?,?);"),
+    'ProviderPayload': ("INSERT INTO ProviderPayload "
+                        "(idx_payload, hash, name, type, accepting) "
+                        "VALUES (?,?,?,?,?);"),
+    'Provider': ("INSERT INTO Provider "
+                 "(idx_provider, npi, idx_payload, last_updated_on, "
+                 "source_url_id) "
+                 "VALUES (?,?,?,?,?);"),
+    'Location': ("INSERT INTO Location "
+                 "(idx_location, address, city, state, zip, phone, hash) "
+                 "VALUES (?,?,?,?,?,?,?);"),
+    'Provider_Location': ("INSERT INTO Provider_Location "
+                          "(idx_payload, idx_location) "
+                          "VALUES (?,?);"),
+    'Provider_Language': ("INSERT INTO Provider_Language "
+                          "(idx_payload, idx_language) "
+                          "VALUES (?,?);"),
+    'Provider_Specialty': ("INSERT INTO Provider_Specialty "
+                           "(idx_payload, idx_specialty) "
+                           "VALUES (?,?);"),
+    'Provider_FacilityType': ("INSERT INTO Provider_FacilityType "
+                              "(idx_payload, idx_facility_type) "
+                              "VALUES (?,?);"),
+    'Provider_Plan': ("INSERT INTO Provider_Plan "
+                      "(idx_provider, idx_plan, network_tier) "
+                      "VALUES (?,?,?);"),
+    'Drug': ("INSERT INTO Drug "
+             "(idx_drug, rxnorm_id, drug_name, source_url_id) "
+             "VALUES (?,?,?,?);"),
+    'Drug_Plan': ("INSERT INTO Drug_Plan "
+                  "(idx_drug, idx_plan, drug_tier, prior_authorization, "
                   "step_therapy, quantity_limit) "
-                  "VALUES (?,?,?,?,?,?);"), args)
-
-
-def insert_provider_plan(conn, prov_plan, idx_plan, idx_provider):
-    args = (idx_provider, idx_plan,
-            prov_plan.network_tier)
-    conn.execute(("INSERT INTO Provider_Plan"
-                  "(idx_provider,idx_plan,network_tier) "
-                  "VALUES (?,?,?);"), args)
+                  "VALUES (?,?,?,?,?,?);"),
+}
+# The primary key of each table whose rows are numbered by BulkWriter
+_BULK_KEYS = {'Plan': 'idx_plan', 'ProviderPayload': 'idx_payload',
+              'Provider': 'idx_provider', 'Location': 'idx_location',
+              'Drug': 'idx_drug'}
+# The tables whose rows BulkWriter looks up by hash, and the query for it
+_BULK_HASHED = {table: "SELECT {} FROM {} WHERE hash=?;".format(
+                    _BULK_KEYS[table], table)
+                for table in ('ProviderPayload', 'Location')}
+
+
+class BulkWriter:
+    """
+    Buffers the rows of plans, providers and drugs, and of the tables
+    that hang off them, and writes each table's rows with one executemany.
+    Their primary keys are handed out here rather than by SQLite, so that
+    the rows referring to them can be buffered too. Rows are written once
+    flush_size of them are waiting, or by tick once flush_interval seconds
+    have passed since the last write. flush before reading, updating or
+    deleting rows of these tables. If a batch fails, its rows are written
+    one at a time and on_error is called with each error. Up to
+    cache_size hashes of payloads and locations are remembered, so that
+    most lookups needn't query the database.
+    """
+    flush_size = 10000  # rows
+    flush_interval = 5  # seconds
+    cache_size = 200000  # hashes per table
+
+    def __init__(self, conn, on_error=None):
+        self.conn = conn
+        self.on_error = on_error
+        self.rows = {table: [] for table in _BULK_INSERTS}
+        self.buffered = 0
+        self.flushed = time.monotonic()
+        # maps the hashes of rows recently added to their keys, by table
+        self.hashed = {table: {} for table in _BULK_HASHED}
+        self.next_idx = {}
+        for table, key in _BULK_KEYS.items():
+            query = "SELECT COALESCE(MAX({}), 0) FROM {};".format(key, table)
+            self.next_idx[table] = conn.execute(query).fetchone()[0] + 1
+
+    def _new_idx(self, table):
+        idx = self.next_idx[table]
+        self.next_idx[table] = idx + 1
+        return idx
+
+    def _add(self, table, row):
+        self.rows[table].append(row)
+        self.buffered += 1
+        if self.buffered >= self.flush_size:
+            self.flush()
+
+    def tick(self):
+        if (self.buffered and
+                time.monotonic() - self.flushed >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        conn = self.conn
+        self.flushed = time.monotonic()
+        if not self.buffered:
+            return
+        if not conn.in_transaction:
+            conn.execute("BEGIN;")  # committed by the caller as before
+        for table, rows in self.rows.items():
+            if not rows:
+                continue
+            query = _BULK_INSERTS[table]
+            conn.execute("SAVEPOINT bulk;")
+            try:
+                conn.executemany(query, rows)
+            except sqlite3.Error:
+                conn.execute("ROLLBACK TO bulk;")
+                for row in rows:
+                    try:
+                        conn.execute(query, row)
+                    except sqlite3.Error as e:
+                        if self.on_error is not None:
+                            self.on_error("{} row {}: {}".format(table, row,
+                                                                e))
+            conn.execute("RELEASE bulk;")
+            self.rows[table] = []
+        self.buffered = 0
+
+    def insert_plan(self, values):
+        """
+        values are those of a Plan row after idx_plan, as are those of the
+        other tables given to the methods below after their own key.
+        """
+        idx_plan = self._new_idx('Plan')
+        self._add('Plan', (idx_plan,) + values)
+        return idx_plan
+
+    def _find(self, table, hash_):
+        hashed = self.hashed[table]
+        idx = hashed.get(hash_)
+        if idx is None:
+            row = self.conn.execute(_BULK_HASHED[table], (hash_,)).fetchone()
+            if row:
+                idx = self._remember(table, hash_, row[0])
+        return idx
+
+    def _remember(self, table, hash_, idx):
+        hashed = self.hashed[table]
+        if len(hashed) >= self.cache_size:
+            # rows still buffered must be found in the database instead
+            self.flush()
+            hashed.clear()
+        hashed[hash_] = idx
+        return idx
+
+    def find_payload(self, hash_):
+        """
+        The idx_payload of the provider payload with hash_, or None if
+        there is none yet.
+        """
+        return self._find('ProviderPayload', hash_)
+
+    def insert_payload(self, hash_, values):
+        """
+        values are (name, type, accepting). Details are added to the new
+        payload with the insert_provider_* methods below.
+        """
+        idx_payload = self._new_idx('ProviderPayload')
+        self._add('ProviderPayload', (idx_payload, hash_) + values)
+        return self._remember('ProviderPayload', hash_, idx_payload)
+
+    def insert_payload_stub(self):
+        """
+        Insert a placeholder payload for a provider that is streamed in
+        pieces, of its own, without a hash. It is filled in by
+        update_provider once the final piece has arrived.
+        """
+        idx_payload = self._new_idx('ProviderPayload')
+        self._add('ProviderPayload', (idx_payload, None, "", -1, -1))
+        return idx_payload
+
+    def insert_provider(self, values):
+        idx_provider = self._new_idx('Provider')
+        self._add('Provider', (idx_provider,) + values)
+        return idx_provider
+
+    def insert_provider_stub(self, idx_payload, source_url_id):
+        """
+        Insert a placeholder Provider row for a provider that is streamed
+        in pieces. The row is filled in by update_provider once the final
+        piece, which carries all of the provider's scalar fields, has
+        arrived.
+        """
+        idx_provider = self._new_idx('Provider')
+        self._add('Provider', (idx_provider, None, idx_payload, 0,
+                               source_url_id))
+        return idx_provider
+
+    def insert_address(self, idx_payload, address):
+        """
+        Link the payload to the Location of address, a normalized
+        (address, city, state, zip, phone, hash), adding it if it is new.
+        """
+        hash_ = address[-1]
+        idx_location = self._find('Location', hash_)
+        if idx_location is None:
+            idx_location = self._new_idx('Location')
+            self._add('Location', (idx_location,) + address)
+            self._remember('Location', hash_, idx_location)
+        self._add('Provider_Location', (idx_payload, idx_location))
+
+    def insert_provider_language(self, idx_payload, idx_language):
+        self._add('Provider_Language', (idx_payload, idx_language))
+
+    def insert_provider_specialty(self, idx_payload, idx_specialty):
+        self._add('Provider_Specialty', (idx_payload, idx_specialty))
+
+    def insert_provider_facility_type(self, idx_payload, idx_facility_type):
+        self._add('Provider_FacilityType', (idx_payload, idx_facility_type))
+
+    def insert_provider_plan(self, idx_provider, idx_plan, network_tier):
+        self._add('Provider_Plan', (idx_provider, idx_plan, network_tier))
+
+    def insert_drug(self, values):
+        idx_drug = self._new_idx('Drug')
+        self._add('Drug', (idx_drug,) + values)
+        return idx_drug
+
+    def insert_drug_stub(self, source_url_id):
+        """
+        Insert a placeholder Drug row for a drug that is streamed in pieces,
+        see insert_provider_stub.
+        """
+        idx_drug = self._new_idx('Drug')
+        self._add('Drug', (idx_drug, 0, "", source_url_id))
+        return idx_drug
+
+    def insert_drug_plan(self, idx_drug, drug_plan):
+        self._add('Drug_Plan', (idx_drug,) + drug_plan)
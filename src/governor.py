@@ -0,0 +1,154 @@
+"""
+Paces requests to each host, so that many download processes together
+get as much out of a host as it will give without being throttled or
+blocked by it.
+"""
+import time
+import threading
+from multiprocessing.managers import BaseManager
+
+_MIN_RATE = 0.05  # requests per second a throttled host is slowed down to
+_MAX_BACKOFF = 60  # seconds paused after repeated connection errors
+_SLOW = 4  # a response this many times slower than usual is congestion,
+_SLOW_FLOOR = 1  # if it also took more than this many seconds
+
+
+class _Host:
+    def __init__(self, limit, rate, burst):
+        self.limit = limit  # requests allowed to await their response
+        self.rate = rate  # requests allowed to start per second
+        self.tokens = burst
+        self.refilled = time.monotonic()
+        self.active = 0
+        self.paused_until = 0
+        self.errors = 0  # connection errors since the last success
+        self.latency = None  # moving average of the time to headers
+
+
+class HostGovernor:
+    """
+    Decides when a request to each host may start. Every host has a cap
+    on the requests awaiting their response headers and a token bucket
+    limiting how fast they start. A response's body doesn't count against
+    the cap, however long it takes to read, so a few huge downloads don't
+    hold up every other request to their host. Both back off
+    multiplicatively when the host throttles us, resets connections or
+    answers far slower than usual, and recover additively as requests
+    succeed (AIMD). A Retry-After from the host,
+    or a run of connection errors, pauses it entirely for a while. To
+    share one between processes, create it with GovernorManager.
+    """
+    def __init__(self, max_streams=4, rate=2.0, burst=4):
+        self.max_streams = max_streams
+        self.max_rate = rate
+        self.burst = burst
+        self.hosts = {}
+        self.cond = threading.Condition()
+
+    def _host(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = _Host(self.max_streams, self.max_rate,
+                                     self.burst)
+        return self.hosts[host]
+
+    def _wait_time(self, h, now):
+        h.tokens = min(self.burst, h.tokens + (now - h.refilled)*h.rate)
+        h.refilled = now
+        if h.paused_until > now:
+            return h.paused_until - now
+        if h.active >= int(h.limit):
+            return 1  # or until a release wakes us
+        if h.tokens < 1:
+            return (1 - h.tokens) / h.rate
+        return 0
+
+    def acquire(self, host, blocking=True):
+        """
+        Wait until a request to host may start, and return True. If not
+        blocking, return False at once if it may not start yet. Every
+        successful acquire must be paired with a release.
+        """
+        with self.cond:
+            h = self._host(host)
+            while True:
+                wait = self._wait_time(h, time.monotonic())
+                if wait <= 0:
+                    break
+                if not blocking:
+                    return False
+                self.cond.wait(wait)
+            h.active += 1
+            h.tokens -= 1
+            return True
+
+    def _back_off(self, h):
+        h.limit = max(1, h.limit / 2)
+        h.rate = max(_MIN_RATE, h.rate / 2)
+
+    def release(self, host, outcome="ok", latency=None, retry_after=None):
+        """
+        Report how a request to host went once its response headers
+        arrived, or it failed: "ok", "throttled" (429/503) or "error" (the
+        connection failed). latency is the time it took to get the headers.
+        """
+        with self.cond:
+            h = self._host(host)
+            h.active -= 1
+            self._record(h, outcome, latency, retry_after)
+            self.cond.notify_all()
+
+    def report(self, host, outcome="ok"):
+        """
+        Report how reading the body of a released request went. Only an
+        "error" counts, its headers having counted as a success already.
+        """
+        if outcome != "error":
+            return
+        with self.cond:
+            self._record(self._host(host), outcome)
+            self.cond.notify_all()
+
+    def _record(self, h, outcome, latency=None, retry_after=None):
+        now = time.monotonic()
+        if outcome == "throttled":
+            self._back_off(h)
+            pause = retry_after if retry_after is not None else 1/h.rate
+            h.paused_until = max(h.paused_until, now + pause)
+        elif outcome == "error":
+            self._back_off(h)
+            h.errors += 1
+            pause = min(_MAX_BACKOFF, 2**(h.errors - 1))
+            h.paused_until = max(h.paused_until, now + pause)
+        elif (latency is not None and h.latency is not None and
+              latency > max(_SLOW*h.latency, _SLOW_FLOOR)):
+            self._back_off(h)
+        else:
+            h.errors = 0
+            h.limit = min(self.max_streams, h.limit + 1/h.limit)
+            h.rate = min(self.max_rate, h.rate + self.max_rate/10)
+        if latency is not None:
+            if h.latency is None:
+                h.latency = latency
+            else:
+                h.latency = 0.8*h.latency + 0.2*latency
+
+    def stats(self):
+        """
+        Maps each host to its current (limit, rate, active requests).
+        """
+        with self.cond:
+            return {host: (h.limit, h.rate, h.active)
+                    for host, h in self.hosts.items()}
+
+
+class GovernorManager(BaseManager):
+    """
+    Serves a HostGovernor from its own process, e.g.
+        manager = GovernorManager()
+        manager.start()
+        governor = manager.HostGovernor(max_streams=4)
+    The governor proxy can then be handed to pool worker processes.
+    """
+
+
+GovernorManager.register('HostGovernor', HostGovernor)
@@ -0,0 +1,389 @@
+"""
+A small pool of keep-alive HTTP(S) connections, so that the many data URLs
+an issuer group lists on one host share TCP and TLS handshakes and a single
+DNS lookup instead of paying for them on every download.
+"""
+import ssl
+import time
+import socket
+import functools
+import threading
+import collections
+import http.client
+import email.utils
+import urllib.error as error
+import urllib.parse as parse
+
+try:  # HTTP/2 needs httpx installed with its h2 extra
+    import httpx
+except ImportError:
+    httpx = None
+
+_MAX_REDIRECTS = 10
+_MAX_IDLE = 4  # idle connections kept per host
+_IDLE_TIMEOUT = 30  # seconds, servers commonly drop idle ones after this
+_DNS_TTL = 300  # seconds
+_DRAIN_SIZE = 64 * 1024  # read off bodies up to this big to reuse the conn
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+_THROTTLE_STATUSES = (429, 503)
+# errors seen when the server has already closed an idle connection
+_STALE_ERRORS = (ConnectionError, http.client.BadStatusLine)
+# errors that suggest the host is overloaded or refusing us
+_CONNECTION_ERRORS = (OSError, http.client.HTTPException)
+
+
+class HostBusy(Exception):
+    """
+    Raised by a request that mustn't wait when the governor won't let it
+    start right away.
+    """
+
+
+class Throttled(error.HTTPError):
+    """
+    The server asked us to slow down (429 or 503). retry_after is the
+    number of seconds it asked us to wait, or None.
+    """
+    def __init__(self, url, code, msg, hdrs, retry_after):
+        super().__init__(url, code, msg, hdrs, None)
+        self.retry_after = retry_after
+
+
+def _retry_after(headers):
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+        return max(0, when.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class PooledResponse:
+    """
+    A response body being read from a pooled connection. Closing it hands
+    the connection back to the pool if the body was read to the end and the
+    server allows reuse, and otherwise closes the connection.
+    """
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.on_close = None  # called with how the transfer went
+        self.outcome = "ok"
+
+    def info(self):
+        return self.headers
+
+    def read(self, size=-1):
+        try:
+            if size is None or size < 0:
+                return self.response.read()
+            return self.response.read(size)
+        except _CONNECTION_ERRORS:
+            self.outcome = "error"
+            raise
+
+    def discard(self):
+        """
+        Close a response whose body isn't wanted, reading it off first if
+        it is small enough to be worth keeping the connection for.
+        """
+        length = self.response.length
+        if length is not None and length <= _DRAIN_SIZE:
+            self.response.read()
+        self.close()
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.on_close is not None:
+            self.on_close(self.outcome)
+        conn, self.conn = self.conn, None
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool._release(self.key, conn)
+        else:
+            self.response.close()
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _HTTPXResponse:
+    """
+    Adapts a streamed httpx response to the read(size) interface. Bytes are
+    passed on still content-encoded, as with http.client.
+    """
+    def __init__(self, response):
+        self.response = response
+        self.url = str(response.url)
+        self.status = response.status_code
+        self.reason = response.reason_phrase
+        self.headers = response.headers
+        self.chunks = response.iter_raw()
+        self.data = b''
+        self.on_close = None
+        self.outcome = "ok"
+
+    def info(self):
+        return self.headers
+
+    def read(self, size=-1):
+        try:
+            return self._read(size)
+        except Exception:
+            self.outcome = "error"
+            raise
+
+    def _read(self, size):
+        while size is None or size < 0 or len(self.data) < size:
+            chunk = next(self.chunks, b'')
+            if not chunk:
+                break
+            self.data += chunk
+        if size is None or size < 0:
+            size = len(self.data)
+        b, self.data = self.data[:size], self.data[size:]
+        return b
+
+    def discard(self):
+        self.close()
+
+    def close(self):
+        if self.on_close is not None:
+            on_close, self.on_close = self.on_close, None
+            on_close(self.outcome)
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ConnectionPool:
+    """
+    Keeps connections to each (scheme, host, port) open between requests
+    and caches host name lookups. opened and reused count the connections
+    made and the requests that went over an already open one. With http2
+    set and httpx available, requests are made through an HTTP/2 client
+    instead, which multiplexes them over one connection per host where the
+    server supports it (and falls back to HTTP/1.1 where it doesn't).
+    Given a governor.HostGovernor, each request waits for its go-ahead
+    and reports back how it went once its response headers arrive, and
+    again if reading the body fails. 429 and 503
+    responses raise Throttled.
+    """
+    def __init__(self, timeout=20, max_idle=_MAX_IDLE, http2=False,
+                 governor=None):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle = collections.defaultdict(collections.deque)
+        self.addresses = {}  # maps (host, port) to (address, expiry)
+        self.lock = threading.Lock()
+        self.context = ssl.create_default_context()
+        self.opened = 0
+        self.reused = 0
+        self.requests = 0
+        self.governor = governor
+        self.client = None
+        if http2 and httpx is not None:
+            self.client = httpx.Client(http2=True, timeout=timeout)
+
+    def stats(self):
+        return {'requests': self.requests, 'opened': self.opened,
+                'reused': self.reused}
+
+    def _resolve(self, host, port):
+        now = time.monotonic()
+        with self.lock:
+            address, expiry = self.addresses.get((host, port), (None, 0))
+        if expiry > now:
+            return address
+        info = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        address = info[0][4][:2]
+        with self.lock:
+            self.addresses[(host, port)] = (address, now + _DNS_TTL)
+        return address
+
+    def _connect(self, key, timeout):
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout,
+                                               context=self.context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        address = self._resolve(host, port)
+
+        # Connect to the cached address. The host name is still used for
+        # the Host header and for SNI and certificate checks.
+        def create_connection(_, timeout, source_address):
+            try:
+                return socket.create_connection(address, timeout,
+                                                source_address)
+            except OSError:
+                with self.lock:
+                    self.addresses.pop((host, port), None)
+                raise
+        conn._create_connection = create_connection
+        self.opened += 1
+        return conn
+
+    def _acquire(self, key, timeout):
+        """
+        Returns an idle connection to key if there is one, else None.
+        """
+        now = time.monotonic()
+        with self.lock:
+            idle = self.idle[key]
+            while idle:
+                conn, since = idle.pop()
+                if conn.sock is not None and now - since < _IDLE_TIMEOUT:
+                    conn.timeout = timeout
+                    conn.sock.settimeout(timeout)
+                    return conn
+                conn.close()
+        return None
+
+    def _release(self, key, conn):
+        with self.lock:
+            idle = self.idle[key]
+            if len(idle) < self.max_idle:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def _request(self, method, url, headers, timeout):
+        parts = parse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ('http', 'https'):
+            raise ValueError("Can't pool \"{}\" URLs".format(scheme))
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        self.requests += 1
+        conn = self._acquire(key, timeout)
+        if conn is not None:
+            try:
+                conn.request(method, target, headers=headers)
+                response = conn.getresponse()
+                self.reused += 1
+                return PooledResponse(self, key, conn, response, url)
+            except _STALE_ERRORS:  # the server closed it, try a new one
+                conn.close()
+        conn = self._connect(key, timeout)
+        try:
+            conn.request(method, target, headers=headers)
+            response = conn.getresponse()
+        except Exception:
+            conn.close()
+            raise
+        return PooledResponse(self, key, conn, response, url)
+
+    def _request_http2(self, method, url, headers, timeout):
+        self.requests += 1
+        request = self.client.build_request(method, url, headers=headers,
+                                            timeout=timeout)
+        response = self.client.send(request, stream=True,
+                                    follow_redirects=True)
+        return _HTTPXResponse(response)
+
+    def get(self, url, headers=None, timeout=None):
+        """
+        GET url, following redirects, and return the response for its body
+        to be read. Raises urllib's HTTPError for error statuses, like
+        request.urlopen.
+        """
+        return self.request('GET', url, headers, timeout)
+
+    def head(self, url, headers=None, timeout=None):
+        """
+        Like get, but makes a HEAD request.
+        """
+        return self.request('HEAD', url, headers, timeout)
+
+    def request(self, method, url, headers=None, timeout=None, blocking=True):
+        """
+        Make a request, following redirects. Unless blocking, raises
+        HostBusy rather than wait for the governor.
+        """
+        headers = dict(headers or {})
+        timeout = self.timeout if timeout is None else timeout
+        host = parse.urlsplit(url).netloc
+        governor = self.governor
+        if governor is not None and not governor.acquire(host, blocking):
+            raise HostBusy(host)
+        start = time.monotonic()
+        try:
+            if self.client is not None:
+                response = self._request_http2(method, url, headers, timeout)
+            else:
+                response = self._follow(method, url, headers, timeout)
+            status = response.status
+            if status >= 400:
+                response.discard()
+                if status in _THROTTLE_STATUSES:
+                    raise Throttled(url, status, response.reason,
+                                    response.headers,
+                                    _retry_after(response.headers))
+                raise error.HTTPError(url, status, response.reason,
+                                      response.headers, None)
+        except Throttled as e:
+            if governor is not None:
+                governor.release(host, "throttled", retry_after=e.retry_after)
+            raise
+        except error.HTTPError:
+            if governor is not None:
+                governor.release(host)
+            raise
+        except Exception:
+            if governor is not None:
+                governor.release(host, "error")
+            raise
+        if governor is not None:
+            # The headers are in, so the next request may start while the
+            # body is read. Should reading it fail, the host hears of it.
+            governor.release(host, latency=time.monotonic() - start)
+            response.on_close = functools.partial(governor.report, host)
+        return response
+
+    def _follow(self, method, url, headers, timeout):
+        for _ in range(_MAX_REDIRECTS + 1):
+            response = self._request(method, url, headers, timeout)
+            status = response.status
+            if status not in _REDIRECT_STATUSES:
+                return response
+            location = response.headers.get('Location')
+            response.discard()
+            if not location:
+                raise error.HTTPError(url, status, "Redirect without "
+                                      "Location", response.headers, None)
+            url = parse.urljoin(url, location)
+        raise error.HTTPError(url, status, "Too many redirects",
+                              response.headers, None)
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn, _ in idle:
+                    conn.close()
+            self.idle.clear()
+        if self.client is not None:
+            self.client.close()
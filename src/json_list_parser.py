@@ -1,22 +1,223 @@
 import io
 import os
+import re
+import bz2
 import json
+import lzma
+import zlib
+import mmap
+import time
+import bisect
+import zipfile
+import asyncio
+import collections
+import multiprocessing as mp
 from datetime import datetime
+import http.client
+import email.parser
+import urllib.error as error
 import urllib.request as request
 import urllib.parse as parse
 
 _DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_WHITESPACE_BYTES = re.compile(rb'[ \t\n\r]*')
 
-_DEFAULT_CHUNK_SIZE = 4096
 _MB = (1024 * 1024)
+_DEFAULT_CHUNK_SIZE = 64 * 1024
+_MAX_CHUNK_SIZE = 4 * _MB
+_COMPACT_SIZE = 1 * _MB  # don't bother moving memory for less than this
 _LARGEST_JSON_OBJECT_ACCEPTED = 16 * _MB  # default to 16 megabytes
 _DEFAULT_TIMEOUT = 20  # seconds
+_MAX_REDIRECTS = 10
+_REQUEST_HEADERS = {'Accept-Encoding': 'gzip, deflate'}
+_DEFAULT_PIECE_SIZE = 1000  # array elements per piece of a streamed object
+_DEFAULT_SPLIT_SIZE = 64 * _MB  # bytes per task of split_json_list_parser
+_HEDGE_PROBE_SIZE = 64 * 1024  # bytes read to judge a hedged request
+_MAX_HEDGES = 2  # hedged requests tried per stream before giving up on it
+_CONTENT_RANGE = re.compile(r'bytes ([0-9]+)-[0-9]+/([0-9]+|\*)')
 
 _VERBOSE = False
 
+# Parser states while walking the top-level list(s) of a file
+_SEEK = 0   # looking for the opening bracket of a list
+_FIRST = 1  # just after '[', expecting an object or ']'
+_ITEM = 2   # just after ',', expecting an object
+_SEP = 3    # just after an object, expecting ',' or ']'
+
+_NEED_DATA = object()  # yielded by the parser when the buffer runs dry
+
+# Where a new list item may start: a '{' that follows "}," (the '{' is the
+# last character of the match). Can also match inside nested arrays.
+_ITEM_START = re.compile(rb'\}[ \t\n\r]*,[ \t\n\r]*\{')
+_LIST_START = re.compile(rb'\[[ \t\n\r]*')
+# What follows the last item of a file's only list
+_LIST_END = re.compile(rb'[ \t\n\r]*\][ \t\n\r\]}]*\Z')
+
+
+def _gzip():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def _deflate():
+    # "deflate" is meant to be zlib-wrapped, but some servers send raw
+    # deflate data. Accept either.
+    return _AutoDeflate()
+
+
+class _AutoDeflate:
+    def __init__(self):
+        self.dec = None
+
+    def decompress(self, data, max_length=0):
+        if self.dec is None:
+            zlib_wrapped = (len(data) >= 2 and (data[0] & 0x0F) == 8 and
+                            ((data[0] << 8) | data[1]) % 31 == 0)
+            wbits = zlib.MAX_WBITS if zlib_wrapped else -zlib.MAX_WBITS
+            self.dec = zlib.decompressobj(wbits)
+        return self.dec.decompress(data, max_length)
+
+    def flush(self):
+        return self.dec.flush() if self.dec is not None else b''
+
+    @property
+    def eof(self):
+        return self.dec is not None and self.dec.eof
+
+    @property
+    def unused_data(self):
+        return self.dec.unused_data
+
+    @property
+    def unconsumed_tail(self):
+        return self.dec.unconsumed_tail if self.dec is not None else b''
+
+
+# maps Content-Encoding values to decompressor factories
+_CONTENT_ENCODINGS = {'gzip':    _gzip,
+                      'x-gzip':  _gzip,
+                      'deflate': _deflate,
+                      'bzip2':   bz2.BZ2Decompressor,
+                      'xz':      lzma.LZMADecompressor}
+# maps file suffixes to decompressor factories
+_FILE_SUFFIXES = {'.gz':  _gzip,
+                  '.bz2': bz2.BZ2Decompressor,
+                  '.xz':  lzma.LZMADecompressor}
+
+
+class _CountingReader:
+    """
+    Wraps a raw file or response object and counts the bytes read from it.
+    """
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        b = self.raw.read(size)
+        self.bytes_read += len(b)
+        return b
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class _DecompressingReader:
+    """
+    Incrementally decompresses a stream. Each read returns at most size
+    bytes of output, and concatenated members (as produced by e.g. pigz or
+    pbzip2) are decompressed one after the other.
+    """
+    def __init__(self, raw, make_decompressor):
+        self.raw = raw
+        self.make_decompressor = make_decompressor
+        self.dec = make_decompressor()
+        self.data = b''
+
+    def read(self, size):
+        while True:
+            if self.dec.eof:
+                self.data = self.dec.unused_data or self.raw.read(size)
+                if not self.data:
+                    return b''
+                self.dec = self.make_decompressor()
+            # zlib keeps unprocessed input in unconsumed_tail, while bz2 &
+            # lzma buffer it internally and say when they need more.
+            if not self.data and getattr(self.dec, 'needs_input', True):
+                self.data = self.raw.read(size)
+                if not self.data:
+                    flush = getattr(self.dec, 'flush', bytes)
+                    out = flush()
+                    if out:
+                        return out
+                    raise EOFError("Compressed stream is truncated")
+            out = self.dec.decompress(self.data, size)
+            self.data = getattr(self.dec, 'unconsumed_tail', b'')
+            if out:
+                return out
+
+    def close(self):
+        self.raw.close()
+
+
+class _Stream:
+    """
+    A readable source of JSON bytes. bytes_read counts the bytes pulled from
+    the file or socket while bytes_decoded counts the bytes handed to the
+    parser after any decompression. validator identifies the version of the
+    file being read, and ranged says whether offsets into the decompressed
+    bytes can be requested directly when resuming.
+    """
+    validator = None
+    ranged = False
+
+    def __init__(self, raw, file_size, make_decompressor=None, reader=None):
+        self.raw = _CountingReader(raw)
+        self.file_size = file_size
+        if reader is not None:
+            self.reader = reader(self.raw)
+        elif make_decompressor is not None:
+            self.reader = _DecompressingReader(self.raw, make_decompressor)
+        else:
+            self.reader = self.raw
+        self.bytes_decoded = 0
+
+    @property
+    def bytes_read(self):
+        return self.raw.bytes_read
+
+    def read(self, size):
+        b = self.reader.read(size)
+        self.bytes_decoded += len(b)
+        return b
+
+    def close(self):
+        self.reader.close()
+        self.raw.close()
+
+
+class Progress(tuple):
+    """
+    The (bytes_read, file_size) pair yielded with each parsed object. Both
+    count bytes as stored or transferred, so may be compressed sizes.
+    bytes_decoded holds the number of uncompressed bytes parsed so far.
+    """
+    def __new__(cls, bytes_read, file_size, bytes_decoded):
+        self = super().__new__(cls, (bytes_read, file_size))
+        self.bytes_decoded = bytes_decoded
+        return self
+
+    @property
+    def bytes_read(self):
+        return self[0]
+
+    @property
+    def file_size(self):
+        return self[1]
+
 
 def _get_file_size(stream):
-    if type(stream) == io.TextIOWrapper:
+    if isinstance(stream, io.BufferedReader):
         file_size = os.stat(stream.name).st_size
     else:
         file_size = stream.info().get('Content-Length')
@@ -27,12 +228,337 @@ def _get_file_size(stream):
     return file_size
 
 
-def _open_stream(url, timeout):
+def _file_validator(raw):
+    st = os.fstat(raw.fileno())
+    return "{}-{}".format(st.st_mtime_ns, st.st_size)
+
+
+def _http_validator(headers):
+    """
+    A validator that names this version of a response whatever encoding
+    it is sent with: a strong ETag of an unencoded response, or else the
+    Last-Modified date.
+    """
+    etag = headers.get('ETag')
+    encoding = headers.get('Content-Encoding', 'identity').strip().lower()
+    if etag and not etag.startswith('W/') and encoding == 'identity':
+        return etag
+    return headers.get('Last-Modified')
+
+
+def _suffix_decompressor(path):
+    return _FILE_SUFFIXES.get(os.path.splitext(path)[1].lower())
+
+
+def _open_zip_member(member):
+    """
+    Returns a reader for the named member of a zip archive, or for its
+    first member if no name is given.
+    """
+    def open_member(raw):
+        zf = zipfile.ZipFile(raw)
+        return zf.open(member or zf.namelist()[0])
+    return open_member
+
+
+def _open_stream(url, timeout, pool=None, cache=None, spool=None):
+    """
+    Open url for reading. Local files ending in .gz, .bz2 or .xz are
+    decompressed on the fly, and members of local .zip files can be read by
+    naming them in the url fragment, e.g. file:/data/provs.zip#provs.json.
+    Remote servers are asked for a gzip or deflate encoded response, over a
+    connection from pool (an http_pool.ConnectionPool) if one is given,
+    through cache (a cache.ResponseCache) if one is given, and spooled to
+    disk by spool (a spool.Spool) if one is given.
+    """
+    parse_result = parse.urlparse(url)
+    path = parse_result.path
+    if parse_result.scheme == "file":
+        raw = open(path, 'rb')
+        file_size = _get_file_size(raw)
+        if path.lower().endswith('.zip'):
+            reader = _open_zip_member(parse.unquote(parse_result.fragment))
+            stream = _Stream(raw, file_size, reader=reader)
+        else:
+            stream = _Stream(raw, file_size, _suffix_decompressor(path))
+            stream.ranged = _suffix_decompressor(path) is None
+        stream.validator = _file_validator(raw)
+        return stream
+    else:
+        raw = http_get(url, timeout, pool, _REQUEST_HEADERS, cache, spool)
+        try:
+            make_decompressor = _response_decompressor(raw.headers, path)
+        except ValueError:
+            raw.close()
+            raise
+        stream = _Stream(raw, _get_file_size(raw), make_decompressor)
+        stream.validator = _http_validator(raw.headers)
+        stream.ranged = (stream.validator is not None and
+                         _suffix_decompressor(path) is None)
+        return stream
+
+
+def http_get(url, timeout=_DEFAULT_TIMEOUT, pool=None, headers=None,
+             cache=None, spool=None):
+    """
+    GET url, over a connection from pool if one is given, and through
+    cache (a cache.ResponseCache) if one is given. Bodies that are
+    downloaded are spooled to disk by spool (a spool.Spool) if given.
+    """
+    def fetch(headers):
+        if pool is not None:
+            raw = pool.get(url, headers, timeout)
+        else:
+            raw = request.urlopen(request.Request(url, headers=headers),
+                                  timeout=timeout)
+        if spool is not None:
+            return spool.wrap(url, raw)
+        return raw
+    headers = headers or {}
+    if cache is not None:
+        return cache.get(url, headers, fetch)
+    return fetch(headers)
+
+
+def content_length(url, timeout=_DEFAULT_TIMEOUT, pool=None):
+    """
+    The size in bytes of the file at url, found with a HEAD request for
+    remote files, or -1 if the server won't say.
+    """
     parse_result = parse.urlparse(url)
     if parse_result.scheme == "file":
-        return open(parse_result.path, 'r')
+        return os.stat(parse_result.path).st_size
+    if pool is not None:
+        raw = pool.head(url, _REQUEST_HEADERS, timeout)
     else:
-        return request.urlopen(url, timeout=timeout)
+        req = request.Request(url, headers=_REQUEST_HEADERS, method='HEAD')
+        raw = request.urlopen(req, timeout=timeout)
+    try:
+        raw.read()  # no body, but lets a pooled connection be reused
+        return _get_file_size(raw)
+    finally:
+        raw.close()
+
+
+class ContentChanged(Exception):
+    """
+    Raised on resuming a download when the file turns out to have changed
+    since it was first opened, so the items already read can't be trusted.
+    """
+
+
+class Resume:
+    """
+    Records how far json_list_parser got through a file, so that a later
+    call given the same Resume carries on from there instead of yielding
+    the same items again. count is the number of whole items yielded and
+    offset the position just past the last of them in the decompressed
+    input.
+    """
+    def __init__(self):
+        self.count = 0
+        self.offset = 0
+        self.validator = None
+        self.ranged = False
+
+
+def _range_headers(offset, validator):
+    # Offsets count decompressed bytes, which are those of the file as sent
+    # without any Content-Encoding.
+    return {'Accept-Encoding': 'identity',
+            'Range': 'bytes={}-'.format(offset),
+            'If-Range': validator}
+
+
+def _range_size(raw, offset):
+    """
+    The file size given by a 206 response to a request made with
+    _range_headers, after checking that it holds the range asked for.
+    """
+    match = _CONTENT_RANGE.match(raw.headers.get('Content-Range', ''))
+    encoding = raw.headers.get('Content-Encoding', 'identity')
+    if (not match or int(match.group(1)) != offset or
+            encoding.strip().lower() != 'identity'):
+        raw.close()
+        raise ValueError("Unusable response to a Range request")
+    return -1 if match.group(2) == '*' else int(match.group(2))
+
+
+def _range_stream(raw, offset, validator):
+    """
+    Wrap a 206 response to a request made with _range_headers.
+    """
+    stream = _Stream(raw, _range_size(raw, offset))
+    stream.raw.bytes_read = offset
+    stream.bytes_decoded = offset
+    stream.validator = validator
+    stream.ranged = True
+    return stream
+
+
+def _resume_stream(url, timeout, pool, cache, spool, resume):
+    """
+    Reopen url at resume.offset, by seeking or with a Range request. Returns
+    the stream and the offset it starts at, which is 0 if the file had to
+    be opened from the start instead. Raises ContentChanged if the file is
+    no longer the one read before.
+    """
+    def reopen():
+        stream = _open_stream(url, timeout, pool, cache, spool)
+        if stream.validator != resume.validator:
+            stream.close()
+            raise ContentChanged(url)
+        return stream, 0
+
+    parse_result = parse.urlparse(url)
+    if not resume.ranged:
+        return reopen()
+    if parse_result.scheme == "file":
+        raw = open(parse_result.path, 'rb')
+        if _file_validator(raw) != resume.validator:
+            raw.close()
+            raise ContentChanged(url)
+        raw.seek(resume.offset)
+        stream = _Stream(raw, _get_file_size(raw))
+        stream.raw.bytes_read = resume.offset
+        stream.bytes_decoded = resume.offset
+        stream.validator = resume.validator
+        stream.ranged = True
+        return stream, resume.offset
+    else:
+        headers = _range_headers(resume.offset, resume.validator)
+        raw = http_get(url, timeout, pool, headers, cache, spool)
+        if getattr(raw, 'status', 200) != 206:
+            # The server ignored the range, or If-Range found a new version
+            if resume.validator not in (raw.headers.get('ETag'),
+                                        raw.headers.get('Last-Modified')):
+                raw.close()
+                raise ContentChanged(url)
+            try:
+                make_decompressor = _response_decompressor(
+                    raw.headers, parse_result.path)
+            except ValueError:
+                raw.close()
+                raise
+            stream = _Stream(raw, _get_file_size(raw), make_decompressor)
+            stream.validator = resume.validator
+            stream.ranged = True
+            return stream, 0
+        stream = _range_stream(raw, resume.offset, resume.validator)
+        return stream, resume.offset
+
+
+class StreamStalled(Exception):
+    """
+    Raised when a stream has delivered data too slowly for too long, and
+    no faster request for the rest of it could be made.
+    """
+
+
+class ThroughputMonitor:
+    """
+    Judges whether streams deliver data fast enough. A stream's rate is
+    measured over windows of `window` seconds, and a window below the floor
+    is a stall. The floor is `fraction` of the baseline, a moving average
+    of the windows of every stream watched so far, but never less than
+    min_rate bytes per second. events counts the stalls seen.
+    """
+    def __init__(self, window=30, fraction=0.05, min_rate=1024):
+        self.window = window
+        self.fraction = fraction
+        self.min_rate = min_rate
+        self.baseline = None
+        self.events = 0
+
+    def floor(self):
+        if self.baseline is None:
+            return self.min_rate
+        return max(self.min_rate, self.fraction*self.baseline)
+
+    def watch(self, total=0):
+        return _Watch(self, total)
+
+    def _record(self, rate):
+        if self.baseline is None:
+            self.baseline = rate
+        else:
+            self.baseline = 0.8*self.baseline + 0.2*rate
+
+
+class _Watch:
+    """
+    Measures one stream for a ThroughputMonitor.
+    """
+    def __init__(self, monitor, total):
+        self.monitor = monitor
+        self.hedges = 0
+        self.reset(total)
+
+    def reset(self, total):
+        self.since = time.monotonic()
+        self.total = total
+
+    def update(self, total):
+        """
+        Given the bytes read so far, returns the rate over the last window
+        if it was a stall, or None.
+        """
+        now = time.monotonic()
+        if now - self.since < self.monitor.window:
+            return None
+        rate = (total - self.total) / (now - self.since)
+        self.reset(total)
+        if rate < self.monitor.floor():
+            self.monitor.events += 1
+            return rate
+        self.monitor._record(rate)
+        return None
+
+
+def _hedge(url, timeout, pool, stream, rate):
+    """
+    Race a second request for the rest of a slow stream against it. Returns
+    the new stream and the first bytes read from it if it delivers them
+    faster than rate, or else (None, b''). The hedge is only made if the
+    host's governor has room for another request right away.
+    """
+    offset = stream.bytes_decoded
+    headers = _range_headers(offset, stream.validator)
+    start = time.monotonic()
+    try:
+        if pool is not None:
+            raw = pool.request('GET', url, headers, timeout, blocking=False)
+        else:
+            raw = http_get(url, timeout, headers=headers)
+        if getattr(raw, 'status', 200) != 206:
+            raw.close()
+            return None, b''
+        hedge = _range_stream(raw, offset, stream.validator)
+    except Exception:
+        return None, b''
+    try:
+        first = hedge.read(_HEDGE_PROBE_SIZE)
+    except Exception:
+        hedge.close()
+        return None, b''
+    if not first or len(first) / (time.monotonic() - start) <= rate:
+        hedge.close()
+        return None, b''
+    return hedge, first
+
+
+def _response_decompressor(headers, path):
+    """
+    Pick the decompressor for a response from its Content-Encoding, or
+    failing that, from the suffix of the path it was requested from.
+    """
+    encoding = headers.get('Content-Encoding', '').strip().lower()
+    if not encoding or encoding == 'identity':
+        return _suffix_decompressor(path)
+    if encoding not in _CONTENT_ENCODINGS:
+        msg = "Unsupported Content-Encoding: \"{}\""
+        raise ValueError(msg.format(encoding))
+    return _CONTENT_ENCODINGS[encoding]
 
 
 def download_formatter():
@@ -67,77 +593,940 @@ def download_formatter():
     return f
 
 
+class _Buffer:
+    """
+    Byte buffer with a read offset. Consumed bytes are left in place and
+    only dropped from the front once they make up most of the buffer, so
+    each input byte is copied a bounded number of times.
+    """
+    def __init__(self, base=0):
+        self.data = bytearray()
+        self.base = base  # stream offset of data[0]
+        self.pos = 0      # offset of the first unconsumed byte
+        self.want = 0     # how many unconsumed bytes the parser would like
+        self.eof = False
+        # stream offsets of the start and end of the last complete object
+        self.last_start = None
+        self.last_end = None
+
+    def unconsumed(self):
+        return len(self.data) - self.pos
+
+    def feed(self, b):
+        if not b:
+            self.eof = True
+            return
+        if self.pos >= _COMPACT_SIZE and 2*self.pos >= len(self.data):
+            del self.data[:self.pos]
+            self.base += self.pos
+            self.pos = 0
+        self.data += b
+
+    def text(self, end):
+        return self.data[self.pos:end].decode('utf8')
+
+    def consume(self, text, i, end):
+        """
+        Advance past the first i characters of text, where text was
+        obtained from self.text(end).
+        """
+        if text.isascii():
+            self.pos += i
+        else:
+            self.pos = end - len(text[i:].encode('utf8'))
+
+
+def _boundary(buf, start):
+    """
+    Return the offset just past the last '}' or ']' in the buffer at or
+    after start, or -1 if there is none. Complete list items can only end
+    at one of these, so there is no point in decoding past it.
+    """
+    end = max(buf.data.rfind(b'}', start), buf.data.rfind(b']', start))
+    return end + 1 if end != -1 else -1
+
+
+class ObjectPiece(dict):
+    """
+    Part of a JSON object that was too large to be decoded in one go. Holds
+    every scalar member seen so far plus a slice of one of the object's
+    arrays. piece is (index, last), where last is True for the final piece,
+    which is the only one guaranteed to hold every scalar member.
+    """
+    def __init__(self, members, index, last):
+        super().__init__(members)
+        self.piece = (index, last)
+
+
+def _peek(buf):
+    """
+    Skip whitespace and return the next character without consuming it.
+    """
+    while True:
+        buf.pos = _WHITESPACE_BYTES.match(buf.data, buf.pos).end()
+        if buf.pos < len(buf.data):
+            return chr(buf.data[buf.pos])
+        if buf.eof:
+            raise ValueError("Unexpected end of JSON input")
+        buf.want = 1
+        yield _NEED_DATA
+
+
+def _expect(buf, chars):
+    c = yield from _peek(buf)
+    if c not in chars:
+        msg = "Badly formatted JSON object, expected one of \"{}\""
+        raise ValueError(msg.format(chars))
+    buf.pos += 1
+    return c
+
+
+def _decode_value(buf, max_size):
+    """
+    Decode and consume one complete JSON value. Decoding is attempted on a
+    window at the front of the buffer that doubles on each failure, so
+    small values stay cheap when the buffer holds a lot of data.
+    """
+    window = _DEFAULT_CHUNK_SIZE
+    yield from _peek(buf)
+    while True:
+        end = min(len(buf.data), buf.pos + window)
+        while end < len(buf.data) and (buf.data[end] & 0xC0) == 0x80:
+            end -= 1  # don't split a multi-byte character
+        text = buf.text(end)
+        try:
+            x, i = _DECODER.raw_decode(text)
+            if i < len(text) or (buf.eof and end == len(buf.data)):
+                buf.consume(text, i, end)
+                return x
+        except ValueError:
+            pass
+        available = buf.unconsumed()
+        if end < len(buf.data):
+            window *= 2
+        elif buf.eof:
+            raise ValueError("Unexpected end of JSON input")
+        elif available >= max_size:
+            msg = "either bad input or too-large JSON object."
+            raise ValueError(msg)
+        else:
+            window = 2*available
+            buf.want = window
+            yield _NEED_DATA
+
+
+def _stream_object(buf, max_size):
+    """
+    Incrementally walk the JSON object at the front of buf, yielding ijson
+    style (prefix, event, value) tuples. Members of the object produce
+    (key, 'value', value) while arrays are never materialized as a whole;
+    each of their elements produces (key, 'item', element) instead.
+    """
+    yield from _expect(buf, '{')
+    c = yield from _peek(buf)
+    if c == '}':
+        buf.pos += 1
+        return
+    while True:
+        key = yield from _decode_value(buf, max_size)
+        yield from _expect(buf, ':')
+        c = yield from _peek(buf)
+        if c == '[':
+            buf.pos += 1
+            c = yield from _peek(buf)
+            if c == ']':
+                buf.pos += 1
+            else:
+                while c != ']':
+                    item = yield from _decode_value(buf, max_size)
+                    yield key, 'item', item
+                    c = yield from _expect(buf, ',]')
+        else:
+            value = yield from _decode_value(buf, max_size)
+            yield key, 'value', value
+        c = yield from _expect(buf, ',}')
+        if c == '}':
+            return
+
+
+def _stream_pieces(buf, max_size, piece_size):
+    """
+    Split the oversized object at the front of buf into ObjectPieces of at
+    most piece_size array elements each.
+    """
+    members = {}
+    key, items = None, []
+    index = 0
+    for event in _stream_object(buf, max_size):
+        if event is _NEED_DATA:
+            yield event
+            continue
+        prefix, kind, value = event
+        if kind == 'value':
+            members[prefix] = value
+            continue
+        if items and (prefix != key or len(items) >= piece_size):
+            yield ObjectPiece(dict(members, **{key: items}), index, False)
+            index += 1
+            items = []
+        key = prefix
+        items.append(value)
+    if items:
+        members[key] = items
+    buf.last_end = buf.base + buf.pos
+    yield ObjectPiece(members, index, True)
+
+
+class _ListEnd(ValueError):
+    """
+    Raised by _parse_list at the closing bracket of a list, when told that
+    the file holds a single list.
+    """
+
+
+def _parse_list(buf, max_size, piece_size=_DEFAULT_PIECE_SIZE, state=_SEEK,
+                single=False):
+    """
+    Generator that yields each JSON object from the list(s) held in buf.
+    Whenever more input is required, _NEED_DATA is yielded and the caller
+    is expected to feed buf before resuming. The stream offsets of each
+    object are left in buf.last_start and buf.last_end while it is yielded.
+    Parsing normally starts before the opening bracket of the list, but
+    can start in the middle of one by passing the state to start in.
+
+    An object that fails to decode is only retried once a new closing
+    bracket has arrived *and* the buffer has doubled in size, which keeps
+    the total decoding work linear in the size of the input. Objects that
+    grow beyond max_size are streamed as ObjectPieces instead, provided
+    piece_size is set. If single, the end of a list raises _ListEnd.
+    """
+    scanned = buf.base  # stream offset up to which boundaries were searched
+    end = buf.base      # stream offset just past the last boundary found
+    need = 0     # minimum unconsumed size before retrying a decode
+    while True:
+        if buf.eof:
+            end = buf.base + len(buf.data)
+        else:
+            found = _boundary(buf, max(scanned - buf.base, buf.pos))
+            scanned = buf.base + len(buf.data)
+            if found != -1:
+                end = buf.base + found
+            available = end - buf.base - buf.pos
+            if available <= 0 or available < min(need, max_size):
+                buf.want = need
+                yield _NEED_DATA
+                continue
+
+        text = buf.text(end - buf.base)
+        i, n = 0, len(text)
+        start = buf.base + buf.pos
+        ascii = text.isascii()
+        ci, bi = 0, 0  # char and byte offsets of the last object's end
+        while True:
+            i = _WHITESPACE.match(text, i).end()
+            if i == n:
+                break
+            if state == _SEEK:
+                j = text.find('[', i)
+                if j == -1:
+                    i = n
+                    break
+                state = _FIRST
+                i = j + 1
+            elif state == _SEP:
+                c = text[i]
+                if c == ',':
+                    # There are more items in list, drop comma & cont
+                    state = _ITEM
+                elif c == ']':
+                    if single:
+                        raise _ListEnd("End of list")
+                    # End of list, check for start of another list
+                    state = _SEEK
+                else:
+                    raise ValueError("Badly formatted JSON List file")
+                i += 1
+            elif state == _FIRST and text[i] == ']':
+                if single:
+                    raise _ListEnd("End of list")
+                state = _SEEK
+                i += 1
+            else:
+                try:
+                    x, i_next = _DECODER.raw_decode(text, i)
+                except ValueError:
+                    break
+                if type(x) != dict:
+                    # Wrong data type, someone's not keeping to spec!
+                    raise ValueError("JSON file contains incorrect datatypes!")
+                if ascii:
+                    buf.last_start = start + i
+                    buf.last_end = start + i_next
+                else:
+                    bi += len(text[ci:i].encode('utf8'))
+                    buf.last_start = start + bi
+                    bi += len(text[i:i_next].encode('utf8'))
+                    buf.last_end = start + bi
+                    ci = i_next
+                i = i_next
+                state = _SEP
+                yield x
+        buf.consume(text, i, end - buf.base)
+
+        pending = end - buf.base - buf.pos
+        if buf.eof:
+            leftover = text[i:].strip()
+            if leftover:
+                if len(leftover) > 70:
+                    leftover = leftover[:70] + '...'
+                msg = "Leftover stuff from input: \"{}\""
+                raise ValueError(msg.format(leftover))
+            return
+        if pending >= max_size:
+            if not piece_size or state not in (_FIRST, _ITEM):
+                msg = "either bad input or too-large JSON object."
+                raise ValueError(msg)
+            buf.last_start = buf.base + buf.pos
+            yield from _stream_pieces(buf, max_size, piece_size)
+            state = _SEP
+            end = scanned = buf.base + buf.pos
+            need = 0
+            continue
+        need = 2*pending if pending else 0
+
+
 def json_list_parser(url,
                      timeout=_DEFAULT_TIMEOUT,
                      chunk_size=_DEFAULT_CHUNK_SIZE,
-                     max_size=_LARGEST_JSON_OBJECT_ACCEPTED):
+                     max_size=_LARGEST_JSON_OBJECT_ACCEPTED,
+                     piece_size=_DEFAULT_PIECE_SIZE,
+                     pool=None,
+                     resume=None,
+                     cache=None,
+                     monitor=None,
+                     spool=None):
     """
-    Read an input file, and yield up each JSON object parsed from the file.
+    Read an input file, and yield up each JSON object parsed from the file,
+    along with a Progress tuple. Compressed input is decompressed on the fly.
     Allocates minimal memory so should be suitable for large input files.
+    Reads start at chunk_size bytes and grow, up to _MAX_CHUNK_SIZE, while
+    a large object is being assembled. Objects larger than max_size are
+    yielded as a series of ObjectPieces, or rejected if piece_size is 0.
+    Remote files are fetched through pool and cache if
+    given, and spooled to disk first by spool if given.
+    If a Resume is given, it is kept up to date with the items yielded, and
+    a later call passing it back yields only the items that come after.
+    If a ThroughputMonitor is given, a stream that stalls is raced against
+    a new request for the rest of the file, which takes over if faster.
+    Failing that, StreamStalled is raised, so the caller can resume later.
     """
-    stream = _open_stream(url, timeout)
-    file_size = _get_file_size(stream)
-
-    bytes_read = 0
+    if resume is not None and resume.count:
+        stream, offset = _resume_stream(url, timeout, pool, cache, spool,
+                                        resume)
+    else:
+        stream, offset = _open_stream(url, timeout, pool, cache, spool), 0
+        if resume is not None:
+            resume.validator = stream.validator
+            resume.ranged = stream.ranged
+    # items to pass over when the file had to be read again from the start
+    skip = resume.count if resume is not None and not offset else 0
+    watch = monitor.watch(stream.bytes_read) if monitor else None
 
-    def read(num_chars):
-        nonlocal bytes_read
+    def read(num_bytes):
+        nonlocal stream
         try:
-            s = stream.read(num_chars)
+            b = stream.read(num_bytes)
         except TimeoutError:
             stream.close()
             raise TimeoutError()
-        bytes_read += len(s)
-        if type(s) == bytes:
-            s = s.decode('utf8')
-        return s
-
-    # Seek to the opening bracket of the data list
-    buf = read(chunk_size)
-    if buf == "[]" or buf == "":
-        return
-    i = buf.find('[')
-    buf = buf[i+1:].lstrip()
-    while True:
-        temp = read(chunk_size)
-        if not temp:
-            break
-        buf += temp
+        if watch is None or not b:
+            return b
+        rate = watch.update(stream.bytes_read)
+        if rate is None:
+            return b
+        # Only remote files whose offsets can be requested directly can be
+        # hedged, others have to be resumed from the last whole item.
+        hedgeable = (stream.ranged and
+                     parse.urlparse(url).scheme in ('http', 'https'))
+        if not hedgeable or watch.hedges >= _MAX_HEDGES:
+            msg = "{} slowed to {:.0f} bytes/s"
+            raise StreamStalled(msg.format(url, rate))
+        watch.hedges += 1
+        hedge, first = _hedge(url, timeout, pool, stream, rate)
+        if hedge is not None:
+            stream.close()
+            stream = hedge
+            watch.reset(stream.bytes_read)
+        return b + first
+
+    buf = _Buffer(offset)
+    state = _SEP if offset else _SEEK
+    try:
+        for x in _parse_list(buf, max_size, piece_size, state):
+            if x is _NEED_DATA:
+                want = buf.want - buf.unconsumed()
+                buf.feed(read(min(max(chunk_size, want), _MAX_CHUNK_SIZE)))
+                continue
+            whole = not isinstance(x, ObjectPiece) or x.piece[1]
+            if skip:
+                if whole:
+                    skip -= 1
+                continue
+            if resume is not None and whole:
+                resume.count += 1
+                resume.offset = buf.last_end
+            progress = Progress(stream.bytes_read, stream.file_size,
+                                stream.bytes_decoded)
+            yield progress, x
+    finally:
+        stream.close()
+
+
+class _Inflater:
+    """
+    Push-style counterpart of _DecompressingReader, for use when the
+    compressed data arrives in chunks rather than being read on demand.
+    """
+    def __init__(self, make_decompressor):
+        self.make_decompressor = make_decompressor
+        self.dec = make_decompressor()
+        self.started = False
+
+    def decompress(self, data):
+        out = []
+        while data:
+            self.started = True
+            out.append(self.dec.decompress(data))
+            if not self.dec.eof:
+                break
+            data = self.dec.unused_data
+            self.dec = self.make_decompressor()
+            self.started = False
+        return b''.join(out)
+
+    def finish(self):
+        if self.started:
+            raise EOFError("Compressed stream is truncated")
+
+
+class _AsyncResponse:
+    """
+    Body of an HTTP/1.1 response read from an asyncio stream. Handles
+    Content-Length delimited, chunked and read-until-close bodies.
+    """
+    def __init__(self, reader, writer, status, headers, timeout):
+        self.reader = reader
+        self.writer = writer
+        self.status = status
+        self.headers = headers
+        self.timeout = timeout
+        self.chunked = 'chunked' in headers.get('Transfer-Encoding', '')
+        length = headers.get('Content-Length')
+        self.remaining = int(length) if length and not self.chunked else None
+        self.done = False
+
+    def info(self):
+        return self.headers
+
+    async def _read(self, coro):
+        try:
+            return await asyncio.wait_for(coro, self.timeout)
+        except asyncio.TimeoutError:
+            self.close()
+            raise TimeoutError()
+
+    async def read(self, size):
+        if self.done:
+            return b''
+        if self.chunked:
+            if not self.remaining:
+                line = await self._read(self.reader.readline())
+                self.remaining = int(line.split(b';')[0], 16)
+                if self.remaining == 0:
+                    while (await self._read(self.reader.readline())).strip():
+                        pass  # trailers
+                    self.done = True
+                    return b''
+            b = await self._read(self.reader.read(min(size, self.remaining)))
+            if not b:
+                raise EOFError("Connection closed mid-chunk")
+            self.remaining -= len(b)
+            if not self.remaining:
+                await self._read(self.reader.readexactly(2))  # CRLF
+            return b
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+            if not size:
+                self.done = True
+                return b''
+        b = await self._read(self.reader.read(size))
+        if self.remaining is not None:
+            if not b:
+                raise EOFError("Connection closed before end of body")
+            self.remaining -= len(b)
+        elif not b:
+            self.done = True
+        return b
+
+    def close(self):
+        self.writer.close()
+
+
+async def _async_http_get(url, timeout, headers=_REQUEST_HEADERS):
+    """
+    Minimal asyncio HTTP/1.1 GET that follows redirects and raises
+    urllib's HTTPError for error statuses, like request.urlopen. A 206
+    answer to a Range request is returned as is.
+    """
+    for _ in range(_MAX_REDIRECTS):
+        parts = parse.urlsplit(url)
+        https = parts.scheme == 'https'
+        port = parts.port or (443 if https else 80)
+        conn = asyncio.open_connection(parts.hostname, port,
+                                       ssl=True if https else None)
+        reader, writer = await asyncio.wait_for(conn, timeout)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        lines = ["GET {} HTTP/1.1".format(target),
+                 "Host: {}".format(parts.netloc),
+                 "Connection: close"]
+        lines += ["{}: {}".format(k, v) for k, v in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                          timeout)
+        except Exception:
+            writer.close()
+            raise
+        status_line, _, header_text = head.decode('latin-1').partition('\r\n')
+        status = int(status_line.split()[1])
+        msg = email.parser.Parser(_class=http.client.HTTPMessage)
+        response_headers = msg.parsestr(header_text)
+        if status in (301, 302, 303, 307, 308):
+            writer.close()
+            url = parse.urljoin(url, response_headers['Location'])
+            continue
+        if status not in (200, 206):
+            writer.close()
+            reason = status_line.split(None, 2)[-1]
+            raise error.HTTPError(url, status, reason, response_headers, None)
+        return _AsyncResponse(reader, writer, status, response_headers,
+                              timeout)
+    raise error.URLError("Too many redirects")
+
+
+class _AsyncStream:
+    """
+    Asynchronous counterpart of _Stream for HTTP responses.
+    """
+    validator = None
+    ranged = False
+
+    def __init__(self, response, file_size, make_decompressor=None):
+        self.response = response
+        self.file_size = file_size
+        self.inflater = make_decompressor and _Inflater(make_decompressor)
+        self.bytes_read = 0
+        self.bytes_decoded = 0
+
+    async def read(self, size):
         while True:
+            b = await self.response.read(size)
+            self.bytes_read += len(b)
+            if self.inflater is None:
+                break
+            if not b:
+                self.inflater.finish()
+                break
+            b = self.inflater.decompress(b)
+            if b:
+                break
+        self.bytes_decoded += len(b)
+        return b
+
+    def close(self):
+        self.response.close()
+
+
+class _ThreadedStream:
+    """
+    Wraps a blocking _Stream, e.g. for a local file, so it can be read from
+    a coroutine without stalling the event loop.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    async def read(self, size):
+        return await asyncio.to_thread(self.stream.read, size)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+async def _async_governed_get(url, timeout, governor,
+                              headers=_REQUEST_HEADERS):
+    """
+    _async_http_get, once governor lets a request to the host start. The
+    governor is told how it went once the response headers arrive.
+    """
+    host = parse.urlsplit(url).netloc
+    await asyncio.to_thread(governor.acquire, host)
+    start = time.monotonic()
+    try:
+        response = await _async_http_get(url, timeout, headers)
+    except error.HTTPError as e:
+        outcome = "throttled" if e.code in (429, 503) else "ok"
+        await asyncio.to_thread(governor.release, host, outcome)
+        raise
+    except Exception:
+        await asyncio.to_thread(governor.release, host, "error")
+        raise
+    await asyncio.to_thread(governor.release, host, "ok",
+                            time.monotonic() - start)
+    return response
+
+
+async def _async_get(url, timeout, governor, headers=_REQUEST_HEADERS):
+    if governor is not None:
+        return await _async_governed_get(url, timeout, governor, headers)
+    return await _async_http_get(url, timeout, headers)
+
+
+async def _async_open_stream(url, timeout, governor=None):
+    parse_result = parse.urlparse(url)
+    if parse_result.scheme == "file":
+        stream = await asyncio.to_thread(_open_stream, url, timeout)
+        return _ThreadedStream(stream)
+    response = await _async_get(url, timeout, governor)
+    try:
+        make_decompressor = _response_decompressor(response.headers,
+                                                   parse_result.path)
+    except ValueError:
+        response.close()
+        raise
+    stream = _AsyncStream(response, _get_file_size(response),
+                          make_decompressor)
+    stream.validator = _http_validator(response.headers)
+    stream.ranged = (stream.validator is not None and
+                     _suffix_decompressor(parse_result.path) is None)
+    return stream
+
+
+async def _async_resume_stream(url, timeout, governor, resume):
+    """
+    Asynchronous counterpart of _resume_stream.
+    """
+    parse_result = parse.urlparse(url)
+    if parse_result.scheme == "file":
+        stream, offset = await asyncio.to_thread(
+            _resume_stream, url, timeout, None, None, None, resume)
+        return _ThreadedStream(stream), offset
+    if not resume.ranged:
+        stream = await _async_open_stream(url, timeout, governor)
+        if stream.validator != resume.validator:
+            stream.close()
+            raise ContentChanged(url)
+        return stream, 0
+    headers = _range_headers(resume.offset, resume.validator)
+    response = await _async_get(url, timeout, governor, headers)
+    if response.status != 206:
+        # The server ignored the range, or If-Range found a new version
+        if resume.validator not in (response.headers.get('ETag'),
+                                    response.headers.get('Last-Modified')):
+            response.close()
+            raise ContentChanged(url)
+        try:
+            make_decompressor = _response_decompressor(response.headers,
+                                                       parse_result.path)
+        except ValueError:
+            response.close()
+            raise
+        stream = _AsyncStream(response, _get_file_size(response),
+                              make_decompressor)
+        stream.validator = resume.validator
+        stream.ranged = True
+        return stream, 0
+    stream = _AsyncStream(response, _range_size(response, resume.offset))
+    stream.bytes_read = resume.offset
+    stream.bytes_decoded = resume.offset
+    stream.validator = resume.validator
+    stream.ranged = True
+    return stream, resume.offset
+
+
+async def async_json_list_parser(url,
+                                 timeout=_DEFAULT_TIMEOUT,
+                                 chunk_size=_DEFAULT_CHUNK_SIZE,
+                                 max_size=_LARGEST_JSON_OBJECT_ACCEPTED,
+                                 piece_size=_DEFAULT_PIECE_SIZE,
+                                 governor=None,
+                                 resume=None):
+    """
+    Asynchronous generator version of json_list_parser, for running many
+    downloads on one event loop. Parsing happens on the event loop thread
+    while waiting for network data does not block it. Given a
+    governor.HostGovernor, the request waits for its go-ahead, as with an
+    http_pool.ConnectionPool. A Resume is kept up to date and carried on
+    from as in json_list_parser, with a Range request where the server
+    allows it.
+    """
+    if resume is not None and resume.count:
+        stream, offset = await _async_resume_stream(url, timeout, governor,
+                                                    resume)
+    else:
+        stream, offset = await _async_open_stream(url, timeout, governor), 0
+        if resume is not None:
+            resume.validator = stream.validator
+            resume.ranged = stream.ranged
+    # items to pass over when the file had to be read again from the start
+    skip = resume.count if resume is not None and not offset else 0
+    buf = _Buffer(offset)
+    state = _SEP if offset else _SEEK
+    try:
+        for x in _parse_list(buf, max_size, piece_size, state):
+            if x is _NEED_DATA:
+                want = buf.want - buf.unconsumed()
+                size = min(max(chunk_size, want), _MAX_CHUNK_SIZE)
+                buf.feed(await stream.read(size))
+                continue
+            whole = not isinstance(x, ObjectPiece) or x.piece[1]
+            if skip:
+                if whole:
+                    skip -= 1
+                continue
+            if resume is not None and whole:
+                resume.count += 1
+                resume.offset = buf.last_end
+            progress = Progress(stream.bytes_read, stream.file_size,
+                                stream.bytes_decoded)
+            yield progress, x
+    finally:
+        stream.close()
+
+
+def is_splittable(url):
+    """
+    Whether url can be parsed by split_json_list_parser, ie. whether it is
+    an uncompressed local file.
+    """
+    parse_result = parse.urlparse(url)
+    if parse_result.scheme != "file":
+        return False
+    path = parse_result.path.lower()
+    return not (path.endswith('.zip') or _suffix_decompressor(path))
+
+
+def _parse_segment(mm, start, end, class_, max_size, piece_size,
+                   speculative=False, stop=()):
+    """
+    Parse the list items of the memory-mapped file mm, starting with the
+    one at offset start, into class_ objects until reaching the first item
+    that starts at or beyond end, or at an offset in stop. Returns
+    (offsets, objs, errors, handoff, ok): the offset of each object (the
+    pieces of a streamed object share its offset), the objects, None in
+    place of those that failed to build, (index, message)s for those, the
+    offset of the item stopped at (None if the list ended) and whether the
+    parse got there. A speculative parse, whose start may not actually be a list
+    item, isn't ok if it fails, or if the list seems to end before the
+    file does. Otherwise failures are raised.
+    """
+    buf = _Buffer(start)
+    read_pos = start
+    offsets = []
+    objs = []
+    errors = []
+    try:
+        for x in _parse_list(buf, max_size, piece_size, _ITEM,
+                             single=speculative):
+            if x is _NEED_DATA:
+                want = buf.want - buf.unconsumed()
+                size = min(max(_DEFAULT_CHUNK_SIZE, want), _MAX_CHUNK_SIZE)
+                buf.feed(mm[read_pos:read_pos + size])
+                read_pos += size
+                continue
+            if buf.last_start >= end or buf.last_start in stop:
+                return offsets, objs, errors, buf.last_start, True
+            offsets.append(buf.last_start)
             try:
-                x, i = _DECODER.raw_decode(buf)
-                if type(x) == dict:
-                    yield (bytes_read, file_size), x
-                    buf = buf[i:]
-                    if len(buf) < chunk_size:
-                        buf += read(chunk_size)
-                    buf = buf.lstrip()
-
-                    if buf[0] == ",":
-                        # There are more items in list, drop comma & cont
-                        buf = buf[1:].lstrip()
-                    elif buf[0] == ']':
-                        # End of list, check for start of another list
-                        i = buf.find('[')
-                        if i == -1:
-                            # raise StopIteration()
-                            return
-                        buf = buf[i+1:].lstrip()
-                    else:
-                        raise ValueError("Badly formatted JSON List file")
-                else:  # Wrong data type, someone's not keeping to spec!
-                    raise ValueError("JSON file contains incorrect datatypes!")
-            except ValueError:
-                if len(buf) >= max_size:
-                    msg = "either bad input or too-large JSON object."
-                    raise ValueError(msg)
+                objs.append(class_(x))
+            except Exception as e:
+                errors.append((len(objs), "{!r} while building {!s:.200}"
+                                          .format(e, x)))
+                objs.append(None)
+    except _ListEnd:
+        last_end = buf.last_end if buf.last_end is not None else start
+        return (offsets, objs, errors, None,
+                _LIST_END.match(mm, last_end) is not None)
+    except ValueError:
+        if not speculative:
+            raise
+        return offsets, objs, errors, None, False
+    return offsets, objs, errors, None, True
+
+
+def _parse_range(args):
+    """
+    Worker for split_json_list_parser. Parses the list items of the file at
+    path from offset start, which looks like, but may not be, the start of
+    one, up to end (see _parse_segment). Whenever the parse shows that it
+    isn't in the list itself, by failing or seeing the list end early, it
+    starts again at the next place that looks like an item. Returns the
+    _parse_segment results of each attempt. Once an attempt reaches a real
+    item it parses exactly as a parse from the start of the file would, so
+    the parent can use everything from the first offset it knows to be an
+    item on.
+    """
+    path, start, end, class_, max_size, piece_size = args
+    segments = []
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        while start < end:
+            segment = _parse_segment(mm, start, end, class_, max_size,
+                                     piece_size, speculative=True)
+            segments.append(segment)
+            offsets, _, _, _, ok = segment
+            if ok:
+                break
+            m = _ITEM_START.search(mm, max([start] + offsets[-1:]) + 1)
+            if not m:
                 break
-    buf = buf.strip()
-    if buf:
-        if len(buf) > 70:
-            buf = buf[:70] + '...'
-        msg = "Leftover stuff from input: \"{}\""
-        raise ValueError(msg.format(buf))
+            start = m.end() - 1
+    return segments
+
+
+def _synced(segments, offset):
+    """
+    The segment of _parse_range results that holds an object at offset,
+    and that object's index in it, or None.
+    """
+    for segment in segments:
+        offsets = segment[0]
+        if offsets and offsets[0] <= offset <= offsets[-1]:
+            i = bisect.bisect_left(offsets, offset)
+            if offsets[i] == offset:
+                return segment, i
+    return None
+
+
+def split_json_list_parser(url, class_, processes,
+                           source_url=None,
+                           split_size=_DEFAULT_SPLIT_SIZE,
+                           max_size=_LARGEST_JSON_OBJECT_ACCEPTED,
+                           piece_size=_DEFAULT_PIECE_SIZE,
+                           on_error=None,
+                           stats=None):
+    """
+    Parse a large local JSON list file using a pool of processes, yielding
+    (Progress, obj) where each obj is a class_ object built by a worker
+    with its source_url set to source_url. Objects come out in file order.
+
+    The file is memory-mapped and cut roughly every split_size bytes, at
+    places that look like the start of a list item, and each range is
+    parsed in a worker. The cut points are only guesses, as the same
+    pattern occurs inside nested arrays, so a worker may start inside an
+    item. It starts again further on whenever it notices, and reports the
+    offset of every object it parsed. The parent parses each range itself
+    only from where the previous one ended up to the first of those
+    offsets it comes to, usually a fraction of one item, and takes the
+    worker's objects from there. Messages for objects that failed to build
+    are passed to on_error. If stats, a dict, is given, it counts the
+    "ranges" parsed and the "reparsed" bytes parsed by the parent.
+    """
+    if stats is None:
+        stats = {}
+    stats.setdefault("ranges", 0)
+    stats.setdefault("reparsed", 0)
+    path = parse.urlparse(url).path
+    file_size = os.stat(path).st_size
+    first = None
+    starts = []
+    if file_size:
+        with open(path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            m = _LIST_START.search(mm)
+            if m and mm[m.end():m.end()+1] == b'{':
+                first = m.end()
+                starts.append(first)
+                for nominal in range(first+split_size, file_size, split_size):
+                    m = _ITEM_START.search(mm, max(nominal, starts[-1]))
+                    if not m:
+                        break
+                    starts.append(m.end() - 1)
+    if first is None:
+        # Empty, or not a list of objects: leave it to the regular parser
+        for progress, obj_dict in json_list_parser(url, max_size=max_size,
+                                                    piece_size=piece_size):
+            yield progress, class_(obj_dict, source_url=source_url)
+        return
+
+    ranges = list(zip(starts, starts[1:] + [file_size + 1]))
+    pool = mp.Pool(processes)
+
+    def results():
+        # keep a bounded number of ranges in flight so that parsed objects
+        # don't pile up faster than they are consumed
+        pending = collections.deque()
+        for start, end in ranges:
+            task = (path, start, end, class_, max_size, piece_size)
+            result = pool.apply_async(_parse_range, (task,))
+            pending.append((start, end, result))
+            if len(pending) >= 2*processes:
+                yield pending.popleft()
+        yield from pending
+
+    def parse_from(mm, offset, end, stop=()):
+        segment = _parse_segment(mm, offset, end, class_, max_size,
+                                 piece_size, stop=stop)
+        handoff = segment[3]
+        stats["reparsed"] += (file_size if handoff is None
+                              else handoff) - offset
+        return segment
+
+    try:
+        with open(path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            expected = first
+            for start, end, result in results():
+                if expected >= end:
+                    continue  # range lies within an earlier range's object
+                stats["ranges"] += 1
+                segments = result.get()
+                parts = []
+                synced = _synced(segments, expected)
+                if synced is None:
+                    # parse up to the first object the worker got right
+                    stop = {offset for segment in segments
+                            for offset in segment[0] if offset > expected}
+                    part = parse_from(mm, expected, end, stop)
+                    parts.append((part, 0))
+                    if part[3] is not None and part[3] < end:
+                        synced = _synced(segments, part[3])
+                if synced is not None:
+                    segment, i = synced
+                    if not segment[4]:
+                        # the input itself is at fault, fail as a parse
+                        # from the start would
+                        segment = parse_from(mm, segment[0][i], end)
+                        i = 0
+                    parts.append((segment, i))
+                handoff = parts[-1][0][3]
+                done = handoff if handoff is not None else file_size
+                progress = Progress(done, file_size, done)
+                for (offsets, objs, errors, _, _), i in parts:
+                    if on_error:
+                        for index, error in errors:
+                            if index >= i:
+                                on_error(error)
+                    for obj in objs[i:]:
+                        if obj is not None:
+                            obj.source_url = source_url
+                            yield progress, obj
+                if handoff is None:
+                    return
+                expected = handoff
+    finally:
+        pool.terminate()
 
 
 if __name__ == "__main__":
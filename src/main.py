@@ -1,20 +1,38 @@
 #!/usr/bin/env python3
 import io
 import os
+import copy
 import json
+import time
+import asyncio
 import logging
 import zipfile
 import argparse
+import itertools
+import contextlib
 import collections
 import multiprocessing as mp
+from multiprocessing import util
 import urllib.parse as parse
 import urllib.request as request
+from queue import Full as QueueFull, Empty as QueueEmpty
 
 import openpyxl
 
-from json_list_parser import json_list_parser, download_formatter
+from json_list_parser import (json_list_parser, async_json_list_parser,
+                              split_json_list_parser, is_splittable,
+                              download_formatter, http_get, content_length,
+                              Resume, ContentChanged, ThroughputMonitor,
+                              StreamStalled)
+from http_pool import ConnectionPool, Throttled
+from governor import GovernorManager
+from cache import ResponseCache
+from spool import Spool
+from budget_queue import ByteBudgetQueue
 import models
+import wire
 import db
+import parquet_sink
 
 NULL_URL = "NOT SUBMITTED"
 PROFILE_DB = False
@@ -34,52 +52,114 @@ def init_logger(logger_name):
     return logger
 
 
+def model_of(url):
+    if url.url_type == models.URLType.plan:
+        return models.Plan
+    if url.url_type == models.URLType.drug:
+        return models.Drug
+    return models.Provider
+
+
+def data_urls_of(issuer_group, url_limit=0):
+    data_urls = [url for url in issuer_group.data_urls
+                 if url.url_type != models.URLType.plan]
+    if url_limit:
+        data_urls = data_urls[:url_limit]
+    return data_urls
+
+
 class Downloader:
     url_limit = 0
     data_limit = 0
     download_attempts = 3
+    split_processes = 0  # processes used to parse each local file
+    http2 = False  # multiplex requests over HTTP/2 where httpx allows
+    cache = None  # a ResponseCache to fetch through, if any
+    governor = None  # a HostGovernor pacing requests to each host, if any
+    spool = None  # a Spool to download data files through, if any
+    max_throttled = 20  # times a URL may be throttled before giving up
+    max_stalls = 5  # times a URL may stall before it counts as a failure
 
     def __init__(self, issuer_group, queue, label):
+        """
+        issuer_group may be None for a Downloader only used to download
+        the data URLs handed to download_url.
+        """
         self.issuer_group = issuer_group
-        self.issuer_group.idx_issuer_group = label
-        for issuer in self.issuer_group.issuers:
-            issuer.idx_issuer_group = label
+        if issuer_group is not None:
+            self.issuer_group.idx_issuer_group = label
+            for issuer in self.issuer_group.issuers:
+                issuer.idx_issuer_group = label
         self.q = queue
         self.logger = init_logger("DL_{}".format(label))
+        # shared by all URLs of the group, most of which are on one host
+        self.pool = ConnectionPool(http2=self.http2, governor=self.governor)
+        # its baseline rate rolls on from one URL to the next
+        self.monitor = ThroughputMonitor()
 
     def run(self):
-        log = self.logger
+        try:
+            if self.run_index():
+                self.run_data()
+        finally:
+            self.close()
+
+    def close(self):
+        fmt = ("HTTP requests: {requests}, connections opened: {opened}, "
+               "reused: {reused}")
+        self.logger.info(fmt.format(**self.pool.stats()))
+        self.pool.close()
+
+    def run_index(self):
         success = self._download_index()
         status = "finished" if success else "failed"
         self.issuer_group.index_status = status
         self.q.put(self.issuer_group)
         for issuer in self.issuer_group.issuers:
             self.q.put(issuer)
-        if not success:
-            return
+        return success
 
+    def run_data(self):
+        log = self.logger
         plan_urls = list(filter(lambda x: x.url_type == models.URLType.plan,
                                 self.issuer_group.data_urls))
         n = len(plan_urls)
         for i, url in enumerate(plan_urls):
             log.info("Downloading from Plan URL {}/{}".format(i+1, n))
-            success = self._download_objects(url, models.Plan, 0)
-            url.status = "finished" if success else "failed"
-            self.q.put(url)
+            self.download_url(url)
 
-        data_urls = list(filter(lambda x: x.url_type != models.URLType.plan,
-                                self.issuer_group.data_urls))
-        if self.url_limit:
-            data_urls = data_urls[:self.url_limit]
+        data_urls = data_urls_of(self.issuer_group, self.url_limit)
         n = len(data_urls)
         for i, url in enumerate(data_urls):
             log.info("Downloading from Data URL {}/{}".format(i+1, n))
-            if url.url_type == models.URLType.drug:
-                success = self._download_objects(url, models.Drug)
-            else:  # provider url
-                success = self._download_objects(url, models.Provider)
-            url.status = "finished" if success else "failed"
-            self.q.put(url)
+            self.download_url(url)
+
+    def download_url(self, url):
+        """
+        Download one data URL, then queue it with its final status.
+        """
+        self.logger.info("Downloading from \"{}\"".format(url.url))
+        if url.url_type == models.URLType.plan:
+            success = self._download_objects(url, models.Plan, 0)
+        else:
+            success = self._download_objects(url, model_of(url))
+        url.status = "finished" if success else "failed"
+        self.q.put(url)
+        return url
+
+    def probe_sizes(self):
+        """
+        Look up the size of each provider and drug URL, so the biggest can
+        be started first.
+        """
+        if self.cache is not None and self.cache.offline:
+            return
+        for url in data_urls_of(self.issuer_group, self.url_limit):
+            try:
+                url.size = content_length(url.url, 20, self.pool)
+            except Exception as e:
+                fmt = "Couldn't find the size of \"{}\": {}"
+                self.logger.warning(fmt.format(url.url, e))
 
     def _download_index(self):
         log = self.logger
@@ -89,7 +169,12 @@ class Downloader:
             return False
         log.info("Pulling JSON index from \"{}\"".format(iss_grp.index_url))
         try:
-            with request.urlopen(iss_grp.index_url, timeout=20) as conn:
+            if parse.urlsplit(iss_grp.index_url).scheme in ('http', 'https'):
+                conn = http_get(iss_grp.index_url, 20, self.pool,
+                                cache=self.cache)
+            else:
+                conn = request.urlopen(iss_grp.index_url, timeout=20)
+            with conn:
                 js = json.loads(conn.read().decode('utf8'))
                 plans = [models.IssuerGroupURL(idx, url, models.URLType.plan,
                                                status="pending")
@@ -114,61 +199,272 @@ class Downloader:
             log.error(fmt.format(iss_grp.index_url))
             return False
 
-    def _download_objects_attempt(self, url, class_, data_limit=None):
+    def _download_objects_attempt(self, url, class_, resume,
+                                  data_limit=None):
         log = self.logger
         if data_limit is None:
             data_limit = self.data_limit
         formatter = download_formatter()
 
-        def status(bytes_read, file_size, i):
-            s = formatter(bytes_read, file_size)
+        def status(progress, i):
+            s = formatter(*progress)
             log.info("Downloaded {}".format(s))
+            log.info("Decompressed {:.2f} MB".format(
+                progress.bytes_decoded/2**20))
             log.info("Parsed {} data objects".format(i))
         try:
-            json_objs = json_list_parser(url.url)
-            for i, ((bytes_read, file_size), obj_dict) in enumerate(json_objs):
+            split = self.split_processes > 1 and is_splittable(url.url)
+            if split:
+                json_objs = split_json_list_parser(url.url, class_,
+                                                   self.split_processes,
+                                                   source_url=url,
+                                                   on_error=log.error)
+                # This can't resume, so pass over what was already sent
+                json_objs = itertools.islice(json_objs, resume.count, None)
+            else:
+                # A spooled stream is read as fast as it is parsed, so its
+                # rate says nothing about the network
+                monitor = self.monitor if self.spool is None else None
+                json_objs = json_list_parser(url.url, pool=self.pool,
+                                             resume=resume,
+                                             cache=self.cache,
+                                             monitor=monitor,
+                                             spool=self.spool)
+            if resume.count:
+                fmt = "Resuming after {} data objects"
+                log.info(fmt.format(resume.count))
+            progress = (0, -1)
+            for i, (progress, obj_dict) in enumerate(json_objs, 1):
+                if split:
+                    resume.count += 1
                 try:
-                    obj = class_(obj_dict, source_url=url)
+                    if isinstance(obj_dict, class_):  # already built
+                        obj = obj_dict
+                    else:
+                        obj = class_(obj_dict, source_url=url)
                     self.q.put(obj)
                 except Exception as e:
                     log.exception(e)
                     log.info(obj_dict)
                     continue
-                if i > 0 and ((i % 1000) == 0):
-                    status(bytes_read, file_size, i)
-                if data_limit and i > data_limit:
+                if (i % 1000) == 0:
+                    status(progress, resume.count)
+                if data_limit and resume.count > data_limit:
                     log.info("Hit data limit, breaking...")
-                    status(bytes_read, file_size, i)
+                    status(progress, resume.count)
                     break
             fmt = "Finished download of url: {} |{} MB"
-            log.info(fmt.format(url.url, bytes_read/2**20))
+            log.info(fmt.format(url.url, progress[0]/2**20))
             return True
+        except (ContentChanged, Throttled, StreamStalled):
+            raise
         except Exception as e:
             log.exception(e)
             log.warning("Error loading data from {}".format(url))
             return False
 
     def _download_objects(self, url, class_, data_limit=None):
-        for i in range(self.download_attempts):
+        """
+        Retries pick up after the last object sent, so that each object
+        reaches the queue once. If the file changes between attempts, the
+        Consumer is told to discard what was sent and it starts over.
+        """
+        resume = Resume()
+        i = throttled = stalled = 0
+        while i < self.download_attempts:
             fmt = "Starting Download Attempt {}/{}"
             self.logger.info(fmt.format(i+1, self.download_attempts))
-            success = self._download_objects_attempt(url, class_,
-                                                     data_limit=None)
+            i += 1
+            events = self.monitor.events
+            try:
+                success = self._download_objects_attempt(url, class_, resume,
+                                                         data_limit=None)
+            except StreamStalled as e:
+                # Start again over a new connection, from the last object
+                stalled += 1
+                self.logger.warning("{}, resuming it".format(e))
+                if stalled < self.max_stalls:
+                    i -= 1
+                continue
+            except Throttled as e:
+                # Not the file's fault, so doesn't use up an attempt. The
+                # governor holds back the retry for as long as the host
+                # asked, or backs off.
+                throttled += 1
+                if throttled > self.max_throttled:
+                    self.logger.error("Throttled too often, giving up")
+                    return False
+                fmt = "Throttled by host ({}), retry after {}"
+                self.logger.warning(fmt.format(e.code, e.retry_after))
+                if self.governor is None:
+                    time.sleep(e.retry_after or 2**min(throttled, 6))
+                i -= 1
+                continue
+            except ContentChanged:
+                fmt = "{} changed since the last attempt, starting over"
+                self.logger.warning(fmt.format(url.url))
+                # a copy, as url is still to be updated and queued again
+                retry = copy.copy(url)
+                retry.status = "retrying"
+                self.q.put(retry)
+                resume = Resume()
+                continue
+            finally:
+                url.stalls += self.monitor.events - events
             if success:
                 return True
-            else:
-                continue
         return False
 
 
+class AsyncDownloader:
+    """
+    Downloads the data URLs of several issuer groups concurrently on one
+    asyncio event loop. Plan URLs of a group finish before its provider and
+    drug URLs start, so the Consumer sees plans before the objects that
+    refer to them. Parsed objects go to the same queue Downloader uses.
+    Requests are paced by the same governor as Downloader's, shared by
+    all processes. max_host_streams only bounds how many responses one
+    process reads from a host at once.
+    """
+    max_streams = 200  # data URLs open at once
+    max_host_streams = 16  # data URLs open at once against one host
+
+    def __init__(self, issuer_groups, queue, label):
+        self.issuer_groups = issuer_groups
+        self.q = queue
+        self.logger = init_logger("ADL_{}".format(label))
+
+    def run(self):
+        asyncio.run(self._run())
+
+    async def _run(self):
+        self.streams = asyncio.Semaphore(self.max_streams)
+        self.hosts = collections.defaultdict(
+            lambda: asyncio.Semaphore(self.max_host_streams))
+        await asyncio.gather(*[self._download_group(grp)
+                               for grp in self.issuer_groups])
+
+    async def _download_group(self, issuer_group):
+        plan_urls = [url for url in issuer_group.data_urls
+                     if url.url_type == models.URLType.plan]
+        await asyncio.gather(*[self._download(url, 0) for url in plan_urls])
+        data_urls = data_urls_of(issuer_group, Downloader.url_limit)
+        await asyncio.gather(*[self._download(url) for url in data_urls])
+
+    async def _put(self, obj):
+        try:
+            self.q.put_nowait(obj)
+        except QueueFull:  # wait for the consumer without blocking the loop
+            await asyncio.to_thread(self.q.put, obj)
+
+    async def _download(self, url, data_limit=None):
+        """
+        Retries pick up after the last object sent, as in Downloader.
+        """
+        log = self.logger
+        host = self.hosts[parse.urlsplit(url.url).netloc]
+        async with self.streams, host:
+            attempts = Downloader.download_attempts
+            resume = Resume()
+            for i in range(attempts):
+                fmt = "Starting Download Attempt {}/{} of {}"
+                log.info(fmt.format(i+1, attempts, url.url))
+                try:
+                    success = await self._download_attempt(url, resume,
+                                                           data_limit)
+                except ContentChanged:
+                    fmt = "{} changed since the last attempt, starting over"
+                    log.warning(fmt.format(url.url))
+                    retry = copy.copy(url)
+                    retry.status = "retrying"
+                    await self._put(retry)
+                    resume = Resume()
+                    continue
+                if success:
+                    url.status = "finished"
+                    break
+            else:
+                url.status = "failed"
+        await self._put(url)
+
+    async def _download_attempt(self, url, resume, data_limit=None):
+        log = self.logger
+        if data_limit is None:
+            data_limit = Downloader.data_limit
+        class_ = model_of(url)
+        formatter = download_formatter()
+
+        def status(progress, i):
+            s = formatter(*progress)
+            log.info("Downloaded {} of {}".format(s, url.url))
+            log.info("Parsed {} data objects".format(i))
+        try:
+            progress = (0, -1)
+            json_objs = async_json_list_parser(url.url,
+                                               governor=Downloader.governor,
+                                               resume=resume)
+            if resume.count:
+                fmt = "Resuming after {} data objects"
+                log.info(fmt.format(resume.count))
+            async with contextlib.aclosing(json_objs):
+                i = 0
+                async for progress, obj_dict in json_objs:
+                    try:
+                        obj = class_(obj_dict, source_url=url)
+                    except Exception as e:
+                        log.exception(e)
+                        log.info(obj_dict)
+                        continue
+                    await self._put(obj)
+                    i += 1
+                    if (i % 1000) == 0:
+                        status(progress, resume.count)
+                    if data_limit and resume.count > data_limit:
+                        log.info("Hit data limit, breaking...")
+                        status(progress, resume.count)
+                        break
+            fmt = "Finished download of url: {} |{} MB"
+            log.info(fmt.format(url.url, progress[0]/2**20))
+            return True
+        except ContentChanged:
+            raise
+        except Exception as e:
+            log.exception(e)
+            log.warning("Error loading data from {}".format(url))
+            return False
+
+
 class Consumer:
-    commit_size = 10000
+    commit_bytes = 64 * 2**20  # commit once the database grows this much
+    commit_interval = 60  # seconds, or once this long has passed
+    check_size = 1000  # objects processed between checks of the size
+    checkpoint_size = 256 * 2**20  # checkpoint once the WAL is this big
+    checkpoint_interval = 600  # seconds, or once this long has passed
 
-    def __init__(self, queue, label="CS", states=None):
+    def __init__(self, queue, label="CS", states=None, shard=None,
+                 profile='safe', parquet=None, parquet_only=False):
+        """
+        Given a shard number, writes to that shard's database instead, to
+        be merged with the other shards later (see db.merge_shards).
+        profile is one of db.PROFILES. Given a directory, parquet writes
+        providers, drugs and plans to Parquet files there too (see
+        parquet_sink), and with parquet_only set, providers and drugs to
+        those alone.
+        """
         self.logger = init_logger("DL_{}".format(label))
         self.q = queue
-        self.conn = db.init_db()
+        self.shard = shard
+        self.fname = db.DB_FILE if shard is None else db.shard_path(shard)
+        self.conn = db.init_db(self.fname, profile)
+        self.page_size = self.conn.execute("PRAGMA page_size;").fetchone()[0]
+        self.commit_pages = 0  # database size at the last commit
+        self.committed = self.checkpointed = time.monotonic()
+        self.writer = db.BulkWriter(self.conn, on_error=self.logger.error)
         self.states = states
+        self.sink = None
+        if parquet is not None:
+            self.sink = parquet_sink.ParquetSink(parquet, shard, states)
+        self.parquet_only = parquet_only and self.sink is not None
 
         # Declare a few auxillary lookup tables
         self.facility_types = {}  # maps name(str) to idx
@@ -176,98 +472,266 @@ class Consumer:
         self.languages = {}  # maps name(str) to idx
         self.urls = {}  # maps url(str) to url_id
         self.plans = {}  # maps (id_issuer,id_plan) to idx_plan
+        self.pieces = {}  # maps url(str) to an object streamed in pieces
+        self.sources = {}  # maps a producer's vocabulary to its Dictionary
+        self.vocab = wire.Vocabulary()  # codes objects put here directly
+        self.local = wire.Dictionary()  # and their values
+        self.source = self.local  # the Dictionary of the rows at hand
         self.commit_obj_cnt = 0
+        self.unchecked = 0  # objects since the size was last checked
+        self.duplicates = 0  # providers listed identically before
+        self.purged = False  # providers were deleted, maybe their payloads
 
-    def _set_url(self, obj):
-        if obj.source_url:
-            obj.source_url.url_id = self.urls[obj.source_url.url]
-        else:
-            obj.source_url = models.IssuerGroupURL(None, "N/A",
-                                                   models.URLType.void, "")
+    def _url_id(self, url):
+        return None if url is None else self.urls[url]
+
+    def _encode(self, encoder, obj):
+        """
+        The row for an object put on the queue as is.
+        """
+        row = encoder(obj, self.vocab)
+        self.local.learn(self.vocab.take())
+        self.source = self.local
+        return row
+
+    def _learn(self, frame):
+        self.source = self.sources.get(frame.source)
+        if self.source is None:
+            self.source = self.sources[frame.source] = wire.Dictionary()
+        self.source.learn(frame.entries)
 
     def _process_issuer_group(self, issuer_group):
         id_ = issuer_group.idx_issuer_group
         self.logger.debug("Inserting Issuer Group: {}".format(id_))
         db.insert_issuer_group(self.conn, issuer_group)
+        if self.sink:
+            self.sink.add_issuer_group(issuer_group)
+
+    def _drop_pieces(self, url):
+        """
+        Forget, and delete, an object whose final piece never arrived.
+        """
+        if url in self.pieces:
+            state = self.pieces.pop(url)
+            idx, delete = state[0], state[2]
+            self.logger.warning("Dropping incomplete object from {}"
+                                .format(url))
+            self.writer.flush()
+            delete(self.conn, idx)
 
     def _process_url(self, url):
+        self._drop_pieces(url.url)
         if url.url in self.urls:
             url.url_id = self.urls[url.url]
             self.logger.debug("Updating URL: {}".format(url))
         else:
             self.logger.debug("Inserting URL: {}".format(url))
+        if url.status == "retrying" and url.url_id is not None:
+            self._purge_url(url)
         self.urls[url.url] = db.insert_data_url(self.conn, url)
+        if self.sink:
+            self.sink.url(url, self.urls[url.url])
+
+    def _purge_url(self, url):
+        """
+        Delete what was read from a URL whose download is starting over.
+        Plans need no purge, as they are only inserted once each.
+        """
+        purge = {models.URLType.prov: db.delete_url_providers,
+                 models.URLType.drug: db.delete_url_drugs}
+        if url.url_type in purge:
+            fmt = "Discarding objects already read from {}"
+            self.logger.warning(fmt.format(url.url))
+            self.writer.flush()
+            purge[url.url_type](self.conn, url.url_id)
+            self.purged = self.purged or url.url_type == models.URLType.prov
 
     def _process_issuer(self, issuer):
         self.logger.debug("Inserting Issuer: {}".format(issuer.id_issuer))
         db.insert_issuer(self.conn, issuer)
+        if self.sink:
+            self.sink.add_issuer(issuer)
 
     def _process_plan(self, plan):
-        self.logger.debug("Inserting Plan: {}".format(plan.marketing_name))
-        self._set_url(plan)
-        if (plan.id_issuer, plan.id_plan) not in self.plans:
-            idx_plan = db.insert_plan(self.conn, plan)
-            self.plans[(plan.id_issuer, plan.id_plan)] = idx_plan
+        self._process_plan_row(self._encode(wire.encode_plan, plan))
+
+    def _process_plan_row(self, row):
+        _, id_issuer, id_plan, id_type, name, summary_url, url = row
+        self.logger.debug("Inserting Plan: {}".format(name))
+        url_id = self._url_id(url)
+        if self.sink:
+            self.sink.add_plan(row)
+        if (id_issuer, id_plan) not in self.plans:
+            idx_plan = self.writer.insert_plan((id_plan, id_issuer, id_type,
+                                                name, summary_url, url_id))
+            self.plans[(id_issuer, id_plan)] = idx_plan
 
-    def _check_provider_in_state(self, prov):
+    def _check_provider_in_state(self, addresses):
         if not self.states:
             return True  # No states selected
-        for addr in prov.addresses:
-            if addr.state in self.states:
+        for addr in addresses:
+            if addr[2] in self.states:
                 return True
         return False
 
     def _process_provider(self, prov):
-        conn = self.conn
+        self._process_provider_row(self._encode(wire.encode_provider, prov))
+
+    def _process_provider_row(self, row):
+        (_, npi, name, last_updated_on, type_, accepting, _, _, _, plans,
+         addresses, hash_, piece, url) = row
         log = self.logger
-        log.debug("Inserting Provider: {},{}".format(prov.npi, prov.name))
-        if not self._check_provider_in_state(prov):
+        log.debug("Inserting Provider: {},{}".format(npi, name))
+        if self.sink:
+            self.sink.add_provider(self.source.decode_provider(row))
+            if self.parquet_only:
+                return
+        if piece is not None:
+            self._process_provider_piece(row)
+            return
+        if not self._check_provider_in_state(addresses):
             # drop provider if it has no addresses in specified states
             return
-        self._set_url(prov)
-        idx_prov = db.insert_provider(conn, prov)
-
-        for lang in prov.languages:
-            if lang not in self.languages:
-                self.languages[lang] = db.insert_language(conn, lang)
-            idx_lang = self.languages[lang]
-            db.insert_provider_language(conn, idx_prov, idx_lang)
-
-        for spec in prov.specialties:
-            if spec not in self.specialties:
-                self.specialties[spec] = db.insert_specialty(conn, spec)
-            idx_spec = self.specialties[spec]
-            db.insert_provider_specialty(conn, idx_prov, idx_spec)
-
-        for ft in prov.facility_types:
-            if ft not in self.facility_types:
-                self.facility_types[ft] = db.insert_facility_type(conn, ft)
-            idx_facil = self.facility_types[ft]
-            db.insert_provider_facility_type(conn, idx_prov, idx_facil)
-
-        for address in prov.addresses:
-            db.insert_address(conn, address, idx_prov)
-
-        for plan in prov.plans:
-            if (plan.id_issuer, plan.id_plan) not in self.plans:
-                p = models.Plan()
-                p.id_issuer = plan.id_issuer
-                p.id_plan = plan.id_plan
-                p.plan_id_type = "VOID"
-                self._process_plan(p)
-            idx_plan = self.plans[(plan.id_issuer, plan.id_plan)]
-            db.insert_provider_plan(conn, plan, idx_plan, idx_prov)
+        if last_updated_on is None:
+            raise ValueError("Provider {} has no last_updated_on".format(npi))
+        writer = self.writer
+        idx_payload = writer.find_payload(hash_)
+        if idx_payload is None:
+            idx_payload = writer.insert_payload(hash_, (name, type_,
+                                                        accepting))
+            self._insert_provider_details(row, idx_payload)
+        else:
+            self.duplicates += 1
+        idx_prov = writer.insert_provider((npi, idx_payload, last_updated_on,
+                                           self._url_id(url)))
+        self._insert_provider_plans(plans, idx_prov)
 
-    def _process_drug(self, drug):
+    def _process_provider_piece(self, row):
+        """
+        Providers too large to parse in one go arrive in pieces. The first
+        piece creates a placeholder row, and payload, that later pieces
+        attach their addresses, plans, etc. to, and the last piece fills
+        it in.
+        """
         conn = self.conn
+        (_, npi, name, last_updated_on, type_, accepting, _, _, _, plans,
+         addresses, _, (index, last), url) = row
+        url_id = self._url_id(url)
+        if index == 0:
+            self._drop_pieces(url)
+            idx_payload = self.writer.insert_payload_stub()
+            idx_prov = self.writer.insert_provider_stub(idx_payload, url_id)
+            self.pieces[url] = [idx_prov, False, db.delete_provider,
+                                idx_payload]
+        state = self.pieces[url]
+        idx_prov = state[0]
+        state[1] = state[1] or self._check_provider_in_state(addresses)
+        self._insert_provider_details(row, state[3])
+        self._insert_provider_plans(plans, idx_prov)
+        if not last:
+            return
+        del self.pieces[url]
+        self.writer.flush()
+        if not state[1]:
+            db.delete_provider(conn, idx_prov)
+            return
+        try:
+            if last_updated_on is None:
+                msg = "Provider {} has no last_updated_on"
+                raise ValueError(msg.format(npi))
+            db.update_provider(conn, (npi, name, last_updated_on, type_,
+                                      accepting), idx_prov)
+        except Exception:
+            db.delete_provider(conn, idx_prov)
+            raise
+
+    def _language_id(self, lang):
+        if lang not in self.languages:
+            self.languages[lang] = db.insert_language(self.conn, lang)
+        return self.languages[lang]
+
+    def _specialty_id(self, spec):
+        if spec not in self.specialties:
+            self.specialties[spec] = db.insert_specialty(self.conn, spec)
+        return self.specialties[spec]
+
+    def _facility_type_id(self, ft):
+        if ft not in self.facility_types:
+            self.facility_types[ft] = db.insert_facility_type(self.conn, ft)
+        return self.facility_types[ft]
+
+    def _provider_plan(self, plan):
+        id_issuer, id_plan, network_tier = plan
+        if (id_issuer, id_plan) not in self.plans:
+            self._process_plan_row((wire.PLAN, id_issuer, id_plan, "VOID",
+                                    None, None, None))
+        return self.plans[(id_issuer, id_plan)], network_tier
+
+    def _insert_provider_details(self, row, idx_payload):
+        writer = self.writer
+        resolve = self.source.resolve
+        languages, specialties, facility_types = row[6:9]
+        for idx_lang in resolve(wire.LANGUAGE, languages, self._language_id):
+            writer.insert_provider_language(idx_payload, idx_lang)
+
+        for idx_spec in resolve(wire.SPECIALTY, specialties,
+                                self._specialty_id):
+            writer.insert_provider_specialty(idx_payload, idx_spec)
+
+        for idx_facil in resolve(wire.FACILITY_TYPE, facility_types,
+                                 self._facility_type_id):
+            writer.insert_provider_facility_type(idx_payload, idx_facil)
+
+        for address in row[10]:
+            writer.insert_address(idx_payload, address)
+
+    def _insert_provider_plans(self, plans, idx_prov):
+        writer = self.writer
+        for idx_plan, network_tier in self.source.resolve(
+                wire.PROVIDER_PLAN, plans, self._provider_plan):
+            writer.insert_provider_plan(idx_prov, idx_plan, network_tier)
+
+    def _process_drug(self, drug):
+        self._process_drug_row(self._encode(wire.encode_drug, drug))
+
+    def _process_drug_row(self, row):
+        _, rxnorm_id, name, plans, piece, url = row
         log = self.logger
-        log.debug("Inserting Drug: {}".format(drug.name))
-        if not drug.rxnorm_id:
+        log.debug("Inserting Drug: {}".format(name))
+        if self.sink:
+            self.sink.add_drug(self.source.decode_drug(row))
+            if self.parquet_only:
+                return
+        if piece is not None:
+            self._process_drug_piece(row)
+            return
+        if not rxnorm_id:
+            return
+        idx_drug = self.writer.insert_drug((rxnorm_id, name,
+                                            self._url_id(url)))
+        for plan in self.source.decode(wire.DRUG_PLAN, plans):
+            self.writer.insert_drug_plan(idx_drug, plan)
+
+    def _process_drug_piece(self, row):
+        """ See _process_provider_piece """
+        conn = self.conn
+        _, rxnorm_id, name, plans, (index, last), url = row
+        url_id = self._url_id(url)
+        if index == 0:
+            self._drop_pieces(url)
+            idx_drug = self.writer.insert_drug_stub(url_id)
+            self.pieces[url] = [idx_drug, True, db.delete_drug]
+        idx_drug = self.pieces[url][0]
+        for plan in self.source.decode(wire.DRUG_PLAN, plans):
+            self.writer.insert_drug_plan(idx_drug, plan)
+        if not last:
+            return
+        del self.pieces[url]
+        self.writer.flush()
+        if not rxnorm_id:
+            db.delete_drug(conn, idx_drug)
             return
-        self._set_url(drug)
-        idx_drug = db.insert_drug(conn, drug)
-        for plan in drug.plans:
-            db.insert_drug_plan(conn, plan, idx_drug)
+        db.update_drug(conn, rxnorm_id, name, idx_drug)
 
     def run(self):
         log = self.logger
@@ -277,62 +741,270 @@ class Consumer:
                    models.Provider:         self._process_provider,
                    models.Plan:             self._process_plan,
                    models.Drug:             self._process_drug}
+        rows = {wire.PROVIDER: self._process_provider_row,
+                wire.DRUG:     self._process_drug_row,
+                wire.PLAN:     self._process_plan_row}
         while True:
-            obj = self.q.get()
+            try:
+                obj = self.q.get(timeout=self.commit_interval)
+            except QueueEmpty:
+                if self.commit_obj_cnt:
+                    self._commit()
+                continue
             if obj == "QUIT":
-                log.info("Finished downloading data. Creating indices...")
-                db.create_indices(self.conn)
-                self.conn.commit()
-                log.info("Finished creating indices.")
+                self.writer.flush()
+                log.info("{} providers shared the payload of an earlier "
+                         "one".format(self.duplicates))
+                if self.purged:
+                    db.delete_unused_payloads(self.conn)
+                if self.shard is None:
+                    log.info("Finished downloading data. "
+                             "Creating indices...")
+                    db.create_indices(self.conn)
+                    log.info("Finished creating indices.")
+                self._commit()
+                self._checkpoint()
                 self.conn.close()
+                if self.sink:
+                    self.sink.close()
                 break
+            elif type(obj) is wire.Frame:
+                self._learn(obj)
+                for item in obj:
+                    self._process(process, rows, item)
             else:
-                try:
-                    process[type(obj)](obj)
-                    self.commit_obj_cnt += 1
-                    if self.commit_obj_cnt >= self.commit_size:
-                        fmt = ("Successfully downloaded {} objects, "
-                               "commiting to db.")
-                        log.info(fmt.format(self.commit_obj_cnt))
-                        self.conn.commit()
-                        log.info("Finished commit.")
-                        self.commit_obj_cnt = 0
-                except Exception as e:
-                    log.exception(e)
+                self._process(process, rows, obj)
 
+    def _process(self, process, rows, obj):
+        try:
+            if type(obj) is tuple:
+                rows[obj[0]](obj)
+            else:
+                process[type(obj)](obj)
+            self.writer.tick()
+            self.commit_obj_cnt += 1
+            self.unchecked += 1
+            if self._commit_due():
+                self._commit()
+                if self._checkpoint_due():
+                    self._checkpoint()
+        except Exception as e:
+            self.logger.exception(e)
 
-def consume(q, states):
-    consumer = Consumer(q, states=states)
+    def _commit_due(self):
+        """
+        Commit by the time since the last commit, or by how much has been
+        written since, as measured by the growth of the database.
+        """
+        if time.monotonic() - self.committed >= self.commit_interval:
+            return True
+        if self.unchecked < self.check_size:
+            return False
+        self.unchecked = 0
+        pages = self.conn.execute("PRAGMA page_count;").fetchone()[0]
+        return (pages - self.commit_pages)*self.page_size >= self.commit_bytes
+
+    def _commit(self):
+        start = time.monotonic()
+        self.writer.flush()
+        pages = self.conn.execute("PRAGMA page_count;").fetchone()[0]
+        self.conn.commit()
+        if self.sink:
+            self.sink.sync()
+        self.committed = time.monotonic()
+        fmt = "Committed {} objects, {:.1f} MB, in {:.2f} s"
+        grown = (pages - self.commit_pages)*self.page_size
+        self.logger.info(fmt.format(self.commit_obj_cnt, grown/2**20,
+                                    self.committed - start))
+        self.commit_pages = pages
+        self.commit_obj_cnt = 0
+
+    def _checkpoint_due(self):
+        if time.monotonic() - self.checkpointed >= self.checkpoint_interval:
+            return True
+        try:
+            return os.path.getsize(self.fname + "-wal") >= self.checkpoint_size
+        except OSError:
+            return False
+
+    def _checkpoint(self):
+        """
+        Keep the WAL from growing without bound. Readers, such as
+        monitor_progress.sh, can hold up a checkpoint, in which case it is
+        tried again later.
+        """
+        try:
+            size = os.path.getsize(self.fname + "-wal")
+        except OSError:
+            size = 0
+        start = time.monotonic()
+        busy, frames, copied = db.checkpoint(self.conn)
+        self.checkpointed = time.monotonic()
+        elapsed = self.checkpointed - start
+        if busy:
+            fmt = ("Checkpoint held up by readers, copied {} of {} WAL "
+                   "frames in {:.2f} s")
+            self.logger.warning(fmt.format(copied, frames, elapsed))
+        else:
+            fmt = "Checkpointed {:.1f} MB of WAL in {:.2f} s"
+            self.logger.info(fmt.format(size/2**20, elapsed))
+
+
+class ShardQueue:
+    """
+    Stands in for the queue to a single Consumer, passing each object on
+    to the queue of the Consumer whose shard holds its issuer group.
+    """
+    def __init__(self, queues):
+        self.queues = queues
+
+    def _queue(self, obj):
+        idx = getattr(obj, 'idx_issuer_group', None)
+        if idx is None:
+            idx = getattr(getattr(obj, 'source_url', None),
+                          'idx_issuer_group', None)
+        return self.queues[(idx or 0) % len(self.queues)]
+
+    def put(self, obj, block=True, timeout=None):
+        self._queue(obj).put(obj, block, timeout)
+
+    def put_nowait(self, obj):
+        self._queue(obj).put_nowait(obj)
+
+    def flush(self):
+        for queue in self.queues:
+            queue.flush()
+
+
+def consume(q, states, shard=None, profile='safe', parquet=None,
+            parquet_only=False):
+    if shard is None:
+        consumer = Consumer(q, states=states, profile=profile,
+                            parquet=parquet, parquet_only=parquet_only)
+        fname = 'consumer.prof'
+    else:
+        consumer = Consumer(q, "CS{}".format(shard), states, shard, profile,
+                            parquet, parquet_only)
+        fname = 'consumer_{}.prof'.format(shard)
     if PROFILE_DB:
         import cProfile
-        cProfile.runctx('consumer.run()', globals(), locals(),
-                        'consumer.prof')
+        cProfile.runctx('consumer.run()', globals(), locals(), fname)
     else:
         consumer.run()
 
 
-def produce(args):
-    issuer_group, label = args
+def produce(url):
+    """
+    Download one data URL. Each worker process keeps a Downloader for its
+    whole life, so connections are reused from one URL to the next.
+    """
+    producer = produce.producer
+    if producer is None:
+        label = "W{}".format(mp.current_process().name.split('-')[-1])
+        producer = produce.producer = Downloader(None, produce.q, label)
+        util.Finalize(producer, producer.close, exitpriority=10)
+    if PROFILE_DOWNLOAD:
+        import cProfile
+        fname = "producer_{}.prof".format(producer.logger.name)
+        if produce.profile is None:
+            produce.profile = cProfile.Profile()
+        try:
+            url = produce.profile.runcall(producer.download_url, url)
+        finally:
+            produce.q.flush()
+        produce.profile.dump_stats(fname)
+        return url
+    try:
+        return producer.download_url(url)
+    finally:
+        produce.q.flush()
+
+
+def produce_index(args):
+    issuer_group, label, probe = args
     producer = Downloader(issuer_group, produce.q, label)
+    try:
+        if producer.run_index() and probe:
+            producer.probe_sizes()
+    finally:
+        produce.q.flush()
+        producer.close()
+    return issuer_group
+
+
+def produce_async(args):
+    issuer_groups, label = args
+    producer = AsyncDownloader(issuer_groups, produce.q, label)
     if PROFILE_DOWNLOAD:
         import cProfile
-        fname = "producer_{:02d}.prof".format(label)
+        fname = "producer_async_{:02d}.prof".format(label)
         cProfile.runctx('producer.run()', globals(), locals(), fname)
     else:
         producer.run()
+    produce.q.flush()
 
 
-def init_produce(q):
+def init_produce(q, governor, frame_size=None, frame_interval=None):
+    """
+    Objects are sent to the Consumer(s) in frames (see wire.FrameQueue).
+    """
+    if isinstance(q, ShardQueue):
+        q = ShardQueue([wire.FrameQueue(queue, frame_size, frame_interval)
+                        for queue in q.queues])
+    else:
+        q = wire.FrameQueue(q, frame_size, frame_interval)
     produce.q = q
+    Downloader.governor = governor
+    produce.producer = None
+    produce.profile = None
+
+
+class _ProducerProcess(mp.Process):
+    """
+    Pool processes are daemonic, and daemonic processes may not start
+    children of their own. Producers that split-parse files need to, so
+    they run in processes that never claim to be daemons.
+    """
+    @property
+    def daemon(self):
+        return False
+
+    @daemon.setter
+    def daemon(self, value):
+        pass
+
+
+class _ProducerContext(type(mp.get_context())):
+    Process = _ProducerProcess
 
 
 class Manager:
-    def __init__(self, cms_url, filters, num_processes=10):
+    def __init__(self, cms_url, filters, num_processes=10,
+                 split_processes=0, async_streams=0, http2=False,
+                 cache=None, host_streams=4, host_rate=2.0, spool=None,
+                 writers=1, db_profile='safe', frame_size=None,
+                 frame_interval=None, queue_bytes=512*2**20, parquet=None,
+                 parquet_only=False):
         self.logger = init_logger("MANAGER")
         self.cms_url = cms_url
         self.requested_issuer_ids = filters['issuer_ids']
         self.requested_states = filters['states']
         self.num_processes = num_processes
+        self.split_processes = split_processes
+        self.async_streams = async_streams
+        self.http2 = http2
+        self.cache = cache
+        self.host_streams = host_streams
+        self.host_rate = host_rate
+        self.spool = spool
+        self.writers = writers
+        self.db_profile = db_profile
+        self.frame_size = frame_size
+        self.frame_interval = frame_interval
+        self.queue_bytes = queue_bytes  # shared by the writers' queues
+        self.parquet = parquet  # directory to write Parquet files to
+        self.parquet_only = parquet_only
+        self.queues = []
 
     def _apply_filters(self):
         log = self.logger
@@ -369,7 +1041,7 @@ class Manager:
             nb = openpyxl.load_workbook(open(parse_result.path, 'rb'))
         else:  # Web URL
             log.info("Pulling CMS Spreadsheet from {}".format(self.cms_url))
-            with request.urlopen(self.cms_url) as f:
+            with http_get(self.cms_url, cache=self.cache) as f:
                 b = io.BytesIO(f.read())
             zf = zipfile.ZipFile(b)
             fname = zf.namelist()[0]
@@ -404,18 +1076,137 @@ class Manager:
             group_objs.append(issuer_group)
         self.issuer_groups = group_objs
 
+    def _run_async(self, pool, jobs):
+        """
+        Pull every index through the pool, then hand whole issuer groups to
+        one asyncio engine per process, balanced by number of data URLs.
+        """
+        AsyncDownloader.max_streams = self.async_streams
+        jobs = [(grp, i, False) for grp, i in jobs]
+        groups = [grp for grp in pool.map(produce_index, jobs)
+                  if grp.index_status == "finished"]
+        shares = [[] for _ in range(self.num_processes)]
+        groups.sort(key=lambda grp: len(grp.data_urls), reverse=True)
+        for grp in groups:
+            min(shares, key=lambda share: sum(len(grp.data_urls)
+                                              for grp in share)).append(grp)
+        self.logger.info("Downloading {} groups with {} async engines".format(
+            len(groups), sum(1 for share in shares if share)))
+        pool.map(produce_async, [(share, i)
+                                 for i, share in enumerate(shares) if share])
+
+    def _run_urls(self, pool, jobs):
+        """
+        Pull every index, then have the pool download the data URLs one at
+        a time, each going to whichever process is free, so that no process
+        sits idle while another works through a big issuer group. All plan
+        URLs go first, as providers and drugs refer to plans, and then the
+        rest, biggest (or unknown size) first.
+        """
+        log = self.logger
+        jobs = [(grp, i, True) for grp, i in jobs]
+        groups = [grp for grp in pool.map(produce_index, jobs)
+                  if grp.index_status == "finished"]
+        plan_urls = [url for grp in groups for url in grp.data_urls
+                     if url.url_type == models.URLType.plan]
+        data_urls = [url for grp in groups
+                     for url in data_urls_of(grp, Downloader.url_limit)]
+        data_urls.sort(key=lambda url: url.size if url.size >= 0
+                       else float('inf'), reverse=True)
+        for name, urls in (("plan", plan_urls), ("data", data_urls)):
+            n = len(urls)
+            log.info("Downloading {} {} URLs".format(n, name))
+            results = pool.imap_unordered(produce, urls)
+            for i, url in enumerate(results):
+                fmt = "Finished {} URL {}/{}: {}"
+                log.info(fmt.format(name, i+1, n, url))
+                self._log_queues()
+
+    def _log_queues(self):
+        fmt = ("Queue {}: {} objects, {:.1f} MB (peak {:.1f} MB), "
+               "producers blocked {} times for {:.1f} s")
+        for i, queue in enumerate(self.queues):
+            stats = queue.stats()
+            self.logger.info(fmt.format(i, stats['depth'],
+                                        stats['bytes']/2**20,
+                                        stats['peak']/2**20, stats['blocks'],
+                                        stats['blocked']))
+
     def run(self):
         self._find_issuer_groups()
         self._apply_filters()
-        q = mp.Queue(maxsize=1000)
-        proc_args = (q, self.requested_states)
-        consume_proc = mp.Process(target=consume, args=proc_args)
-        consume_proc.start()
-        pool = mp.Pool(self.num_processes, init_produce, [q])
-        pool.map(produce, [(grp, i)
-                           for i, grp in enumerate(self.issuer_groups)])
-        q.put("QUIT")
-        consume_proc.join()
+        # bounds the memory held by objects on their way to the writer(s)
+        budget = self.queue_bytes // max(1, self.writers)
+        if self.writers > 1:
+            # each writes a shard of the database, merged at the end
+            queues = [ByteBudgetQueue(budget) for _ in range(self.writers)]
+            consume_procs = [mp.Process(target=consume,
+                                        args=(queue, self.requested_states,
+                                              shard, self.db_profile,
+                                              self.parquet,
+                                              self.parquet_only))
+                             for shard, queue in enumerate(queues)]
+            q = ShardQueue(queues)
+        else:
+            queues = [ByteBudgetQueue(budget)]
+            consume_procs = [mp.Process(target=consume,
+                                        args=(queues[0],
+                                              self.requested_states,
+                                              None, self.db_profile,
+                                              self.parquet,
+                                              self.parquet_only))]
+            q = queues[0]
+        self.queues = queues
+        for consume_proc in consume_procs:
+            consume_proc.start()
+        Downloader.split_processes = self.split_processes
+        Downloader.http2 = self.http2
+        Downloader.cache = self.cache
+        Downloader.spool = self.spool
+        if self.split_processes > 1:
+            context = _ProducerContext()
+        else:
+            context = mp.get_context()
+        # paces the requests of all processes to each host
+        governor_manager = GovernorManager()
+        governor_manager.start()
+        governor = governor_manager.HostGovernor(self.host_streams,
+                                                 self.host_rate)
+        pool = context.Pool(self.num_processes, init_produce,
+                            [q, governor, self.frame_size,
+                             self.frame_interval])
+        jobs = [(grp, i) for i, grp in enumerate(self.issuer_groups)]
+        if self.async_streams and self.cache and self.cache.offline:
+            self.logger.warning("The async engine can't replay from the "
+                                "cache, downloading one URL at a time")
+            self._run_urls(pool, jobs)
+        elif self.async_streams:
+            self._run_async(pool, jobs)
+        else:
+            self._run_urls(pool, jobs)
+        pool.close()
+        pool.join()
+        self.logger.info("Host limits (streams, rate, active) at the end: "
+                         "{}".format(governor.stats()))
+        governor_manager.shutdown()
+        self._log_queues()
+        for queue in queues:
+            queue.put("QUIT")
+        for consume_proc in consume_procs:
+            consume_proc.join()
+        if self.writers > 1:
+            self._merge_shards()
+
+    def _merge_shards(self):
+        log = self.logger
+        paths = [db.shard_path(shard) for shard in range(self.writers)]
+        log.info("Merging {} shards into {}".format(len(paths), db.DB_FILE))
+        db.merge_shards(paths, profile=self.db_profile).close()
+        for path in paths:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        log.info("Finished merging shards.")
 
 
 def main():
@@ -433,11 +1224,95 @@ def main():
         help="Specify a list of specific states to download fulldata on")
     add('--processes', default=1, type=int,
         help="Set the number of processes to use in the full data pull")
+    add('--splitprocesses', default=0, type=int,
+        help=("Parse local (file:) data URLs in parallel with this many "
+              "processes per URL"))
+    add('--asyncstreams', default=0, type=int,
+        help=("Download data URLs on asyncio event loops instead, with up "
+              "to this many streams open per process"))
+    add('--http2', action='store_true',
+        help=("Multiplex each issuer group's downloads over HTTP/2 where "
+              "the server supports it. Needs httpx[http2] installed"))
+    add('--cachedir', default=None,
+        help=("Keep downloaded files in this directory, and only download "
+              "them again when they have changed"))
+    add('--cachesize', default=50, type=float,
+        help="Most GB to keep in the cache directory (default 50)")
+    add('--offline', action='store_true',
+        help=("Replay a previous run from the cache directory (default "
+              "data/cache) without downloading anything"))
+    add('--hoststreams', default=4, type=int,
+        help=("Most requests to have waiting on one host for a response "
+              "at once, over all processes (default 4). Lowered "
+              "automatically if the host throttles us. Responses being "
+              "read don't count"))
+    add('--hostrate', default=2.0, type=float,
+        help="Most requests to start per second against one host")
+    add('--spooldir', default=None,
+        help=("Download data files into this directory at full speed, "
+              "and parse them from there, so that slow parsing doesn't "
+              "hold up the connection"))
+    add('--spoolsize', default=4, type=float,
+        help="Most GB to use in the spool directory (default 4)")
+    add('--keepspool', action='store_true',
+        help=("Keep spooled files once parsed, deleting the oldest when "
+              "the spool directory is full"))
+    add('--spoolcomplete', action='store_true',
+        help=("Start parsing a spooled file once it is downloaded, rather "
+              "than while it downloads"))
+    add('--writers', default=1, type=int,
+        help=("Write the database with this many processes, each holding "
+              "a share of the issuer groups, and merge their work at the "
+              "end"))
+    add('--dbprofile', default='safe', choices=sorted(db.PROFILES),
+        help=("\"bulk\" writes the database several times faster, but "
+              "it may not survive a power loss. \"safe\" is the default"))
+    add('--queuemem', default=512, type=float,
+        help=("Most MB of objects to hold on their way to the database "
+              "writer(s), over all of them (default 512). Downloads wait "
+              "while it is full"))
+    add('--framesize', default=None, type=int,
+        help=("Send objects to the database writer(s) in batches of this "
+              "many (default {})".format(wire.FrameQueue.batch_size)))
+    add('--frameinterval', default=None, type=float,
+        help=("Most seconds an object waits for its batch to fill "
+              "(default {})".format(wire.FrameQueue.flush_interval)))
+    add('--parquet', default=None,
+        help=("Also write providers, drugs and plans to Parquet files in "
+              "this directory, partitioned by state and issuer group. "
+              "Needs pyarrow installed"))
+    add('--parquetonly', action='store_true',
+        help=("Write providers and drugs to the Parquet files alone, "
+              "leaving them out of the database"))
+    add('--rowgroupsize', default=None, type=int,
+        help=("Rows per row group of the Parquet files (default "
+              "{})".format(parquet_sink.ParquetSink.row_group_size)))
     args = parser.parse_args()
+    if args.parquet and parquet_sink.pa is None:
+        parser.error("--parquet needs pyarrow installed")
+    if args.parquetonly and not args.parquet:
+        parser.error("--parquetonly needs --parquet")
+    if args.rowgroupsize:
+        parquet_sink.ParquetSink.row_group_size = args.rowgroupsize
 
     filters = {'issuer_ids': args.issuerids,
                'states': [state.lower() for state in args.states]}
-    manager = Manager(args.cmsurl, filters, args.processes)
+    cache = None
+    if args.cachedir or args.offline:
+        cache = ResponseCache(args.cachedir or "data/cache",
+                              int(args.cachesize * 2**30), args.offline)
+    spool = None
+    if args.spooldir:
+        # each process spools on its own, so gets its share of the budget
+        size = int(args.spoolsize * 2**30) // max(1, args.processes)
+        spool = Spool(args.spooldir, size, args.keepspool,
+                      args.spoolcomplete)
+    manager = Manager(args.cmsurl, filters, args.processes,
+                      args.splitprocesses, args.asyncstreams, args.http2,
+                      cache, args.hoststreams, args.hostrate, spool,
+                      args.writers, args.dbprofile, args.framesize,
+                      args.frameinterval, int(args.queuemem * 2**20),
+                      args.parquet, args.parquetonly)
     manager.run()
 
 
@@ -1,3 +1,5 @@
+import re
+import functools
 from enum import IntEnum
 from datetime import date
 
@@ -5,8 +7,94 @@ from datetime import date
 def unique(xs):
     if xs is None:
         return set()
-    xs = [x.lower() for x in xs if type(x) == str]
-    return set(xs)
+    return {x.lower() for x in xs if type(x) == str}
+
+
+@functools.lru_cache(maxsize=4 * 1024)
+def parse_date(date_str):
+    """
+    The date of a "YYYY-MM-DD" string. Listings share a handful of dates,
+    so each is parsed, and held in memory, once.
+    """
+    year, month, day = map(int, date_str.split('-'))
+    return date(year=year, month=month, day=day)
+
+
+@functools.lru_cache(maxsize=64 * 1024)
+def split_plan_id(plan_id):
+    """
+    (id_issuer, id_plan) of a plan id, whose first 5 characters are the
+    issuer's id. Listings cite the same few plans over and over, so each
+    is split once.
+    """
+    return int(plan_id[:5]), plan_id[5:]
+
+
+# USPS abbreviations of the words most often spelled out in street lines
+_STREET_WORDS = {'street': 'st', 'avenue': 'ave', 'road': 'rd',
+                 'drive': 'dr', 'boulevard': 'blvd', 'lane': 'ln',
+                 'court': 'ct', 'place': 'pl', 'parkway': 'pkwy',
+                 'highway': 'hwy', 'circle': 'cir', 'square': 'sq',
+                 'terrace': 'ter', 'trail': 'trl', 'suite': 'ste',
+                 'building': 'bldg', 'floor': 'fl', 'room': 'rm',
+                 'apartment': 'apt', 'north': 'n', 'south': 's',
+                 'east': 'e', 'west': 'w', 'northeast': 'ne',
+                 'northwest': 'nw', 'southeast': 'se', 'southwest': 'sw'}
+_PUNCTUATION = re.compile(r"[.,;]")
+_NOT_DIGITS = re.compile(r"[^0-9]")
+# The same cities, streets, etc. recur across listings, so the normalized
+# form of each is remembered, and shared by the addresses that use it
+_normalized = functools.lru_cache(maxsize=64 * 1024)
+
+
+def _words(s):
+    return _PUNCTUATION.sub(' ', s.lower()).split()
+
+
+@_normalized
+def _street(s):
+    return ' '.join(_STREET_WORDS.get(w, w) for w in _words(s))
+
+
+@_normalized
+def _words_of(s):
+    return ' '.join(_words(s))
+
+
+@_normalized
+def _zip(s):
+    digits = _NOT_DIGITS.sub('', s)
+    return digits[:5] if len(digits) >= 5 else s.strip()
+
+
+@_normalized
+def _phone(s):
+    digits = _NOT_DIGITS.sub('', s)
+    if len(digits) == 11 and digits[0] == '1':
+        digits = digits[1:]
+    return digits or None
+
+
+def normalize_street(s):
+    return None if s is None else _street(str(s))
+
+
+def normalize_words(s):
+    return None if s is None else _words_of(str(s))
+
+
+def normalize_zip(s):
+    """
+    The 5 digit ZIP code, without any +4 extension.
+    """
+    return None if s is None else _zip(str(s))
+
+
+def normalize_phone(s):
+    """
+    The digits of a phone number, without a leading US country code.
+    """
+    return None if s is None else _phone(str(s))
 
 
 class Accepting(IntEnum):
@@ -19,10 +107,13 @@ class Accepting(IntEnum):
     def lookup(cls, accept_str):
         if accept_str is None:
             return cls.no_data
-        map_ = {'accepting': cls.accepting,
-                'not accepting': cls.not_accepting,
-                'accepting in some locations': cls.accepting_some_locations}
-        return map_.get(accept_str.lower(), cls.no_data)
+        return _ACCEPTING.get(accept_str.lower(), cls.no_data)
+
+
+_ACCEPTING = {'accepting': Accepting.accepting,
+              'not accepting': Accepting.not_accepting,
+              'accepting in some locations':
+                  Accepting.accepting_some_locations}
 
 
 class ProviderType(IntEnum):
@@ -34,11 +125,13 @@ class ProviderType(IntEnum):
     @classmethod
     def lookup(cls, provider_str):
         if provider_str is None:
-            return cls.no_data
-        map_ = {'facility': cls.facility,
-                'individual': cls.individual,
-                'group': cls.group}
-        return map_.get(provider_str.lower(), cls.no_type)
+            return cls.no_type
+        return _PROVIDER_TYPES.get(provider_str.lower(), cls.no_type)
+
+
+_PROVIDER_TYPES = {'facility': ProviderType.facility,
+                   'individual': ProviderType.individual,
+                   'group': ProviderType.group}
 
 
 class URLType(IntEnum):
@@ -49,11 +142,13 @@ class URLType(IntEnum):
 
     @classmethod
     def get_name(cls, type_):
-        type_map = {cls.plan: "Plan",
-                    cls.prov: "Provider",
-                    cls.drug: "Drug",
-                    cls.void: "Void"}
-        return type_map.get(type_)
+        return _URL_TYPE_NAMES.get(type_)
+
+
+_URL_TYPE_NAMES = {URLType.plan: "Plan",
+                   URLType.prov: "Provider",
+                   URLType.drug: "Drug",
+                   URLType.void: "Void"}
 
 
 class IssuerGroup:
@@ -66,12 +161,17 @@ class IssuerGroup:
 
 
 class IssuerGroupURL:
+    __slots__ = ('url_id', 'idx_issuer_group', 'url', 'url_type', 'status',
+                 'size', 'stalls')
+
     def __init__(self, idx, url, url_type, status=""):
         self.url_id = None
         self.idx_issuer_group = idx
         self.url = url
         self.url_type = url_type
         self.status = status
+        self.size = -1  # bytes, if known, used to schedule big files first
+        self.stalls = 0  # times the download slowed to a crawl
 
     def __str__(self):
         return "{}|{}|{}".format(self.url_id, self.status, self.url)
@@ -86,30 +186,33 @@ class Issuer:
 
 
 class Plan:
+    __slots__ = ('id_issuer', 'id_plan', 'plan_id_type', 'marketing_name',
+                 'summary_url', 'source_url')
+
     def __init__(self, plan_dict=None, source_url=None):
         if not plan_dict:
             self.id_issuer = None
             self.id_plan = None
-            self.id_plan_type = None
+            self.plan_id_type = None
             self.marketing_name = None
             self.summary_url = None
         else:
-            id_plan = plan_dict.get('plan_id')
-            self.id_issuer = int(id_plan[:5])
-            self.id_plan = id_plan[5:]
+            self.id_issuer, self.id_plan = split_plan_id(
+                plan_dict.get('plan_id'))
             self.plan_id_type = plan_dict.get('plan_id_type')
             self.marketing_name = plan_dict.get('marketing_name')
             self.summary_url = plan_dict.get('summary_url')
         self.source_url = source_url
 
 
-class Address():
-    def __init__(self, addr_dict=None):
-        def f(s):
-            if s is not None:
-                return s.lower()
-            return s
+class Address:
+    __slots__ = ('address', 'city', 'state', 'zip_', 'phone')
 
+    def __init__(self, addr_dict=None):
+        """
+        Addresses are normalized, so that the same location listed in
+        slightly different ways is stored once (see db.init_db).
+        """
         if addr_dict is None:
             self.address = None
             self.city = None
@@ -117,14 +220,18 @@ class Address():
             self.zip_ = None
             self.phone = None
         else:
-            self.address = f(addr_dict.get('address'))
-            self.city = f(addr_dict.get('city'))
-            self.state = f(addr_dict.get('state'))
-            self.zip_ = addr_dict.get('zip')
-            self.phone = addr_dict.get('phone')
+            self.address = normalize_street(addr_dict.get('address'))
+            self.city = normalize_words(addr_dict.get('city'))
+            self.state = normalize_words(addr_dict.get('state'))
+            self.zip_ = normalize_zip(addr_dict.get('zip'))
+            self.phone = normalize_phone(addr_dict.get('phone'))
 
 
 class Provider:
+    __slots__ = ('npi', 'type_', 'name', 'last_updated_on', 'accepting',
+                 'languages', 'specialties', 'facility_types', 'plans',
+                 'addresses', 'piece', 'source_url')
+
     def __init__(self, prov_dict=None, source_url=None):
         if prov_dict is None:
             self.npi = -1
@@ -154,44 +261,53 @@ class Provider:
             else:
                 self.name = None
             try:
-                date_str = prov_dict['last_updated_on']
-                year, month, day = map(int, date_str.split('-'))
-                self.last_updated_on = date(year=year, month=month, day=day)
+                self.last_updated_on = parse_date(
+                    prov_dict['last_updated_on'])
             except KeyError:
                 self.last_updated_on = None
             self.accepting = Accepting.lookup(prov_dict.get('accepting'))
-            self.languages = unique(prov_dict.get('languages', []))
-            self.specialties = set.union(unique(prov_dict.get('specialty')),
-                                         unique(prov_dict.get('speciality')))
-            self.facility_types = unique(prov_dict.get('facility_type', []))
-
-            def unique_plans(plan_dicts):
-                plans = {}
-                for p_dict in plan_dicts:
-                    p = ProviderPlan(p_dict)
-                    plans[(p.id_plan, p.network_tier)] = p
-                return list(plans.values())
-            self.plans = unique_plans(prov_dict.get('plans', []))
+            # tuples of the distinct values take a fraction of the memory
+            # of sets
+            self.languages = tuple(unique(prov_dict.get('languages', [])))
+            self.specialties = tuple(unique(prov_dict.get('specialty')) |
+                                     unique(prov_dict.get('speciality')))
+            self.facility_types = tuple(unique(prov_dict.get('facility_type',
+                                                             [])))
+            self.plans = _unique_plans(prov_dict.get('plans', []))
             self.addresses = [Address(addr_dict)
                               for addr_dict in prov_dict.get('addresses', [])]
+        # (index, last) if this is one piece of a streamed provider
+        self.piece = getattr(prov_dict, 'piece', None)
         self.source_url = source_url
 
 
+def _unique_plans(plan_dicts):
+    plans = {}
+    for p_dict in plan_dicts:
+        p = ProviderPlan(p_dict)
+        plans[(p.id_plan, p.network_tier)] = p
+    return list(plans.values())
+
+
 class ProviderPlan:
+    __slots__ = ('id_issuer', 'id_plan', 'id_plan_type', 'network_tier')
+
     def __init__(self, provplan_dict=None):
         if provplan_dict is None:
+            self.id_issuer = None
             self.id_plan = None
             self.id_plan_type = None
             self.network_tier = None
         else:
-            id_plan = provplan_dict.get('plan_id')
-            self.id_issuer = int(id_plan[:5])
-            self.id_plan = id_plan[5:]
+            self.id_issuer, self.id_plan = split_plan_id(
+                provplan_dict.get('plan_id'))
             self.id_plan_type = provplan_dict.get('plan_id_type')
             self.network_tier = provplan_dict.get('network_tier')
 
 
 class Drug:
+    __slots__ = ('rxnorm_id', 'name', 'plans', 'piece', 'source_url')
+
     def __init__(self, drug_dict=None, source_url=None):
         if drug_dict is None:
             self.rxnorm_id = None
@@ -202,10 +318,15 @@ class Drug:
             self.name = drug_dict.get('drug_name')
             self.plans = [DrugPlan(drugplan_dict)
                           for drugplan_dict in drug_dict.get('plans', [])]
+        # (index, last) if this is one piece of a streamed drug
+        self.piece = getattr(drug_dict, 'piece', None)
         self.source_url = source_url
 
 
 class DrugPlan:
+    __slots__ = ('id_plan', 'drug_tier', 'prior_authorization',
+                 'step_therapy', 'quantity_limit')
+
     def __init__(self, drugplan_dict=None):
         if drugplan_dict is None:
             self.id_plan = None
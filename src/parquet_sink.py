@@ -0,0 +1,337 @@
+"""
+Writes what the Consumer reads to Parquet files, as well as or instead of
+the sqlite database, for analyses that scan whole tables: they read only
+the columns they need, in large vectorized batches, with string columns
+dictionary encoded (categoricals, in pandas). Needs pyarrow.
+
+Listings of providers and drugs are written flattened, one directory per
+table, partitioned Hive style by state and issuer group:
+    <directory>/<table>/state=<state>/issuer_group=<idx>/<file>.parquet
+so that e.g. pyarrow.parquet.read_table("<directory>/address",
+filters=[("state", "=", "ia")]) reads Iowa's files alone. A provider is
+filed under each state it has an address in, and a drug under the state
+of each issuer whose plans list it, so a scan of several states can see
+the same listing more than once. The rows of one listing share its
+"listing" number. The issuer_group, issuer and url tables hold the same
+run and download status metadata as the database, one file per writer.
+"""
+import os
+import re
+import datetime
+
+try:  # Parquet output needs pyarrow
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+import models
+
+_EPOCH = datetime.date(1970, 1, 1).toordinal()
+_PARTITION_VALUE = re.compile(r'[a-z0-9_]+')
+
+# The columns of each table, and their types. "str" columns are
+# dictionary encoded.
+_TABLES = {
+    'provider': (('listing', 'int64'), ('npi', 'int64'), ('name', 'str'),
+                 ('type', 'int8'), ('accepting', 'int8'),
+                 ('last_updated_on', 'date32'), ('url', 'str')),
+    'address': (('listing', 'int64'), ('npi', 'int64'), ('address', 'str'),
+                ('city', 'str'), ('state', 'str'), ('zip', 'str'),
+                ('phone', 'str')),
+    'provider_language': (('listing', 'int64'), ('npi', 'int64'),
+                          ('language', 'str')),
+    'provider_specialty': (('listing', 'int64'), ('npi', 'int64'),
+                           ('specialty', 'str')),
+    'provider_facility_type': (('listing', 'int64'), ('npi', 'int64'),
+                               ('facility_type', 'str')),
+    'provider_plan': (('listing', 'int64'), ('npi', 'int64'),
+                      ('id_issuer', 'int64'), ('id_plan', 'str'),
+                      ('network_tier', 'str')),
+    'drug': (('listing', 'int64'), ('rxnorm_id', 'int64'),
+             ('drug_name', 'str'), ('url', 'str')),
+    'drug_plan': (('listing', 'int64'), ('rxnorm_id', 'int64'),
+                  ('id_plan', 'str'), ('drug_tier', 'str'),
+                  ('prior_authorization', 'bool'),
+                  ('step_therapy', 'bool'), ('quantity_limit', 'bool')),
+    'plan': (('id_issuer', 'int64'), ('id_plan', 'str'),
+             ('plan_id_type', 'str'), ('marketing_name', 'str'),
+             ('summary_url', 'str'), ('url', 'str')),
+    'issuer_group': (('idx_issuer_group', 'int64'), ('index_url', 'str'),
+                     ('index_status', 'str')),
+    'issuer': (('id_issuer', 'int64'), ('idx_issuer_group', 'int64'),
+               ('name', 'str'), ('state', 'str')),
+    'url': (('url_id', 'int64'), ('url', 'str'), ('url_type', 'str'),
+            ('idx_issuer_group', 'int64'), ('download_status', 'str'),
+            ('stalls', 'int64')),
+}
+
+
+def _type(name):
+    if name == 'str':
+        return pa.dictionary(pa.int32(), pa.string())
+    return getattr(pa, name + ('_' if name == 'bool' else ''))()
+
+
+def _schema(table):
+    return pa.schema([(column, _type(type_))
+                      for column, type_ in _TABLES[table]])
+
+
+def _flag(value):
+    if value is None or isinstance(value, bool):
+        return value
+    return str(value).lower() in ('true', 'yes', 'y', '1')
+
+
+def _table(rows, schema):
+    columns = list(zip(*rows)) or [()] * len(schema)
+    return pa.Table.from_arrays(
+        [pa.array(column, type=field.type.value_type).dictionary_encode()
+         if pa.types.is_dictionary(field.type)
+         else pa.array(column, type=field.type)
+         for column, field in zip(columns, schema)], schema=schema)
+
+
+def _partition(value):
+    value = str(value).lower()
+    return value if _PARTITION_VALUE.fullmatch(value) else 'unknown'
+
+
+class _Part:
+    """
+    The rows of one table read from one URL into one partition.
+    """
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        self.rows = []
+        self.writer = None
+
+    def write(self):
+        if not self.rows:
+            return
+        if self.writer is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.writer = pq.ParquetWriter(self.path, self.schema)
+        self.writer.write_table(_table(self.rows, self.schema))
+        self.rows = []
+
+    def close(self):
+        self.write()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def discard(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            os.remove(self.path)
+        self.rows = []
+
+
+class ParquetSink:
+    """
+    Takes the rows the Consumer reads (see wire), decoded, along with the
+    status of the URLs they come from, and writes them to Parquet files in
+    directory. Each URL's files are finished once the URL is, and started
+    over if its download is. Rows are written in row groups of
+    row_group_size, or smaller ones when more than max_buffered rows are
+    waiting over all files. states, if given, drops providers with no
+    address in them, as the Consumer does. Sinks of different writers
+    (shards) write to the same directory, each numbering its listings
+    apart from the others'.
+    """
+    row_group_size = 128 * 1024  # rows
+    max_buffered = 1024 * 1024  # rows
+
+    def __init__(self, directory, shard=None, states=None):
+        if pa is None:
+            raise RuntimeError("Writing Parquet files needs pyarrow")
+        self.directory = directory
+        self.shard = shard or 0
+        self.states = states
+        self.schemas = {table: _schema(table) for table in _TABLES}
+        self.parts = {}  # maps (url, table, state, group) to a _Part
+        self.buffered = 0
+        self.listing = self.shard << 40  # numbers listings
+        self.pieces = {}  # maps url(str) to the pieces read of an object
+        self.issuer_groups = {}
+        self.issuers = {}
+        self.urls = {}  # maps url(str) to (url_id, url, url_type, ...)
+        self.issuer_states = {}  # maps id_issuer to its state
+
+    def _add(self, url, table, state, row):
+        url_id, _, url_type, group = self.urls.get(url, (None,)*4)[:4]
+        key = (url, table, _partition(state), _partition(group))
+        part = self.parts.get(key)
+        if part is None:
+            name = "{}-{}-{}.parquet".format(self.shard, _partition(url_type),
+                                             _partition(url_id))
+            path = os.path.join(self.directory, table, "state=" + key[2],
+                                "issuer_group=" + key[3], name)
+            part = self.parts[key] = _Part(path, self.schemas[table])
+        part.rows.append(row)
+        self.buffered += 1
+        if len(part.rows) >= self.row_group_size:
+            self._write(part)
+        elif self.buffered >= self.max_buffered:
+            self._write(max(self.parts.values(),
+                            key=lambda part: len(part.rows)))
+
+    def _write(self, part):
+        self.buffered -= len(part.rows)
+        part.write()
+
+    def add_issuer_group(self, issuer_group):
+        self.issuer_groups[issuer_group.idx_issuer_group] = (
+            issuer_group.idx_issuer_group, issuer_group.index_url,
+            issuer_group.index_status)
+
+    def add_issuer(self, issuer):
+        self.issuers[issuer.id_issuer] = (
+            issuer.id_issuer, issuer.idx_issuer_group, issuer.name,
+            issuer.state)
+        self.issuer_states[issuer.id_issuer] = issuer.state
+
+    def url(self, url, url_id):
+        """
+        Record the status of a URL, whose files are started over if it is
+        being downloaded again, and finished once it is done with.
+        """
+        self.urls[url.url] = (url_id, url.url,
+                              models.URLType.get_name(url.url_type),
+                              url.idx_issuer_group, url.status, url.stalls)
+        self.pieces.pop(url.url, None)
+        if url.status not in ("retrying", "finished", "failed"):
+            return
+        for key in [key for key in self.parts if key[0] == url.url]:
+            part = self.parts.pop(key)
+            self.buffered -= len(part.rows)
+            if url.status == "retrying":
+                part.discard()
+            else:
+                part.close()
+
+    def add_plan(self, row):
+        _, id_issuer, id_plan, id_type, name, summary_url, url = row
+        if url is None:
+            return  # a placeholder for a plan that wasn't listed
+        self._add(url, 'plan', self.issuer_states.get(id_issuer),
+                  (id_issuer, id_plan, id_type, name, summary_url, url))
+
+    def _whole(self, row, merge):
+        """
+        Collect the pieces of a streamed object, and return it whole once
+        the last has arrived, else None.
+        """
+        (index, last), url = row[-2:]
+        if index == 0:
+            self.pieces[url] = []
+        pieces = self.pieces.get(url)
+        if pieces is None:
+            return None  # its first piece is missing
+        pieces.append(row)
+        if not last:
+            return None
+        del self.pieces[url]
+        return merge(pieces)
+
+    @staticmethod
+    def _merge_provider(pieces):
+        last = pieces[-1]
+        details = [tuple(item for piece in pieces for item in piece[i])
+                   for i in range(6, 11)]
+        return last[:6] + tuple(details) + (None, None, last[-1])
+
+    @staticmethod
+    def _merge_drug(pieces):
+        last = pieces[-1]
+        plans = tuple(plan for piece in pieces for plan in piece[3])
+        return last[:3] + (plans, None, last[-1])
+
+    def add_provider(self, row):
+        if row[-2] is not None:
+            row = self._whole(row, self._merge_provider)
+            if row is None:
+                return
+        (_, npi, name, last_updated_on, type_, accepting, languages,
+         specialties, facility_types, plans, addresses, _, _, url) = row
+        states = {address[2] for address in addresses}
+        if self.states and not states & set(self.states):
+            return
+        if last_updated_on is None:
+            return
+        self.listing += 1
+        listing = self.listing
+        add = self._add
+        for state in states or (None,):
+            add(url, 'provider', state,
+                (listing, npi, name, type_, accepting,
+                 last_updated_on - _EPOCH, url))
+            for address in addresses:
+                add(url, 'address', state,
+                    (listing, npi) + tuple(address[:5]))
+            for table, values in (('provider_language', languages),
+                                  ('provider_specialty', specialties),
+                                  ('provider_facility_type',
+                                   facility_types)):
+                for value in values:
+                    add(url, table, state, (listing, npi, value))
+            for id_issuer, id_plan, network_tier in plans:
+                add(url, 'provider_plan', state,
+                    (listing, npi, id_issuer, id_plan, network_tier))
+
+    def _plan_state(self, id_plan):
+        try:
+            id_issuer, _ = models.split_plan_id(str(id_plan))
+            return self.issuer_states.get(id_issuer)
+        except ValueError:
+            return None
+
+    def add_drug(self, row):
+        if row[-2] is not None:
+            row = self._whole(row, self._merge_drug)
+            if row is None:
+                return
+        _, rxnorm_id, name, plans, _, url = row
+        if not rxnorm_id:
+            return
+        self.listing += 1
+        listing = self.listing
+        states = {}
+        for plan in plans:
+            states.setdefault(self._plan_state(plan[0]), []).append(plan)
+        for state, plans in (states or {None: ()}).items():
+            self._add(url, 'drug', state, (listing, rxnorm_id, name, url))
+            for id_plan, tier, prior, step, quantity in plans:
+                self._add(url, 'drug_plan', state,
+                          (listing, rxnorm_id, id_plan, tier, _flag(prior),
+                           _flag(step), _flag(quantity)))
+
+    def _write_table(self, table, rows):
+        """
+        Replace this sink's file of a metadata table.
+        """
+        directory = os.path.join(self.directory, table)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "{}.parquet".format(self.shard))
+        pq.write_table(_table(list(rows), self.schemas[table]),
+                       path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def sync(self):
+        """
+        Write out the run and URL status metadata as it stands.
+        """
+        self._write_table('issuer_group', self.issuer_groups.values())
+        self._write_table('issuer', self.issuers.values())
+        self._write_table('url', self.urls.values())
+
+    def close(self):
+        for part in self.parts.values():
+            part.close()
+        self.parts.clear()
+        self.buffered = 0
+        self.sync()
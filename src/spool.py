@@ -0,0 +1,206 @@
+"""
+Spools response bodies to local files as fast as the network delivers
+them, so that a slow parse or a full queue downstream doesn't stall the
+connection until the server gives up on it.
+"""
+import os
+import re
+import hashlib
+import threading
+import itertools
+import collections
+
+_MB = 1024 * 1024
+_BLOCK_SIZE = 1 * _MB  # bytes read off the network at a time
+_SEGMENT_SIZE = 64 * _MB  # bytes per spool file
+_SEGMENT_NAME = re.compile(r'[0-9a-f]{12}-[0-9]+-[0-9]+\.[0-9]{4}')
+
+
+class SpooledResponse:
+    """
+    A response whose body is copied to disk by a thread of its own, and
+    read back from there, with the interface of an HTTP response. Reads
+    wait for the body to arrive as needed. An error met downloading is
+    raised once the bytes spooled before it have been read.
+    """
+    def __init__(self, spool, url, raw):
+        self.spool = spool
+        self.raw = raw
+        self.url = getattr(raw, 'url', url)
+        self.status = getattr(raw, 'status', 200)
+        self.reason = getattr(raw, 'reason', '')
+        self.headers = raw.headers
+        self.name = "{}-{}-{}".format(
+            hashlib.sha1(url.encode('utf8')).hexdigest()[:12], os.getpid(),
+            next(spool.count))
+        self.written = 0  # bytes spooled
+        self.pos = 0  # bytes read back
+        self.done = False  # the spooling thread has finished
+        self.closed = False
+        self.error = None
+        self.started = False  # reading back has begun
+        self.segment = None  # the file being read back
+        self.thread = threading.Thread(target=self._spool, daemon=True)
+        self.thread.start()
+
+    def info(self):
+        return self.headers
+
+    def _path(self, index):
+        return os.path.join(self.spool.directory,
+                            "{}.{:04d}".format(self.name, index))
+
+    def _spool(self):
+        spool = self.spool
+        size = spool.segment_size
+        out = None
+        try:
+            while True:
+                with spool.cond:
+                    spool.cond.wait_for(lambda: self.closed or spool._room())
+                    if self.closed:
+                        break
+                index, offset = divmod(self.written, size)
+                b = self.raw.read(min(_BLOCK_SIZE, size - offset))
+                if not b:
+                    break
+                if out is None:
+                    out = open(self._path(index), 'wb')
+                out.write(b)
+                out.flush()
+                if offset + len(b) == size:
+                    out.close()
+                    out = None
+                with spool.cond:
+                    self.written += len(b)
+                    spool.used += len(b)
+                    spool.cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            if out is not None:
+                out.close()
+            self.raw.close()
+            with spool.cond:
+                self.done = True
+                spool.cond.notify_all()
+                last = self.closed
+            if last:
+                self._dispose()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(_BLOCK_SIZE), b''))
+        spool = self.spool
+        with spool.cond:
+            if spool.complete and not self.started:
+                # unless the budget runs out first
+                spool.cond.wait_for(lambda: self.done or not spool._room())
+                self.started = True
+            spool.cond.wait_for(lambda: self.done or self.written > self.pos)
+            available = self.written - self.pos
+            if not available and self.error is not None:
+                raise self.error
+        if not available or size == 0:
+            return b''
+        index, offset = divmod(self.pos, spool.segment_size)
+        if self.segment is None:
+            self.segment = open(self._path(index), 'rb')
+        b = self.segment.read(min(size, available,
+                                  spool.segment_size - offset))
+        self.pos += len(b)
+        if offset + len(b) == spool.segment_size:
+            self.segment.close()
+            self.segment = None
+            spool._retire(self._path(index), spool.segment_size)
+        return b
+
+    def _dispose(self):
+        """
+        Retire the segments not already read through, once both the
+        reader and the spooling thread are done with them.
+        """
+        size = self.spool.segment_size
+        for index in range(self.pos // size, -(-self.written // size)):
+            self.spool._retire(self._path(index),
+                               min(size, self.written - index*size))
+
+    def close(self):
+        spool = self.spool
+        with spool.cond:
+            if self.closed:
+                return
+            self.closed = True
+            spool.cond.notify_all()
+            last = self.done
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+        if last:
+            self._dispose()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Spool:
+    """
+    Hands out SpooledResponses, which download into segment files of
+    segment_size bytes in directory. Segments are deleted once read, or
+    with keep set, retained until the oldest have to be rotated out to
+    stay within max_size bytes. Downloads wait while the spooled bytes
+    still to be read fill the budget. Reads start as soon as there is
+    something to read, or with complete set, once the whole body is on
+    disk (or the budget is full). The budget is per process, and files
+    left in directory by an earlier run are removed.
+    """
+    def __init__(self, directory="data/spool", max_size=1024*_MB,
+                 keep=False, complete=False, segment_size=_SEGMENT_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.keep = keep
+        self.complete = complete
+        # two segments fit, so one can be read while the next is written
+        self.segment_size = max(1, min(segment_size, max_size // 2))
+        self.used = 0  # bytes on disk
+        self.retired = collections.deque()  # kept segments, oldest first
+        self.count = itertools.count()
+        self.cond = threading.Condition()
+        os.makedirs(directory, exist_ok=True)
+        with os.scandir(directory) as it:
+            for entry in it:
+                if _SEGMENT_NAME.fullmatch(entry.name):
+                    os.remove(entry.path)
+
+    def wrap(self, url, raw):
+        """
+        Spool the body of raw, a response to a GET of url. Responses that
+        have no body to speak of are returned as they are.
+        """
+        if getattr(raw, 'status', 200) not in (200, 206):
+            return raw
+        return SpooledResponse(self, url, raw)
+
+    def _room(self):
+        # called holding cond
+        while self.used >= self.max_size and self.retired:
+            self._remove(*self.retired.popleft())
+        return self.used < self.max_size
+
+    def _remove(self, path, size):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        self.used -= size
+
+    def _retire(self, path, size):
+        with self.cond:
+            if self.keep:
+                self.retired.append((path, size))
+            else:
+                self._remove(path, size)
+            self.cond.notify_all()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Measure how fast models are built from the objects in a data file, and
+how much memory each takes, counting what it holds (addresses, plans,
+etc.) but not the parsed JSON it was built from.
+
+    ./bench_models.py file:/path/to/providers.json --type provider
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from json_list_parser import json_list_parser  # noqa: E402
+import models  # noqa: E402
+
+CLASSES = {'provider': models.Provider,
+           'drug':     models.Drug,
+           'plan':     models.Plan}
+
+
+def build(class_, obj_dicts):
+    start = time.perf_counter()
+    objs = [class_(obj_dict) for obj_dict in obj_dicts]
+    return objs, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    add = parser.add_argument
+    add('url', help='url of the data file, e.g. "file:/path/to/file"')
+    add('--type', default='provider', choices=sorted(CLASSES),
+        help='kind of objects held in the file')
+    add('--limit', default=100000, type=int,
+        help='build the first this many objects (default 100000)')
+    add('--repeat', default=5, type=int,
+        help='time the best of this many builds (default 5)')
+    args = parser.parse_args()
+
+    class_ = CLASSES[args.type]
+    obj_dicts = []
+    for _, obj_dict in json_list_parser(args.url):
+        obj_dicts.append(obj_dict)
+        if len(obj_dicts) >= args.limit:
+            break
+    count = len(obj_dicts)
+    elapsed = min(build(class_, obj_dicts)[1] for _ in range(args.repeat))
+    tracemalloc.start()
+    objs, _ = build(class_, obj_dicts)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    fmt = ("{} {} objects: {:.2f} s, {:.0f} objects/sec, "
+           "{:.0f} bytes/object")
+    print(fmt.format(count, class_.__name__, elapsed, count/elapsed,
+                     size/len(objs)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Measure json_list_parser throughput, in objects/sec, on a data file, both
+parsing alone and building the models from what it parses.
+
+    ./bench_parser.py file:/path/to/providers.json --type provider
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from json_list_parser import json_list_parser  # noqa: E402
+import models  # noqa: E402
+
+CLASSES = {'provider': models.Provider,
+           'drug':     models.Drug,
+           'plan':     models.Plan}
+
+
+def bench(url, class_, build, limit):
+    count = 0
+    start = time.perf_counter()
+    for _, obj_dict in json_list_parser(url):
+        if build:
+            class_(obj_dict)
+        count += 1
+        if limit and count >= limit:
+            break
+    elapsed = time.perf_counter() - start
+    return count, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    add = parser.add_argument
+    add('url', help='url of the data file, e.g. "file:/path/to/file"')
+    add('--type', default='provider', choices=sorted(CLASSES),
+        help='kind of objects held in the file')
+    add('--limit', default=0, type=int,
+        help='stop after this many objects')
+    args = parser.parse_args()
+
+    class_ = CLASSES[args.type]
+    fmt = "{:<6} {:>10} objects {:>8.2f} s {:>10.0f} objects/sec"
+    for build in (False, True):
+        count, elapsed = bench(args.url, class_, build, args.limit)
+        print(fmt.format("build" if build else "parse",
+                         count, elapsed, count/elapsed))
+
+
+if __name__ == '__main__':
+    main()
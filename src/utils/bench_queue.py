@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Measure how many objects/sec get from a producer to a consuming process
+through a multiprocessing Queue, sent one model object at a time as
+before, and in frames of rows (see wire.FrameQueue).
+
+    ./bench_queue.py file:/path/to/providers.json --type provider
+"""
+import os
+import sys
+import time
+import argparse
+import multiprocessing as mp
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from json_list_parser import json_list_parser  # noqa: E402
+import models  # noqa: E402
+import wire  # noqa: E402
+
+CLASSES = {'provider': models.Provider,
+           'drug':     models.Drug,
+           'plan':     models.Plan}
+
+
+def consume(q, results):
+    count = 0
+    while True:
+        obj = q.get()
+        if obj == "QUIT":
+            break
+        count += len(obj) if type(obj) is wire.Frame else 1
+    results.put((count, time.perf_counter()))
+
+
+def bench(objs, frame_size):
+    q = mp.Queue(maxsize=1000)
+    results = mp.Queue()
+    consumer = mp.Process(target=consume, args=(q, results))
+    consumer.start()
+    start = time.perf_counter()
+    if frame_size:
+        fq = wire.FrameQueue(q, frame_size, float('inf'))
+        for obj in objs:
+            fq.put(obj)
+        fq.flush()
+    else:
+        for obj in objs:
+            q.put(obj)
+    q.put("QUIT")
+    put = time.perf_counter() - start
+    count, end = results.get()
+    consumer.join()
+    return count, put, end - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    add = parser.add_argument
+    add('url', help='url of the data file, e.g. "file:/path/to/file"')
+    add('--type', default='provider', choices=sorted(CLASSES),
+        help='kind of objects held in the file')
+    add('--limit', default=100000, type=int,
+        help='send the first this many objects (default 100000)')
+    add('--framesizes', default=[100, 500, 2000], nargs='+', type=int,
+        help='frame sizes to try')
+    args = parser.parse_args()
+
+    class_ = CLASSES[args.type]
+    objs = []
+    for _, obj_dict in json_list_parser(args.url):
+        objs.append(class_(obj_dict))
+        if len(objs) >= args.limit:
+            break
+    fmt = ("{:<12} {:>10} objects {:>8.2f} s put {:>8.2f} s "
+           "{:>10.0f} objects/sec")
+    for frame_size in [0] + args.framesizes:
+        count, put, elapsed = bench(objs, frame_size)
+        label = "frames {}".format(frame_size) if frame_size else "objects"
+        print(fmt.format(label, count, put, elapsed, count/elapsed))
+
+
+if __name__ == '__main__':
+    main()
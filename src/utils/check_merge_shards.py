@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Check that db.merge_shards keeps a plan listed by one shard over the
+"VOID" placeholder another shard made for it, whichever shard comes first.
+Works in a scratch directory, which it deletes.
+
+    ./check_merge_shards.py
+"""
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import db  # noqa: E402
+
+REAL = ('IA0010001', 11111, 'HIOS-PLAN-ID', 'Gold Plan', 'http://sbc')
+
+
+def make_shard(fname, idx_issuer_group, real):
+    conn = db.init_db(fname)
+    conn.execute("INSERT INTO IssuerGroup "
+                 "(idx_issuer_group, index_url, index_status) "
+                 "VALUES (?, ?, 'finished');",
+                 (idx_issuer_group, 'http://index{}'.format(idx_issuer_group)))
+    conn.execute("INSERT INTO PlanURL "
+                 "(url_id, url, idx_issuer_group, download_status) "
+                 "VALUES (1, ?, ?, 'finished');",
+                 ('http://plans{}'.format(idx_issuer_group),
+                  idx_issuer_group))
+    if real:
+        conn.execute("INSERT INTO Plan (idx_plan, id_plan, id_issuer, "
+                     "plan_id_type, marketing_name, summary_url, "
+                     "source_url_id) VALUES (1, ?, ?, ?, ?, ?, 1);", REAL)
+    else:
+        conn.execute("INSERT INTO Plan (idx_plan, id_plan, id_issuer, "
+                     "plan_id_type) VALUES (1, ?, ?, 'VOID');", REAL[:2])
+    conn.commit()
+    conn.close()
+
+
+def check(real_first):
+    paths = ['shard0.sqlite3', 'shard1.sqlite3']
+    make_shard(paths[0], 0, real_first)
+    make_shard(paths[1], 1, not real_first)
+    conn = db.merge_shards(paths, 'merged.sqlite3')
+    plans = conn.execute("SELECT id_plan, id_issuer, plan_id_type, "
+                         "marketing_name, summary_url, url "
+                         "FROM Plan LEFT JOIN PlanURL "
+                         "ON (source_url_id=url_id);").fetchall()
+    conn.close()
+    real_shard = 0 if real_first else 1
+    expected = [REAL + ('http://plans{}'.format(real_shard),)]
+    assert plans == expected, plans
+
+
+def main():
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    try:
+        os.chdir(directory)
+        for real_first in (True, False):
+            check(real_first)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Check that split_json_list_parser gives the same providers as
+json_list_parser on a file whose cut points mostly fall inside nested
+arrays (plans and addresses), and that its parent process re-parses
+hardly any of it. Works in a scratch directory, which it deletes.
+
+    ./check_split_parser.py --providers 5000 --processes 4
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from json_list_parser import (json_list_parser,  # noqa: E402
+                              split_json_list_parser)
+import models  # noqa: E402
+
+
+def provider(i, plans):
+    return {"npi": 1000000000 + i, "type": "INDIVIDUAL",
+            "name": {"first": "First{}".format(i), "last": "Last"},
+            "addresses": [{"address": "{} Main Street".format(j),
+                           "city": "Des Moines", "state": "IA",
+                           "zip": "50309", "phone": "5155550100"}
+                          for j in range(3)],
+            "specialty": ["Family Medicine"], "accepting": "accepting",
+            "plans": [{"plan_id_type": "HIOS-PLAN-ID",
+                       "plan_id": "{:05d}IA{:07d}".format(10000 + j % 7, j),
+                       "network_tier": "PREFERRED"}
+                      for j in range(plans)],
+            "languages": ["English"], "last_updated_on": "2017-01-01"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    add = parser.add_argument
+    add('--providers', default=5000, type=int,
+        help='providers in the file (default 5000)')
+    add('--plans', default=40, type=int,
+        help='plans listed by each provider (default 40)')
+    add('--processes', default=2, type=int,
+        help='worker processes (default 2)')
+    add('--splitsize', default=256*1024, type=int,
+        help='bytes per range (default 256k)')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "providers.json")
+        with open(path, 'w') as f:
+            f.write('[')
+            for i in range(args.providers):
+                if i:
+                    f.write(',\n')
+                f.write(json.dumps(provider(i, args.plans)))
+            f.write(']\n')
+        size = os.path.getsize(path)
+        url = "file:" + path
+
+        start = time.perf_counter()
+        expected = [models.Provider(obj_dict).npi
+                    for _, obj_dict in json_list_parser(url)]
+        serial = time.perf_counter() - start
+        stats = {}
+        start = time.perf_counter()
+        npis = [obj.npi for _, obj in
+                split_json_list_parser(url, models.Provider, args.processes,
+                                       split_size=args.splitsize,
+                                       stats=stats)]
+        split = time.perf_counter() - start
+    finally:
+        shutil.rmtree(directory)
+
+    print("{} bytes in {} ranges, {} bytes re-parsed by the parent"
+          .format(size, stats["ranges"], stats["reparsed"]))
+    print("json_list_parser {:.2f} s, split_json_list_parser {:.2f} s"
+          .format(serial, split))
+    assert npis == expected, "the providers differ"
+    assert stats["reparsed"] < 0.01 * size, "too much was re-parsed"
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
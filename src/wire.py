@@ -0,0 +1,317 @@
+"""
+The format objects are sent from the producers to the Consumer in. Rather
+than pickling every model, with its nested addresses and plans, as an
+object graph of its own, producers encode each one as a row of plain
+tuples, and send the rows in Frames of many at a time. The Consumer
+unpickles a whole Frame in one go and works on the rows directly.
+
+The values that recur across millions of listings, such as languages and
+plans, are sent as codes, small ints numbered by the producer's
+Vocabulary. Each value is sent once, with the first Frame to use it, and
+the Consumer keeps a Dictionary of them per producer.
+
+Rows, by their first element:
+    (PROVIDER, npi, name, last_updated_on, type, accepting, languages,
+     specialties, facility_types, plans, addresses, hash, piece, url)
+        last_updated_on is a date ordinal, languages, specialties and
+        facility_types are codes of LANGUAGE, SPECIALTY and FACILITY_TYPE
+        strings, plans codes of PROVIDER_PLAN (id_issuer, id_plan,
+        network_tier), and addresses (address, city, state, zip, phone,
+        hash), see location_hash. hash identifies the provider's
+        payload, see payload_hash
+    (DRUG, rxnorm_id, name, plans, piece, url)
+        plans are codes of DRUG_PLAN (id_plan, drug_tier,
+        prior_authorization, step_therapy, quantity_limit)
+    (PLAN, id_issuer, id_plan, plan_id_type, marketing_name, summary_url,
+     url)
+piece is (index, last) for a piece of a streamed object, else None, and
+url is that of the source URL, or None.
+"""
+import time
+import uuid
+import hashlib
+import threading
+from queue import Full as QueueFull
+
+import models
+
+PROVIDER = 0
+DRUG = 1
+PLAN = 2
+
+# kinds of coded values
+LANGUAGE = 0
+SPECIALTY = 1
+FACILITY_TYPE = 2
+PROVIDER_PLAN = 3
+DRUG_PLAN = 4
+_KINDS = 5
+
+
+class Frame(list):
+    """
+    A batch of rows, and of the odd object that isn't sent as a row, from
+    the Vocabulary named source, with the (kind, value)s it numbered since
+    the previous Frame.
+    """
+    def __init__(self, source=None, entries=None):
+        super().__init__()
+        self.source = source
+        self.entries = [] if entries is None else entries
+
+
+class Vocabulary:
+    """
+    Numbers the distinct values of each kind that a producer sends, in
+    the order it first sees them.
+    """
+    def __init__(self):
+        self.name = uuid.uuid4().hex  # unique over producer processes
+        self.codes = [{} for _ in range(_KINDS)]
+        self.entries = []  # (kind, value)s numbered since the last take
+
+    def encode(self, kind, values):
+        codes = self.codes[kind]
+        out = []
+        for value in values:
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(codes)
+                self.entries.append((kind, value))
+            out.append(code)
+        return tuple(out)
+
+    def take(self):
+        """
+        The (kind, value)s numbered since the last take, to send on.
+        """
+        entries, self.entries = self.entries, []
+        return entries
+
+
+class Dictionary:
+    """
+    The values a Vocabulary numbered, as the Consumer learns them, and
+    what the Consumer resolved them to, e.g. database ids.
+    """
+    def __init__(self):
+        self.values = [[] for _ in range(_KINDS)]
+        self.resolved = [[] for _ in range(_KINDS)]
+
+    def learn(self, entries):
+        for kind, value in entries:
+            self.values[kind].append(value)
+            self.resolved[kind].append(None)
+
+    def decode(self, kind, codes):
+        values = self.values[kind]
+        return tuple([values[code] for code in codes])
+
+    def resolve(self, kind, codes, resolver):
+        """
+        What resolver makes of the value of each code, calling it once
+        per value. It mustn't return None.
+        """
+        values = self.values[kind]
+        resolved = self.resolved[kind]
+        out = []
+        for code in codes:
+            r = resolved[code]
+            if r is None:
+                r = resolved[code] = resolver(values[code])
+            out.append(r)
+        return out
+
+    def decode_provider(self, row):
+        """
+        row with its values in place of their codes.
+        """
+        decode = self.decode
+        return row[:6] + (decode(LANGUAGE, row[6]),
+                          decode(SPECIALTY, row[7]),
+                          decode(FACILITY_TYPE, row[8]),
+                          decode(PROVIDER_PLAN, row[9])) + row[10:]
+
+    def decode_drug(self, row):
+        return row[:3] + (self.decode(DRUG_PLAN, row[3]),) + row[4:]
+
+
+def _url(obj):
+    return obj.source_url.url if obj.source_url else None
+
+
+def _distinct(items):
+    # in an order that doesn't depend on the order they were listed in
+    return tuple(sorted(set(items), key=repr))
+
+
+def _hash(values):
+    return hashlib.blake2b(repr(values).encode('utf8'),
+                           digest_size=16).digest()
+
+
+def location_hash(address, city, state, zip_, phone):
+    """
+    A hash of a normalized address (see models.Address), identifying the
+    Location it is stored as.
+    """
+    return _hash((address, city, state, zip_, phone))
+
+
+def payload_hash(name, type_, accepting, languages, specialties,
+                 facility_types, addresses):
+    """
+    A hash of what a provider listing says about the provider, other than
+    its npi, plans and date, given distinct details in a fixed order.
+    Identical listings from different issuers or URLs hash the same.
+    """
+    return _hash((name, type_, accepting, languages, specialties,
+                  facility_types, addresses))
+
+
+def encode_provider(prov, vocab):
+    updated = prov.last_updated_on
+    name = prov.name
+    type_ = int(prov.type_)
+    accepting = int(prov.accepting)
+    languages = _distinct(prov.languages)
+    specialties = _distinct(prov.specialties)
+    facility_types = _distinct(prov.facility_types)
+    addresses = _distinct([(a.address, a.city, a.state, a.zip_, a.phone,
+                            location_hash(a.address, a.city, a.state,
+                                          a.zip_, a.phone))
+                           for a in prov.addresses])
+    hash_ = None  # pieces are only whole once they reach the Consumer
+    if prov.piece is None:
+        hash_ = payload_hash(name, type_, accepting, languages, specialties,
+                             facility_types, addresses)
+    encode = vocab.encode
+    return (PROVIDER, prov.npi, name,
+            updated.toordinal() if updated is not None else None,
+            type_, accepting, encode(LANGUAGE, languages),
+            encode(SPECIALTY, specialties),
+            encode(FACILITY_TYPE, facility_types),
+            encode(PROVIDER_PLAN, [(p.id_issuer, p.id_plan, p.network_tier)
+                                   for p in prov.plans]),
+            addresses, hash_, prov.piece, _url(prov))
+
+
+def encode_drug(drug, vocab):
+    return (DRUG, drug.rxnorm_id, drug.name,
+            vocab.encode(DRUG_PLAN,
+                         [(p.id_plan, p.drug_tier, p.prior_authorization,
+                           p.step_therapy, p.quantity_limit)
+                          for p in drug.plans or ()]),
+            drug.piece, _url(drug))
+
+
+def encode_plan(plan, vocab):
+    return (PLAN, plan.id_issuer, plan.id_plan, plan.plan_id_type,
+            plan.marketing_name, plan.summary_url, _url(plan))
+
+
+_ENCODERS = {models.Provider: encode_provider,
+             models.Drug:     encode_drug,
+             models.Plan:     encode_plan}
+
+
+def encode(obj, vocab):
+    """
+    The row for obj, with the values it uses numbered by vocab, or obj
+    itself if it isn't sent as a row.
+    """
+    encoder = _ENCODERS.get(type(obj))
+    return obj if encoder is None else encoder(obj, vocab)
+
+
+class FrameQueue:
+    """
+    Stands in for the queue to the Consumer, encoding what is put in it
+    and passing it on in Frames. A Frame is sent once it holds batch_size
+    rows, once flush_interval seconds have passed since the last one was
+    sent, and straight after anything that isn't a row, such as a URL's
+    status, so that the Consumer sees those promptly and in order. The
+    interval is kept by a timer thread, so rows don't wait on a stream
+    that has stalled or slowed to a trickle. Call flush when done putting
+    for now, e.g. at the end of each URL.
+    """
+    batch_size = 500  # rows per frame
+    flush_interval = 1  # seconds a row may wait for its frame to fill
+
+    def __init__(self, queue, batch_size=None, flush_interval=None):
+        self.queue = queue
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        self.vocab = Vocabulary()
+        self.frame = self._frame()
+        self.sent = time.monotonic()
+        self.lock = threading.Lock()  # the async engine puts from threads
+        self.timer = None  # started by the first put
+
+    def _frame(self):
+        # values are numbered straight into the Frame they are sent with
+        return Frame(self.vocab.name, self.vocab.entries)
+
+    def put(self, obj, block=True, timeout=None):
+        """
+        If the frame can't be sent without blocking, raises queue.Full
+        and obj isn't taken, as with Queue.put. Nor does a put that mustn't
+        block wait for another thread's put to finish.
+        """
+        if self.timer is None and 0 < self.flush_interval < float('inf'):
+            self.timer = threading.Thread(target=self._send_late,
+                                          daemon=True)
+            self.timer.start()
+        if not self.lock.acquire(block, -1 if timeout is None else timeout):
+            raise QueueFull
+        try:
+            row = encode(obj, self.vocab)
+            self.frame.append(row)
+            if (type(row) is tuple and len(self.frame) < self.batch_size and
+                    time.monotonic() - self.sent < self.flush_interval):
+                return
+            try:
+                self.queue.put(self.frame, block, timeout)
+            except QueueFull:
+                self.frame.pop()  # its values can stay numbered
+                raise
+            self.vocab.take()
+            self.frame = self._frame()
+            self.sent = time.monotonic()
+        finally:
+            self.lock.release()
+
+    def _send_late(self):
+        """
+        Send the frame once flush_interval has passed since the last one,
+        unless the queue is full, in which case the Consumer is behind
+        anyway and the frame keeps filling.
+        """
+        while True:
+            with self.lock:
+                wait = self.sent + self.flush_interval - time.monotonic()
+                if wait <= 0:
+                    wait = self.flush_interval
+                    if self.frame:
+                        try:
+                            self.queue.put(self.frame, False)
+                        except QueueFull:
+                            pass
+                        else:
+                            self.vocab.take()
+                            self.frame = self._frame()
+                            self.sent = time.monotonic()
+            time.sleep(wait)
+
+    def put_nowait(self, obj):
+        self.put(obj, False)
+
+    def flush(self):
+        with self.lock:
+            if self.frame:
+                self.queue.put(self.frame)
+                self.vocab.take()
+                self.frame = self._frame()
+            self.sent = time.monotonic()